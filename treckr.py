@@ -32,20 +32,28 @@
 #  - 0.1: March   2019  - First version
 #
 #--------------------------------------------------------------------------------------------------------------
-import serial, time, binascii, os, errno, sys
+import serial, time, binascii, os, errno, sys, glob, hashlib, struct, zlib, zipfile, json, ast, fnmatch, array, mmap, io, functools, concurrent.futures, threading, queue, http.server, multiprocessing
+try:
+    import numpy as np # optional; speeds up queries of capture statistics
+except ImportError:
+    np = None
 #--------------------------------------------------------------------------------------------------------------
 #
 # Definition of USB serial port connected to board
 #
 # <<<<<<< CHANGE HERE FOR YOUR SETTINGS >>>>>>>>>>
 #
-SERIAL_PORT = "COM6"  
+# SERIAL_PORT may be set to the port of the board, e.g. "COM6" or "/dev/ttyACM0".
+# If set to None, all candidate ports are probed and the first one answering the treckr handshake is used.
+SERIAL_PORT = None
+SERIAL_PORT_PATTERNS = ["/dev/ttyACM*", "/dev/ttyUSB*", "/dev/cu.usbmodem*", "/dev/cu.usbserial*"]
 #
 # ------------------------------------------------------------------------------------------------------------- 
 
 # global definitions, don't change
 # -------------------------------------------------------------------------------------------------------------
 RAW_TRACK_SIZE = (7*1024)              # memory used by Arduino to capture the raw contents of one track [in bytes]
+RAW_SECTOR_SIZE = 512                  # disk bytes captured by the board after the address field of a sector (COMMAND_READ_SECTOR)
 SECTOR_SIZE    = 256                   # net storage capacity of one DOS sector
 MAX_SECTORS    = 16                    # number of sectors per disk track
 TRACK_SIZE     = (MAX_SECTORS * SECTOR_SIZE) # Net storage capacity of one track (16 sectors with 256 bytes each)
@@ -54,10 +62,40 @@ DEF_TRACKS     = 35                    # default number of tracks in DOS3.3 form
 DEF_ROUND      = 32                    # default rounding value used by Arduino when calculating time delta between 2 events
 DIR_TRACK      = 17                    # track number hosting the VTOC and table of contents
 RETRY_ATTEMPTS = 3                     # max number of retry attempts when positioning the track motor 
+SPARSE_READ_ATTEMPTS = 1               # number of read attempts for tracks without allocated sectors in sparse capture mode
+FIRST_PASS_ATTEMPTS  = 4               # reads per track in the first pass of 'c'; incomplete tracks are retried after the pass
+RETRY_CHUNK_ATTEMPTS = 8               # reads per incomplete track and sweep of the retry pass of 'c'
+CAPTURE_TIME_BUDGET  = 600             # max time [s] spent on the retry pass of 'c' per disk; 0 = no limit
 BAUD_RATE      = 500000                # Baud rate used on serial connection
+BOOT_TIMEOUT   = 3.0                   # max time [s] for the board to answer the handshake after opening the port (board resets on connect)
+HANDSHAKE_POLL = 0.05                  # time [s] to wait for a handshake response before repeating the handshake
 DISK_DIR_NAME  = "disks"               # name directory path containing the DOS 3.3 image disk files
 VERSION        = "Version 0.5"         # Treckr Version
 QSCAN_TRACKS   = [0,1,2,3,4,DIR_TRACK] # list of tracks to be scanned in quick mode
+DEF_VOLUME     = 254                   # default DOS 3.3 volume number
+EXPORT_FORMATS = []                    # default image formats written in addition to .bin by 'c' and 'r', e.g. ["po", "nib", "woz"]
+NIB_TRACK_SIZE = 6656                  # number of disk bytes per track in .nib files
+MANIFEST_SUFFIX = ".manifest"          # appended to image file names for the integrity manifest (see ImageManifest)
+PROVENANCE_SUFFIX = ".provenance.json" # appended to the name of merged images for the map of sector sources (see merge_captures())
+SECTOR_CACHE_SIZE = 32                 # sectors kept per image opened for lazy file access (see DosImage)
+FINGERPRINT_INDEX = "fingerprints.json" # index of the disk identities of the .bin images in DISK_DIR_NAME (see find_duplicate())
+FINGERPRINT_SAMPLE_TRACKS = 2          # tracks read and compared before a disk is taken as duplicate of an archived image
+DAEMON_HOST    = "127.0.0.1"           # address the capture daemon listens on (treckr.py --daemon [port]); local clients only
+DAEMON_PORT    = 8642                  # default port of the capture daemon
+WATCH_INTERVAL = 10                    # time [s] between two scans of DISK_DIR_NAME by the watch folder service (treckr.py --watch [interval])
+WATCH_STATE    = "watch.json"          # state of the watch folder service in DISK_DIR_NAME: processed .raw files and catalogs of the .bin files
+WATCH_CATALOG_NAME = "catalog"         # name of the catalog index ('g') kept up to date by the watch folder service
+FLUX_AFTER_ATTEMPTS = 4                # board reads of a track before every second read is a flux window (see flux_decode())
+FLUX_THRESHOLDS = [20, 26, 32, 38, 44] # round values [timer ticks] tried by the host on each flux window
+FLUX_CLOCK_WINDOWS = [0, 32, 256]      # bit cell clock: 0 = fixed 4us; n = recovered from the average over n flux intervals
+SECTOR_READ_MAX_MISSING = 2            # missing sectors of a track are read one by one (read_sector_from_drive()) if not more than this
+LINK_COMPRESSION = True                # transfer tracks packed (COMMAND_READ_PACKED) if supported by the board firmware
+BENCHMARK_TRACKS = [0, DIR_TRACK]      # tracks read by the serial link benchmark ('b')
+BENCHMARK_READS  = 3                   # reads per track and transfer mode in the serial link benchmark
+PHYSICAL_2_LOGICAL = [0,13,11,9,7,5,3,1,14,12,10,8,6,4,2,15] # logical DOS 3.3 sector -> physical sector, e.g. logical sector 13 maps to physical sector 1
+PRODOS_2_LOGICAL   = [0,14,13,12,11,10,9,8,7,6,5,4,3,2,1,15] # ProDOS order sector -> logical DOS 3.3 sector
+LOGICAL_OF_PHYSICAL = [PHYSICAL_2_LOGICAL.index( j) for j in range( MAX_SECTORS)] # physical sector -> logical DOS 3.3 sector
+ROUND_VALUES   = [32, 32, 32, 32, 34, 34, 36, 36, 38, 38, 30, 30, 28, 28, 26, 26] # round values used by board for each retry; length needs to be power of 2
 DEBUG          = False                 # control print of debug messages
 # -------------------------------------------------------------------------------------------------------------
 
@@ -66,27 +104,46 @@ class SerialConnection:
     def __init__(self):
         self.configured = False # default start condition of serial connection to board; not initialized
         self.target     = None
+        self.port       = None  # port of the board found during last setup
+        self.track_cache = TrackCache() # decoded sectors of the disk(s) read via this connection
+        self.capture_stats = None       # CaptureStats recording the read attempts of the running capture (if any)
+        self.head_track = None  # track the head has been moved to by the last command; None if unknown
+        self.head_steps = 0     # number of tracks the head has been moved by the commands sent (seek metric)
+        self.flux_supported = None # True if board firmware supports flux reads (COMMAND_READ_FLUX); None if unknown
+        self.capabilities = None   # CAPABILITY_xxx flags reported by the board firmware; None if not queried yet
+        self.last_transfer = None  # (bytes on serial link, track bytes, transfer time [s]) of the last track read
         
     def setup( self):
         """ sets up serial connection to Arduino board (target) """
-        try:
-            if not self.configured:
-                sys.stdout.write( "Setting up serial port " + SERIAL_PORT + " ....")
-                sys.stdout.flush()
-                self.target = serial.Serial( SERIAL_PORT, BAUD_RATE, timeout=0.2)
-                time.sleep(1) #give the connection a second to settle 	
-                self.configured = True     
-                print("ok.") 
-        except Exception as e:
+        if self.configured:
+            return True
+        sys.stdout.write( "Setting up serial connection ....")
+        sys.stdout.flush()
+        ports = list_serial_ports( self.port)
+        if len( ports) == 0:
+            print("failed. No serial ports found. Board not connected?")
+            return False
+        result = probe_serial_ports( ports)
+        if result is None:
             print("failed. Board not connected? Wrong port?")
-            print(str(e))
+            print("Probed ports:", ", ".join( ports))
             return False
+        self.port, self.target, ready_time = result
+        self.configured = True     
+        # board may have been flashed with another firmware since the last setup
+        self.capabilities = None
+        self.flux_supported = None
+        print("ok. Board on port ", self.port, " ready after ", "{0:.2f}".format( ready_time), "s.", sep='') 
         return True  
         
     def is_established( self):
         """ returns logical state of serial connection to Arduino board (target) """
         if not self.configured:
             return False
+        if not self.target.is_open:
+            # port has been closed under our feet (board unplugged); force setup on next command
+            self.configured = False
+            return False
         return True    
         
     def shutdown( self):
@@ -103,8 +160,32 @@ class SerialConnection:
             return None
         else: 
             self.target.write( bytearray("r", "utf-8"))
+            if self.capabilities is None:
+                self.query_capabilities()
         return
         
+    def query_capabilities( self):
+        """ asks board firmware (in single track read mode) for the supported commands (CAPABILITY_xxx flags) """
+        self.target.write( bytearray( [0xB0]))   # CAPABILITIES command
+        while self.target.in_waiting<1:
+            continue
+        response = self.target.read(1)
+        if( response[0] == 0x40):
+            while self.target.in_waiting<1:
+                continue
+            self.capabilities = self.target.read(1)[0]
+            self.flux_supported = bool( self.capabilities & CAPABILITY_FLUX)
+        else:
+            # firmware without CAPABILITIES command has left single track read mode
+            debug("Debug: query_capabilities: unexpected response code: " + str( response))
+            self.capabilities = 0
+            self.target.write( bytearray("r", "utf-8"))
+        return self.capabilities
+        
+    def is_packed_supported( self):
+        """ returns True if tracks are transferred packed (LINK_COMPRESSION set and supported by board firmware) """
+        return LINK_COMPRESSION and bool( self.capabilities and (self.capabilities & CAPABILITY_PACKED))
+        
     def enter_main_loop( self):
         """ configure target to leave single track read mode and enter main loop """
         if not self.configured:
@@ -118,30 +199,112 @@ class SerialConnection:
             response = self.target.read(1)    
         return
                
-    def read_track_from_drive( self, track_id, delay):
-        """ read disk track <track_id> with round value <delay> from drive """
+    def read_track_from_drive( self, track_id, delay, packed=None):
+        """ read disk track <track_id> with round value <delay> from drive; <packed>: None = packed if supported """
         if not self.configured:
             print("Error: read_track_from_drive(): serial IF not configured.")
             return None
         else:
             command = bytearray(3)	
             response = bytearray(1)
+            if packed is None:
+                packed = self.is_packed_supported()
    
-            command[0] = 0x80        # READ command
+            command[0] = 0x81 if packed else 0x80 # READ_PACKED or READ command
             command[1] = track_id    # track to be read
             command[2] = delay       #  delay used by target time stamp calculation
+            self.move_head( track_id)
         
             if( 3 == self.target.write( command)):  
                 while self.target.in_waiting<1:
                     continue
             response = self.target.read(1) 	
             if( response[0] == 0x40):
+                start = time.monotonic()
+                if packed:
+                    return self.read_packed_track( track_id, delay, start)
                 while self.target.in_waiting < RAW_TRACK_SIZE:
                     continue
-                return self.target.read( RAW_TRACK_SIZE)
+                track = self.target.read( RAW_TRACK_SIZE)
+                self.last_transfer = (RAW_TRACK_SIZE, RAW_TRACK_SIZE, time.monotonic() - start)
+                return track
             debug("Debug: read_track_from_drive: unexpected response code: " + str( response))
             return None
 
+    def read_packed_track( self, track_id, delay, start):
+        """ receives and unpacks track data sent by COMMAND_READ_PACKED """
+        decoder = PackedTrackDecoder()
+        while not decoder.finished:
+            waiting = self.target.in_waiting
+            if waiting > 0:
+                decoder.feed( self.target.read( waiting))
+        self.last_transfer = (decoder.wire_bytes, len( decoder.data), time.monotonic() - start)
+        if decoder.error is not None:
+            # transfer corrupted: drop remaining data and repeat read with plain transfer
+            print("Packed track transfer failed (", decoder.error, "). Compression disabled.", sep='')
+            time.sleep( 0.2)
+            self.target.reset_input_buffer()
+            self.capabilities &= ~CAPABILITY_PACKED
+            return self.read_track_from_drive( track_id, delay, packed=False)
+        return bytes( decoder.data)
+
+    def is_flux_supported( self):
+        """ returns False if flux reads are known to be unavailable (old board firmware or NumPy not installed) """
+        return (np is not None) and (self.flux_supported is not False)
+        
+    def read_flux_from_drive( self, track_id):
+        """ read flux transition intervals (RAW_TRACK_SIZE bytes, timer ticks) of disk track <track_id> from drive """
+        if not self.configured:
+            print("Error: read_flux_from_drive(): serial IF not configured.")
+            return None
+        command = bytearray( [0x90, track_id, 0]) # READ_FLUX command, track to be read, unused
+        if( 3 == self.target.write( command)):  
+            while self.target.in_waiting<1:
+                continue
+        response = self.target.read(1) 	
+        if( response[0] == 0x40):
+            self.flux_supported = True
+            self.move_head( track_id)
+            while self.target.in_waiting < RAW_TRACK_SIZE:
+                continue
+            return self.target.read( RAW_TRACK_SIZE)
+        if( response[0] == 0xEF) and (self.flux_supported is None):
+            # firmware without flux reads has left single track read mode
+            print("Board firmware does not support flux reads. Please update the board software.")
+            self.flux_supported = False
+            self.enter_single_track_mode()
+            return None
+        debug("Debug: read_flux_from_drive: unexpected response code: " + str( response))
+        return None
+
+    def move_head( self, track_no):
+        """ records head movement to track <track_no> """
+        self.head_steps += abs( track_no - (self.head_track or 0))
+        self.head_track = track_no
+        
+    def is_sector_read_supported( self):
+        """ returns True if board firmware supports sector reads (COMMAND_READ_SECTOR) """
+        return bool( self.capabilities and (self.capabilities & CAPABILITY_SECTOR))
+        
+    def read_sector_from_drive( self, track_id, delay, sector_id):
+        """ read RAW_SECTOR_SIZE disk bytes following the address field of physical sector <sector_id>; None if not found """
+        if not self.configured:
+            print("Error: read_sector_from_drive(): serial IF not configured.")
+            return None
+        command = bytearray( [0x82, track_id, delay, sector_id]) # READ_SECTOR command, track, round value, physical sector
+        self.move_head( track_id)
+        if( 4 == self.target.write( command)):  
+            while self.target.in_waiting<1:
+                continue
+        response = self.target.read(1) 	
+        if( response[0] == 0x40):
+            while self.target.in_waiting < RAW_SECTOR_SIZE:
+                continue
+            return self.target.read( RAW_SECTOR_SIZE)
+        if( response[0] != 0x44):
+            debug("Debug: read_sector_from_drive: unexpected response code: " + str( response))
+        return None
+
     def reset_track_motor( self, track_no):
         """ forces track motor to reset and return to requested position <track_no> """
         command = bytearray(3)	
@@ -150,6 +313,9 @@ class SerialConnection:
         command[0] = 0x80 #READ
         command[1] = track_no
         command[2] = 255
+        # board moves head beyond track 0 (2 tracks more than its position), next read moves it to <track_no>
+        self.head_steps += (MAX_TRACKS if self.head_track is None else self.head_track) + 3
+        self.head_track = 0
         if( 3 == self.target.write(command)): 
             while self.target.in_waiting<1:
                 continue
@@ -184,7 +350,318 @@ def debug( message):
     if DEBUG:
         print( message)
     return		
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Serial port discovery
+#
+# The board is reset when the port is opened. Instead of waiting a fixed time, the host repeats a short
+# handshake (enter serial test mode and leave it again: 't', COMMAND_FINISH) until the board answers with
+# RESPONSE_FINISH. The board is ready as soon as it has booted.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def list_serial_ports( last_port=None):
+    """ returns list of candidate ports: last used port, SERIAL_PORT, matching device files and ports reported by pyserial """
+    ports = []
+    if last_port:
+        ports.append( last_port)
+    if SERIAL_PORT:
+        ports.append( SERIAL_PORT)
+    for pattern in SERIAL_PORT_PATTERNS:
+        ports += sorted( glob.glob( pattern))
+    try:
+        from serial.tools import list_ports
+        ports += sorted( port.device for port in list_ports.comports())
+    except Exception as e:
+        debug("Debug: list_serial_ports: cannot enumerate ports: " + str(e))
+    # remove duplicates, keep order
+    candidates = []
+    for port in ports:
+        if port not in candidates:
+            candidates.append( port)
+    return candidates
+
+def handshake( target, timeout):
+    """ repeats handshake until board answers; returns time [s] until board was ready, None if board did not answer """
+    start = time.monotonic()
+    target.reset_input_buffer()
+    while time.monotonic() - start < timeout:
+        target.write( bytearray(b't\xf0'))  # enter serial test mode and leave it immediately
+        response = target.read(1)
+        if len( response) == 1 and response[0] == 0x60:
+            # drop late responses to earlier handshake attempts
+            time.sleep( HANDSHAKE_POLL)
+            target.reset_input_buffer()
+            return time.monotonic() - start
+        target.reset_input_buffer()
+    return None
+
+def probe_serial_port( port):
+    """ opens <port> and checks if a treckr board is connected; returns (port, serial IF, ready time) or None """
+    try:
+        target = serial.Serial( port, BAUD_RATE, timeout=HANDSHAKE_POLL)
+    except Exception as e:
+        debug("Debug: probe_serial_port: " + port + ": " + str(e))
+        return None
+    try:
+        ready_time = handshake( target, BOOT_TIMEOUT)
+    except Exception as e:
+        debug("Debug: probe_serial_port: " + port + ": " + str(e))
+        ready_time = None
+    if ready_time is None:
+        target.close()
+        return None
+    target.timeout = 0.2
+    return port, target, ready_time
+
+def probe_serial_ports( ports):
+    """ probes all candidate ports in parallel; returns result of the first port answering the handshake """
+    executor = concurrent.futures.ThreadPoolExecutor( max_workers=len( ports))
+    futures = [executor.submit( probe_serial_port, port) for port in ports]
+    found = None
+    for future in concurrent.futures.as_completed( futures):
+        if future.result() is not None:
+            found = future
+            break
+    # don't wait for the remaining probes; release the port if another board answers later
+    for future in futures:
+        if future is not found:
+            future.add_done_callback( _close_probed_port)
+    executor.shutdown( wait=False)
+    if found is None:
+        return None
+    return found.result()
+
+def _close_probed_port( future):
+    if future.result() is not None:
+        future.result()[1].close()
+ 
+#--------------------------------------------------------------------------------------------------------------
+#
+# Disk image model
+#
+# A DiskImage holds the decoded sectors of a disk in one preallocated bytearray, tracks one after another and sectors
+# in logical DOS 3.3 order (i.e. the layout of the .bin files). Sectors and tracks are handed out as memoryviews,
+# so decoded data is written and read in place without copies.
+# A validity bitmap (one 16-bit mask per track, bit n set = logical sector n decoded) tells which sectors hold data;
+# sectors which have not been decoded are all zero.
+# A TrackImage is the view on one track of a DiskImage as seen by the decoder: sectors are addressed by their
+# physical sector number and mapped to logical sectors via the interleave table LOGICAL_OF_PHYSICAL.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+class DiskImage:
+    def __init__( self, no_tracks=MAX_TRACKS, data=None):
+        if data is None:
+            data = bytearray( no_tracks * TRACK_SIZE)
+        self.no_tracks = no_tracks
+        self.data  = data                                   # image data: no_tracks * TRACK_SIZE bytes
+        self.view  = memoryview( data)
+        self.valid = array.array( 'H', [0] * no_tracks)     # per track: bit mask of decoded logical sectors
+        
+    @classmethod
+    def from_bytes( cls, data):
+        """ returns image of the decoded disk <data> (e.g. content of a .bin file); all sectors are valid """
+        no_tracks = (len( data) + TRACK_SIZE - 1) // TRACK_SIZE
+        image = cls( no_tracks, data)
+        for track_no in range( no_tracks):
+            image.valid[track_no] = 0xffff
+        return image
+        
+    def sector( self, track_no, sector_no):
+        """ returns view on logical sector <sector_no> of track <track_no>; empty if outside of the image """
+        if not( 0 <= track_no < self.no_tracks and 0 <= sector_no < MAX_SECTORS):
+            return self.view[0:0]
+        offset = track_no * TRACK_SIZE + sector_no * SECTOR_SIZE
+        return self.view[offset:offset + SECTOR_SIZE]
+        
+    def track_data( self, track_no):
+        """ returns view on the 16 logical sectors of track <track_no> """
+        return self.view[track_no * TRACK_SIZE:(track_no + 1) * TRACK_SIZE]
+        
+    def track( self, track_no):
+        """ returns TrackImage of track <track_no> """
+        return TrackImage( self, track_no)
+        
+    def is_valid( self, track_no, sector_no):
+        """ returns True if logical sector <sector_no> of track <track_no> has been decoded """
+        if not( 0 <= track_no < self.no_tracks and 0 <= sector_no < MAX_SECTORS):
+            return False
+        return (self.valid[track_no] >> sector_no) & 1 == 1
+        
+    def missing_sectors( self, track_no):
+        """ returns sorted list of logical sectors of track <track_no> which have not been decoded """
+        mask = self.valid[track_no]
+        return [j for j in range( MAX_SECTORS) if not (mask >> j) & 1]
+        
+    def merge( self, other):
+        """ copies the valid sectors of image <other> which are not valid in this image """
+        for track_no in range( min( self.no_tracks, other.no_tracks)):
+            new = other.valid[track_no] & ~self.valid[track_no]
+            for j in range( MAX_SECTORS):
+                if (new >> j) & 1:
+                    self.sector( track_no, j)[:] = other.sector( track_no, j)
+            self.valid[track_no] |= new
+            
+
+class TrackImage:
+    def __init__( self, disk, track_no):
+        self.disk     = disk
+        self.track_no = track_no
+        self.data     = disk.track_data( track_no)          # 16 logical sectors of this track
+        
+    def sector( self, physical_sector):
+        """ returns view on physical sector <physical_sector> """
+        offset = LOGICAL_OF_PHYSICAL[physical_sector] * SECTOR_SIZE
+        return self.data[offset:offset + SECTOR_SIZE]
+        
+    def is_valid( self, physical_sector):
+        """ returns True if physical sector <physical_sector> has been decoded """
+        return (self.disk.valid[self.track_no] >> LOGICAL_OF_PHYSICAL[physical_sector]) & 1 == 1
+        
+    def set_valid( self, physical_sector):
+        """ marks physical sector <physical_sector> as decoded """
+        self.disk.valid[self.track_no] |= 1 << LOGICAL_OF_PHYSICAL[physical_sector]
+        
+    def count( self):
+        """ returns number of decoded sectors """
+        return bin( self.disk.valid[self.track_no]).count( "1")
+        
+    def is_complete( self, logical_sectors=None):
+        """ returns True if all sectors (or all sectors in list <logical_sectors>) have been decoded """
+        mask = self.disk.valid[self.track_no]
+        if logical_sectors is None:
+            return mask == 0xffff
+        return all( (mask >> j) & 1 for j in logical_sectors)
+        
+    def missing_sectors( self):
+        """ returns sorted list of logical sectors which have not been decoded """
+        return self.disk.missing_sectors( self.track_no)
+        
  
+#--------------------------------------------------------------------------------------------------------------
+#
+# Session cache of decoded sectors
+#
+# Decoded sectors are kept per disk (as DiskImage), so a sector recovered once does not cost drive time again.
+# A disk is identified by its volume number and a fingerprint of the VTOC and catalog sectors (see disk_identity()).
+# Tracks read before the disk in the drive has been identified are kept in a pending image which is assigned to the disk
+# as soon as DIR_TRACK has been decoded.
+# Different disks can have the same VTOC and catalog (copies of a disk, data disks rewritten in place). If the identity
+# is already in the cache, the disk in the drive is read into the pending image until a track with data (not DOS tracks
+# 0-2 or DIR_TRACK) has been compared with the cached image (see confirm()). If the decoded sectors are equal, the cached 
+# sectors are used; otherwise the disk gets an identity of its own (volume, fingerprint, number of the variant).
+# begin_disk() needs to be called whenever the disk in the drive may have been changed.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+class TrackCache:
+    def __init__(self):
+        self.disks   = {}   # disk identity -> DiskImage
+        self.current = None # identity of disk in drive; None if not identified yet
+        self.pending = DiskImage() # sectors read from disk in drive before it has been identified (and confirmed)
+        self.confirmed = True # False: identity of disk in drive is in the cache, but the disk has not been compared yet
+        
+    def begin_disk( self):
+        """ disk in drive may have been changed; cached sectors are not used until the disk is identified again """
+        self.current = None
+        self.pending = DiskImage()
+        self.confirmed = True
+        
+    def clear( self):
+        """ drops all cached sectors """
+        self.disks = {}
+        self.begin_disk()
+        
+    def is_identified( self):
+        """ returns True if disk in drive has been identified """
+        return self.current is not None
+        
+    def identify( self, identity):
+        """ assigns disk in drive to <identity>; sectors read so far are merged into the image of this disk
+            a disk of a cached identity is not confirmed until confirm() has compared it (see confirm_cached_disk()) """
+        self.current = identity
+        if identity not in self.disks:
+            self.disks[identity] = self.pending
+            self.pending = DiskImage()
+            return
+        self.confirmed = False
+        
+    def variants( self):
+        """ returns identities of the cached disks with the identity of the disk in drive """
+        return [identity for identity in self.disks if identity[:2] == self.current[:2]]
+        
+    def confirm( self):
+        """ compares the tracks read from disk in drive with the cached disks of the same identity; uses the matching one 
+            (a new one if all differ; the first one without comparable data tracks if none matches) """
+        variants = self.variants()
+        results = [compare_cached_tracks( self.pending, self.disks[identity]) for identity in variants]
+        if True in results:
+            self.current = variants[results.index( True)]
+            print("Disk matches a disk read before (VTOC, catalog and a data track). Cached sectors are used; use 'x' to read all sectors again.")
+        elif all( result is False for result in results):
+            self.current = self.current[:2] + (len( variants),)
+            print("Disk has the same VTOC and catalog as a disk read before, but different data. Cached sectors are not used.")
+        else:
+            self.current = variants[results.index( None)]
+            print("Disk has the same VTOC and catalog as a disk read before (no data track to compare). Cached sectors are used; use 'x' to read all sectors again.")
+        if self.current in self.disks:
+            self.disks[self.current].merge( self.pending)
+        else:
+            self.disks[self.current] = self.pending
+        self.pending = DiskImage()
+        self.confirmed = True
+        
+    def add_reads( self, image):
+        """ merges the sectors of DiskImage <image>, read from disk in drive without the cache, into the image of the disk
+            the disk is cached separately if they differ from the cached sectors """
+        if( self.current is None) or not self.confirmed:
+            self.pending.merge( image)
+            return
+        if compare_cached_tracks( image, self.disks[self.current]) is False:
+            self.current = self.current[:2] + (len( self.variants()),)
+            self.disks[self.current] = DiskImage()
+            print("Disk differs from the disk read before with the same VTOC and catalog. Cached sectors are not used.")
+        self.disks[self.current].merge( image)
+        
+    def image( self):
+        """ returns DiskImage of disk in drive """
+        if( self.current is None) or not self.confirmed:
+            return self.pending
+        return self.disks[self.current]
+        
+        
+def compare_cached_tracks( image, cached):
+    """ compares sectors decoded in both DiskImages (tracks with data only); returns True if equal, False if not, None if unknown """
+    equal = 0
+    for track_no in range( 3, min( image.no_tracks, cached.no_tracks)):
+        if track_no == DIR_TRACK:
+            continue
+        for sector_no in range( MAX_SECTORS):
+            if not( image.is_valid( track_no, sector_no) and cached.is_valid( track_no, sector_no)):
+                continue
+            if image.sector( track_no, sector_no) != cached.sector( track_no, sector_no):
+                return False
+            if any( image.sector( track_no, sector_no)):
+                equal += 1
+    return True if equal > 0 else None
+        
+        
+def disk_identity( disk_dec, missing_sector_list):
+    """ returns identity (volume, fingerprint) of disk from its decoded DIR_TRACK; None if VTOC is missing """
+    if 0 in missing_sector_list:
+        return None
+    fingerprint = hashlib.sha1()
+    fingerprint.update( disk_dec[0:SECTOR_SIZE])
+    # add catalog sectors in catalog order
+    visited = []
+    track, sector = disk_dec[1], disk_dec[2]
+    while track == DIR_TRACK and 0 < sector < MAX_SECTORS and sector not in visited and sector not in missing_sector_list:
+        visited.append( sector)
+        catalog_sector = disk_dec[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+        fingerprint.update( catalog_sector)
+        track, sector = catalog_sector[1], catalog_sector[2]
+    return disk_dec[6], fingerprint.hexdigest()
+    
+
 #--------------------------------------------------------------------------------------------------------------
 #
 # read track from drive and convert to DOS 3.3 format
@@ -194,81 +671,140 @@ def debug( message):
 #         track_no: number of requested track to be read (0..39)
 #         repeat_counter:  how many times shall be attempted to reposition the track motor in case of errors
 #                          if set to 0, also limit the number of read attempts per track to 3
+#         attempts_limit:  if set, limits the number of read attempts (best effort read)
+#         needed_sectors:  if set, list of logical sectors; reading stops as soon as these sectors have been decoded
 # returns:
 #         rc:               True (ok); False (track could not be read)
 #         read_sectors:     number of decoded sectors in this track
 #         list:             list of missing logical sectors
-#         track_dec:        16*256 bytes of decoded data fields 
+#         round_list:       round values of the read attempts which decoded new sectors
+#         track_dec:        16*256 bytes of decoded data fields (view on the track in the DiskImage of the disk in the drive)
+#
+# Sectors decoded before (see TrackCache) are not read again. Only missing sectors are searched for on the drive.
 #
 # ------------------------------------------------------------------------------------------------------------- 
-def track_read( connection, track_no, repos_attempts):
+def track_read( connection, track_no, repos_attempts, attempts_limit=None, needed_sectors=None, first_attempt=0, motor_resets=True, image=None):
+    # image: DiskImage the sectors are decoded into instead of the track cache (the track is read from the drive)
 	  
-    track_dec_phys_total = {}
-    missing_logical_sector_list=[]
-    track_dec=bytearray()   
-    total_track_dec=[]  
+    track_cache = connection.track_cache
+    track_image = (image or track_cache.image()).track( track_no)
     round_success_list=[]
-    # round values to be used by assembly read function on board for each retry
-    ROUND_VALUES =[32, 32, 32, 32, 34, 34, 36, 36, 38, 38, 30, 30, 28, 28, 26, 26] # length needs to be power of 2
     
-    attempts = 0
+    # attempts made before (by earlier calls for this track) continue the sequence of round values
+    attempts = first_attempt
     if repos_attempts == 0:
         max_attempts = 8 # fast mode for quick scan
     else:
         max_attempts = len( ROUND_VALUES) * repos_attempts
+    if attempts_limit is not None:
+        max_attempts = min( max_attempts, first_attempt + attempts_limit)
         
-    finished=False
+    finished = track_image.is_complete( needed_sectors)
     while not finished:
-        # read requested track from drive
-        track = connection.read_track_from_drive( track_no, ROUND_VALUES[attempts % len(ROUND_VALUES)])
-        attempts+=1
-        if track == None:
-            print("track==None")
-            break    
-        # decode track and get content of physical sectors
-        # note that the sector list may be incomplete
-        read_track_no, track_dec_phys = track_decode_dos33( track.hex())
-        if( track_no == read_track_no):
-            # search for new sectors in this read attempts
-            # if available, add them to dictionary track_dec_phys_total
-            for sector in track_dec_phys:
-                if sector not in track_dec_phys_total:
-                    track_dec_phys_total[sector] = track_dec_phys[sector]
-                    print("Track: ", track_no,". Decoded Sectors:", len( track_dec_phys_total), end="\r", flush=True)
-                    # log ROUND_VALUE (debug purposes)
-                    round_success_list.append( ROUND_VALUES[attempts % len(ROUND_VALUES)])
+        errors = {"header_errors": 0, "data_errors": 0, "wrong_track": 0}
+        # the last missing sectors are read one by one: the board waits for their address field, 
+        # so each sector costs one revolution at most instead of a full track transfer
+        missing_physical_sectors = [PHYSICAL_2_LOGICAL[j] for j in track_image.missing_sectors() if needed_sectors is None or j in needed_sectors]
+        sector_reads = (attempts > 0) and (len( missing_physical_sectors) <= SECTOR_READ_MAX_MISSING) and connection.is_sector_read_supported()
+        # a flux window covers about 1/5 of a revolution only: flux reads alternate with reads of the whole track
+        # (or of the missing sectors), which remain the retry path
+        flux_reads = (attempts >= FLUX_AFTER_ATTEMPTS) and ((attempts - FLUX_AFTER_ATTEMPTS) % 2 == 0) and connection.is_flux_supported()
+        flux = None
+        if flux_reads:
+            # instead of re-reading the track with other round values, capture flux intervals and 
+            # let the host try all thresholds and clock recovery variants on them
+            flux = connection.read_flux_from_drive( track_no)
+        if flux is not None:
+            attempts+=1
+            read_mode = READ_MODE_FLUX
+            round_value = 0
+            new_sectors = []
+            for threshold, clock_window, sectors in flux_decode( flux, track_image, errors):
+                new_sectors += sectors
+                # log threshold of decode variant (debug purposes)
+                round_success_list += [threshold] * len( sectors)
+                if( len( sectors) > 0) and (round_value == 0):
+                    round_value = threshold
+        elif sector_reads:
+            read_mode = READ_MODE_SECTOR
+            round_value = ROUND_VALUES[attempts % len(ROUND_VALUES)]
+            attempts+=1
+            new_sectors = []
+            for sector_no in missing_physical_sectors:
+                sector_data = connection.read_sector_from_drive( track_no, round_value, sector_no)
+                if sector_data is None:
+                    # address field not found
+                    errors["header_errors"] += 1
+                elif decode_sector_capture( sector_data, track_image, sector_no):
+                    new_sectors.append( sector_no)
+                else:
+                    errors["data_errors"] += 1
+            round_success_list += [round_value] * len( new_sectors)
+        else:
+            # read requested track from drive
+            read_mode = READ_MODE_BOARD
+            round_value = ROUND_VALUES[attempts % len(ROUND_VALUES)]
+            track = connection.read_track_from_drive( track_no, round_value)
+            attempts+=1
+            if track == None:
+                print("track==None")
+                break    
+            # decode sectors of this track which have not been decoded yet directly into the disk image
+            # note that the sector list may be incomplete
+            read_track_no, new_sectors = track_decode_dos33( track, track_image, errors=errors)
+            # log ROUND_VALUE (debug purposes)
+            round_success_list += [round_value] * len( new_sectors)
+        if len( new_sectors) > 0:
+            print("Track: ", track_no,". Decoded Sectors:", track_image.count(), end="\r", flush=True)
                     					
-        # check if all sectors in current track have been decoded successfully         
-        if( len( track_dec_phys_total) == MAX_SECTORS) or (attempts == max_attempts):
-            finished=True
+        # check if all (needed) sectors in current track have been decoded successfully         
+        finished = track_image.is_complete( needed_sectors) or (attempts >= max_attempts)
         # reposition track motor if all attempts failed        
-        elif( attempts % len( ROUND_VALUES) == 0):
+        motor_reset = motor_resets and not finished and (attempts % len( ROUND_VALUES) == 0)
+        if connection.capture_stats is not None:
+            connection.capture_stats.add_read( track_no, attempts, read_mode, round_value, [LOGICAL_OF_PHYSICAL[j] for j in new_sectors], 
+                                               track_image.count(), errors, motor_reset)
+        if motor_reset:
             connection.reset_track_motor( track_no)
 	
-    sectors_read = len(	track_dec_phys_total)
-    j=0
-    while j<MAX_SECTORS:
-        # fill missing physical sectors with all zero pattern
-        if j not in track_dec_phys_total:
-            track_dec_phys_total[j] = [0 for i in range( SECTOR_SIZE)]
-            missing_logical_sector_list.append(j)
-        j+=1
-                
-    # now reassemble 16 physical to 16 logical sectors
-   	# e.g. logical sector 13 maps to physical sector 1
-    physical_2_logical_sector_mapping_list=[0,13,11,9,7,5,3,1,14,12,10,8,6,4,2,15]
-    for j in physical_2_logical_sector_mapping_list:
-        track_dec += bytes( track_dec_phys_total[j])			
+    sectors_read = track_image.count()
+    missing_logical_sector_list = track_image.missing_sectors()
+    # missing sectors are all zero in the image
+    track_dec = track_image.data
           	  
-    if( sectors_read == MAX_SECTORS):
+    if( attempts == first_attempt) and (sectors_read == MAX_SECTORS):
+        print("Track ", track_no, ": ", MAX_SECTORS," sectors taken from cache.       ", sep='')
+    elif( sectors_read == MAX_SECTORS):
         print("Track ", track_no, ": ", MAX_SECTORS," sectors decoded correctly.       ", sep='')
+    elif track_image.is_complete( needed_sectors):
+        print("Track ", track_no, ": required sector(s) ", str( sorted( needed_sectors)), " decoded.       ", sep='')
     else:
-        print("Track ", track_no, ". Incomplete track read. Sector(s) ", str( sorted( missing_logical_sector_list)), " could not be decoded.", sep='')
+        print("Track ", track_no, ". Incomplete track read. Sector(s) ", str( missing_logical_sector_list), " could not be decoded.", sep='')
+
+    # identify disk when reading the track with VTOC and catalog, so sectors of this disk can be reused later
+    if( image is None) and (track_no == DIR_TRACK) and not track_cache.is_identified():
+        identity = disk_identity( track_dec, missing_logical_sector_list)
+        if identity is not None:
+            track_cache.identify( identity)
+            if not track_cache.confirmed:
+                confirm_cached_disk( connection)
 
-   # print(read_sectors, missing_logical_sector_list)
-    return True, len( track_dec_phys_total), sorted( missing_logical_sector_list), round_success_list, track_dec
+    return True, sectors_read, missing_logical_sector_list, round_success_list, track_dec
 	
 
+def confirm_cached_disk( connection):
+    """ disk in drive has the identity of a cached disk: reads a data track which has been cached and confirms the disk """
+    track_cache = connection.track_cache
+    vtoc = track_cache.pending.sector( DIR_TRACK, 0)
+    disk_no_tracks = vtoc[0x34] if DEF_TRACKS <= vtoc[0x34] <= MAX_TRACKS else DEF_TRACKS
+    cached = [track_cache.disks[identity] for identity in track_cache.variants()]
+    for track_no in sample_tracks( vtoc, disk_no_tracks, MAX_TRACKS):
+        if any( disk.is_valid( track_no, j) and any( disk.sector( track_no, j)) for disk in cached for j in range( MAX_SECTORS)):
+            track_read( connection, track_no, RETRY_ATTEMPTS, FIRST_PASS_ATTEMPTS, image=track_cache.pending)
+            break
+    track_cache.confirm()
+    
+
 #--------------------------------------------------------------------------------------------------------------
 #
 # decode DOS 3.3 sector address field
@@ -309,72 +845,101 @@ LUT =     [0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x0
            0x00, 0x00, 0x00, 0x00, 0x00, 0x29, 0x2a, 0x2b, 0x00, 0x2c, 0x2d, 0x2e, 0x2f, 0x30, 0x31, 0x32,
            0x00, 0x00, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x00, 0x39, 0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f] 
 
-def decode_data_field( data_field):
-  
-    data_256=[]
+# 6-bit value of each disk byte as translation table for bytes.translate()
+DECODE_6_2 = bytes( LUT[i & 0x7f] for i in range( 256))
+# the 2-bit values in the 86 byte field are stored with swapped bits
+SWAP_2 = [0, 2, 1, 3]
+
+def decode_data_field( data_field, sector):
+    """ decodes the 346 disk bytes following the data field header into the 256 byte buffer <sector>; returns False on error """
+    
     # check if data field has correct trailer
-    if( data_field[-1] != 0xeb or data_field[-2] != 0xaa or data_field[-3] != 0xde):
-        return False, data_256
+    if( data_field[345] != 0xeb or data_field[344] != 0xaa or data_field[343] != 0xde):
+        return False
 
     # DOS 3.3 data fields consists of five parts
     # 3 byte header: d5-aa-ad
-    # 256 bytes field containing encoded representation of lower 6-bits (torso) of the unencoded data field
-    # 86 bytes field containing encoded representation of multiplexed higher 2-bits of unencoded data field;
+    # 86 bytes field containing encoded representation of multiplexed lower 2-bits of unencoded data field;
     #          the unencoded 256 field is structured in 3 columns, where the 2-bit values of three columns are grouped in one code word
+    # 256 bytes field containing encoded representation of higher 6-bits (torso) of the unencoded data field
     #          the decoding of a 6bit->8bit value is done using a look up table (LUT)
     # 1 byte checksum
     # 3 byte trailer: 0xde-0xaa-0xeb
   
-    # step 1 - decode first 86 bytes of encoded block in 6-bit values
+    # step 1 - decode 342 bytes of encoded block in 6-bit values; each value is XORed with the previous one
+    values = bytes( data_field[0:343]).translate( DECODE_6_2)
     dec=0
-    data_256_2_8=[]
+    decoded = bytearray( 342)
     i=0
-    while i<86:
-        dec ^= LUT[data_field[i] & 0x7f]
-        data_256_2_8.insert( 0, dec)
-        i+=1  
-  
-    # step 2 - decode remaining 256 bytes of encoded block in 6-bit values
     while i<342:
-        dec ^= LUT[data_field[i] & 0x7f]
-        data_256.append( dec << 2)
+        dec ^= values[i]
+        decoded[i] = dec
         i+=1  
 
-    # step 3 - verify checksum (XOR of data bytes)
-    if (dec != LUT[data_field[342] & 0x7f]): 
-        #print("CRC error")
-        return False, data_256
+    # step 2 - verify checksum (XOR of data bytes); sector buffer is not touched if the data field is corrupt
+    if (dec != values[342]): 
+        return False
     
-   # print([hex(x) for x in data_256])
-    #print([hex(x) for x in data_256_2_8])
-    
-    # step 4 - demux the 86 bytes containing 3 muxed pairs of 2 MSBs and insert them as MSBs next to the 6-bit torso fields of the remaining 256 byte field
-    # processing is done in three columns: 84 bytes, 86 bytes, 86 bytes: first group is smaller because two 2-bit fields are unused (86*6=512+2*2)
+    # step 3 - demux the 86 bytes containing 3 muxed pairs of 2 LSBs and insert them next to the 6-bit torso fields
+    # processing is done in three columns: 86 bytes, 86 bytes, 84 bytes: last group is smaller because two 2-bit fields are unused (86*6=512+2*2)
     i=0
-    while i<84: 
-        p = ((data_256_2_8[2+i]>>4) & 3)
-        if(p==2): p=1
-        elif (p==1): p=2
-        data_256[255-i] |= p
-        i+=1
-  
-    i=0  
     while i<86:
-        p = ((data_256_2_8[i]>>2) & 3)
-        if(p==2): p=1
-        elif(p==1): p=2
-        data_256[171-i] |= p
+        aux = decoded[i]
+        sector[i] = (decoded[86+i] << 2 | SWAP_2[aux & 3]) & 0xff
+        sector[86+i] = (decoded[172+i] << 2 | SWAP_2[(aux >> 2) & 3]) & 0xff
+        if i<84:
+            sector[172+i] = (decoded[258+i] << 2 | SWAP_2[(aux >> 4) & 3]) & 0xff
         i+=1
-  
-    i=0  
+   
+    return True
+
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# encode DOS 3.3 sector data field and address field (inverse of decode_data_field() and check_address_field())
+#
+# ------------------------------------------------------------------------------------------------------------- 
+
+# GCR_6_2 = 6-bit data words to disk bytes (inverse of LUT)
+GCR_6_2 = [0x96, 0x97, 0x9a, 0x9b, 0x9d, 0x9e, 0x9f, 0xa6, 0xa7, 0xab, 0xac, 0xad, 0xae, 0xaf, 0xb2, 0xb3,
+           0xb4, 0xb5, 0xb6, 0xb7, 0xb9, 0xba, 0xbb, 0xbc, 0xbd, 0xbe, 0xbf, 0xcb, 0xcd, 0xce, 0xcf, 0xd3,
+           0xd6, 0xd7, 0xd9, 0xda, 0xdb, 0xdc, 0xdd, 0xde, 0xdf, 0xe5, 0xe6, 0xe7, 0xe9, 0xea, 0xeb, 0xec,
+           0xed, 0xee, 0xef, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff]
+
+def encode_data_field( data):
+    """ returns 343 disk bytes (342 data bytes + checksum) encoding the 256 bytes <data> """
+    
+    def swap( p): # the 2-bit values are stored with swapped bits
+        return ((p & 1) << 1) | ((p >> 1) & 1)
+        
+    # 86 bytes containing 3 muxed pairs of 2 LSBs, followed by the 256 6-bit torso fields
+    values = []
+    i=0
     while i<86:
-        p = ((data_256_2_8[i]) & 3)
-        if(p==2): p=1
-        elif(p==1): p=2
-        data_256[85-i] |= p
+        value = swap( data[i] & 3) | (swap( data[86+i] & 3) << 2)
+        if( i < 84):
+            value |= swap( data[172+i] & 3) << 4
+        values.append( value)
         i+=1
-   
-    return True, data_256
+    values += [x >> 2 for x in data]
+    
+    # disk bytes are XOR of two subsequent values; last value serves as checksum
+    encoded = bytearray()
+    previous = 0
+    for value in values:
+        encoded.append( GCR_6_2[value ^ previous])
+        previous = value
+    encoded.append( GCR_6_2[previous])
+    return encoded
+
+def encode_address_field( volume_no, track_no, sector_no):
+    """ returns 14 disk bytes of sector address field (header, 4-and-4 encoded values, trailer) """
+    field = bytearray( b'\xd5\xaa\x96')
+    for value in [volume_no, track_no, sector_no, volume_no ^ track_no ^ sector_no]:
+        field.append( (value >> 1) | 0xaa)
+        field.append( value | 0xaa)
+    field += b'\xde\xaa\xeb'
+    return field
 
 
 #--------------------------------------------------------------------------------------------------------------
@@ -382,80 +947,262 @@ def decode_data_field( data_field):
 # decode track into DOS 3.3 sector format
 # 
 # input:
-#         track: data retrieved from board (string with length of 7KB)
+#         track:       disk bytes retrieved from board (bytes, bytearray or mmap; usually 7KB)
+#         track_image: TrackImage receiving the decoded sectors; sectors already decoded are skipped
+#         start, end:  optional range of <track> to be decoded (e.g. one track within a .raw file)
+#         errors:      optional dictionary counting "header_errors" (damaged address fields), "data_errors" (corrupt data
+#                      fields of sectors not decoded yet) and "wrong_track" (address fields of another track)
 # returns:
-#         track_no: number of track
-#         sector_list: list of successfully decoded sectors (sector header + data field)
-#         track_dec: list of decoded data sectors (16*256 bytes). An invalid data field is replaced by an empty field (all 256 bytes set to 0)
+#         track_no:    number of track found in the last valid address field (255 if none)
+#         new_sectors: list of physical sectors decoded into <track_image> by this call
+#
+# Only sectors with an address field matching the track number of <track_image> are stored. 
+# Sectors with a damaged address field or data field are skipped.
 #   
 # -------------------------------------------------------------------------------------------------------------   
-def track_decode_dos33( track):
+ADR_FIELD_HEADER  = b'\xd5\xaa\x96'
+DATA_FIELD_HEADER = b'\xd5\xaa\xad'
+
+def track_decode_dos33( track, track_image, start=0, end=None, errors=None):
     
-    track_dec_phys={}
+    new_sectors=[]
     track_no = 255 # initialize with invalid number
+    if end is None or end > len( track):
+        end = len( track)
+    view = memoryview( track)
     
-    adr_field_header  = "d5aa96"
-    adr_field_size    = 13*2 # 13 bytes
-    data_field_header = "d5aaad"
-    data_field_size   = 349*2 # 349 bytes
+    adr_field_size    = 13  # 13 bytes following the address field header position
+    data_field_size   = 346 # 346 bytes following the data field header
     
-    finished=False
-    while not finished:
-        # search for next address field header
-        s=track.find( adr_field_header)
-        if s == -1:
-            finished=True
-            break
-        # sector field header has been found
-        # check if remaining size of the track is smaller than a sector field (26 nibbles)
-        if len( track[s:]) < adr_field_size:
-            finished=True
-            break
-        try:    
-        # convert address field into list of 8bit integers
-            address_field = [int(track[s+i:s+i+2],16) for i in range( 0, adr_field_size, 2)]
-        except:
-            print(track[s:s+adr_field_size])
-            exit(1)
+    # search for first address field header
+    s = track.find( ADR_FIELD_HEADER, start, end)
+    while( s != -1) and (s + adr_field_size <= end):
         # check sector field header field content
-        adr_field_ok, track_no, sector_no = check_address_field( address_field)
+        adr_field_ok, adr_track_no, sector_no = check_address_field( view[s:s+adr_field_size])
+        s += adr_field_size
         if not adr_field_ok:
-            # sector field is invalid
-            #print("Header error")
-            track=track[s+adr_field_size:]
-            break         
-          
-        # address field is valid; advance by length of address field header 
-        track=track[s+adr_field_size:]
-        # now search for data field header
-        t=track.find( data_field_header)
-        if( t == -1):
-            # no data field found
-            finished=True
-            break   
-              
-        # check if remaining track length is sufficient to contain a complete data field
-        if( len(track[t+6:]) < data_field_size):
-            finished=True
+            # sector field is invalid; continue with next address field
+            if errors is not None:
+                errors["header_errors"] += 1
+            s = track.find( ADR_FIELD_HEADER, s, end)
+            continue
+        track_no = adr_track_no
+        if( adr_track_no != track_image.track_no) and (errors is not None):
+            errors["wrong_track"] += 1
+        
+        # address field is valid; now search for data field header
+        t = track.find( DATA_FIELD_HEADER, s, end)
+        if( t == -1) or (t + 3 + data_field_size > end):
+            # no (complete) data field found
             break
         # check that data field belongs to the current sector 
-        if( t > 50*2):
-            break # data field header too far away from address field header ; ignore this sector
+        if( t - s > 50):
+            # data field header too far away from address field header ; ignore this sector
+            s = track.find( ADR_FIELD_HEADER, s, end)
+            continue
             
-        data_field = [int(track[t+i:t+i+2],16) for i in range( 6, data_field_size, 2)]
-        # decode data field
-        data_field_ok, data_dec = decode_data_field( data_field)
-        
-        if data_field_ok:
-            if sector_no not in track_dec_phys:
-                # data field is ok; insert sector in result list
-                track_dec_phys[sector_no] = data_dec
-            if len( track_dec_phys) == MAX_SECTORS:
-                finished=True
-                break
+        if( adr_track_no == track_image.track_no) and (sector_no < MAX_SECTORS) and not track_image.is_valid( sector_no):
+            # decode data field into the image
+            if decode_data_field( view[t+3:t+3+data_field_size], track_image.sector( sector_no)):
+                track_image.set_valid( sector_no)
+                new_sectors.append( sector_no)
+                if track_image.is_complete():
+                    break
+            elif errors is not None:
+                errors["data_errors"] += 1
+        s = track.find( ADR_FIELD_HEADER, t + 3 + data_field_size, end)
               
-    return track_no, track_dec_phys
+    view.release()
+    return track_no, new_sectors
   
+def decode_sector_capture( sector_data, track_image, sector_no):
+    """ decodes data field of physical sector <sector_no> from <sector_data> (read_sector_from_drive()); returns True if decoded """
+    # capture starts behind the sector number of the address field; data field header follows within a few bytes
+    t = sector_data.find( DATA_FIELD_HEADER, 0, 60)
+    if( t == -1) or (t + 3 + 346 > len( sector_data)):
+        return False
+    if not decode_data_field( memoryview( sector_data)[t+3:t+3+346], track_image.sector( sector_no)):
+        return False
+    track_image.set_valid( sector_no)
+    return True
+    
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Packed track transfer (COMMAND_READ_PACKED)
+#
+# The board sends the captured disk bytes as 6-bit symbols, four symbols packed in three bytes (MSB first):
+#   0..62:   disk byte GCR_6_2[symbol], i.e. every byte of the 6-and-2 code except 0xFF
+#   63:      escape (PACKED_ESCAPE); the next symbol is
+#            0..47:  run of 1..48 0xFF bytes (sync bytes)
+#            48/49:  disk byte 0xD5/0xAA (field headers)
+#            50:     any other byte; the upper 2 bits and the lower 6 bits follow as two symbols
+#            51:     end of track data; the remaining bits of the last byte are zero
+#            52:     the remaining bits of this byte are zero, the track data follows unpacked (RAW_TRACK_SIZE bytes);
+#                    sent if the symbols would need more bytes than the track data (e.g. unformatted tracks)
+# A DOS 3.3 track needs about 75% of the bytes of the plain transfer. The board sends while packing, so the
+# transfer time is reduced accordingly. The capture itself is unchanged, the unpacked data is identical.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+CAPABILITY_PACKED = 0x01 # board firmware supports COMMAND_READ_PACKED
+CAPABILITY_FLUX   = 0x02 # board firmware supports COMMAND_READ_FLUX
+CAPABILITY_SECTOR = 0x04 # board firmware supports COMMAND_READ_SECTOR
+PACKED_ESCAPE     = 63
+PACKED_MAX_RUN    = 48
+PACKED_D5         = 48
+PACKED_AA         = 49
+PACKED_LITERAL    = 50
+PACKED_END        = 51
+PACKED_PLAIN      = 52
+
+class PackedTrackDecoder:
+    """ unpacks the symbol stream of COMMAND_READ_PACKED; data can be fed in pieces as received from the board """
+    def __init__( self):
+        self.data = bytearray()
+        self.wire_bytes = 0    # number of packed bytes decoded
+        self.finished = False  # end of track data or error found
+        self.error = None      # description of the error found
+        self.acc = 0           # bits not decoded yet
+        self.bits = 0          # number of bits in acc
+        self.state = 0         # 0: symbol, 1: escape code, 2: upper bits of literal, 3: lower bits of literal, 4: plain bytes
+        self.literal = 0
+        
+    def feed( self, packed):
+        """ decodes <packed> bytes; returns True when end of track data has been reached """
+        data, acc, bits, state, literal = self.data, self.acc, self.bits, self.state, self.literal
+        for byte in packed:
+            if self.finished:
+                break
+            self.wire_bytes += 1
+            if state == 4:
+                data.append( byte)
+                if len( data) == RAW_TRACK_SIZE:
+                    self.finished = True
+                continue
+            acc = ((acc << 8) | byte) & 0x3fff
+            bits += 8
+            while bits >= 6:
+                bits -= 6
+                symbol = (acc >> bits) & 0x3f
+                if state == 0:
+                    if symbol == PACKED_ESCAPE:
+                        state = 1
+                    else:
+                        data.append( GCR_6_2[symbol])
+                elif state == 1:
+                    state = 0
+                    if symbol < PACKED_MAX_RUN:
+                        data += b'\xff' * (symbol + 1)
+                    elif symbol == PACKED_D5:
+                        data.append( 0xd5)
+                    elif symbol == PACKED_AA:
+                        data.append( 0xaa)
+                    elif symbol == PACKED_LITERAL:
+                        state = 2
+                    elif symbol == PACKED_PLAIN:
+                        state = 4
+                        bits = 0
+                        break
+                    elif symbol == PACKED_END:
+                        self.finished = True
+                        if len( data) != RAW_TRACK_SIZE:
+                            self.error = "track size " + str( len( data))
+                        break
+                    else:
+                        self.finished = True
+                        self.error = "invalid escape code " + str( symbol)
+                        break
+                elif state == 2:
+                    literal = symbol << 6
+                    state = 3
+                else:
+                    data.append( literal | symbol)
+                    state = 0
+            if( len( data) > RAW_TRACK_SIZE) and not self.finished:
+                self.finished = True
+                self.error = "track size exceeded"
+        self.acc, self.bits, self.state, self.literal = acc, bits, state, literal
+        return self.finished
+
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Software decoding of flux transition intervals
+#
+# In flux read mode (see read_flux_from_drive()) the board returns the time intervals between flux transitions in 
+# timer ticks (62.5ns, i.e. 64 ticks per 4us bit cell) instead of disk bytes. The board RAM holds 7168 intervals, 
+# which covers about 1/5 of a track revolution (3-4 sectors).
+# The host converts the intervals into disk bytes the same way as the board does, but with several decode variants 
+# on the same capture:
+#
+#   threshold:     round value added to each interval before it is divided by the bit cell length
+#                  (FLUX_THRESHOLDS, same meaning as the round values used for board reads)
+#   clock window:  0: bit cell length is fixed (4us)
+#                  n: bit cell length is recovered from the intervals: average cell length of the n surrounding intervals
+#                     (FLUX_CLOCK_WINDOWS); compensates speed variations of the drive and stretched disks
+#
+# The variants are computed with NumPy on whole arrays; the bytes of each variant are decoded by track_decode_dos33().
+#
+# ------------------------------------------------------------------------------------------------------------- 
+FLUX_TICKS_PER_CELL = 64
+READ_MODE_BOARD     = 0 # track read as disk bytes (read_track_from_drive())
+READ_MODE_FLUX      = 1 # track read as flux intervals (read_flux_from_drive())
+READ_MODE_SECTOR    = 2 # missing sectors read one by one (read_sector_from_drive())
+
+def flux_cells( intervals, threshold, clock_window):
+    """ returns number of bit cells (1..3) of each flux interval for one decode variant """
+    ticks = intervals.astype( np.float64)
+    if( clock_window > 0) and (len( ticks) > clock_window):
+        # recover bit cell clock: intervals and their nominal number of cells averaged over clock_window intervals
+        nominal = np.clip( np.floor( (ticks + FLUX_TICKS_PER_CELL // 2) / FLUX_TICKS_PER_CELL), 1, 3)
+        kernel = np.ones( clock_window)
+        clock = np.convolve( ticks, kernel, "same") / np.convolve( nominal, kernel, "same")
+        ticks = ticks * (FLUX_TICKS_PER_CELL / clock)
+    cells = np.floor( (ticks + threshold) / FLUX_TICKS_PER_CELL)
+    if( cells == 0).any():
+        # too short interval (noise): merge it with the following interval
+        end_times = np.cumsum( ticks)[cells > 0]
+        ticks = np.diff( end_times, prepend=0.0)
+        cells = np.floor( (ticks + threshold) / FLUX_TICKS_PER_CELL)
+    return np.clip( cells, 1, 3).astype( np.int64)
+    
+def flux_to_disk_bytes( cells):
+    """ returns disk bytes assembled from bit cells like the Disk II controller: a byte is complete when its MSB is set """
+    if len( cells) == 0:
+        return b''
+    # each interval ends with a "1" (flux transition), preceded by cells-1 "0"
+    ones = np.cumsum( cells) - 1
+    total = int( ones[-1]) + 1
+    bits = np.zeros( total + 8, dtype=np.uint8)
+    bits[ones] = 1
+    # next_one[i]: position of the first "1" at or after bit i; leading zeros of a byte are skipped
+    next_one = np.append( ones, total + 8)[np.searchsorted( ones, np.arange( total + 9))].tolist()
+    starts = []
+    start = next_one[0]
+    while start + 8 <= total:
+        starts.append( start)
+        start = next_one[start + 8]
+    if len( starts) == 0:
+        return b''
+    return np.packbits( bits[np.array( starts)[:, None] + np.arange( 8)], axis=1).tobytes()
+    
+def flux_decode( flux, track_image, errors=None):
+    """ decodes flux intervals <flux> with all decode variants into <track_image>; returns list of (threshold, clock window, new physical sectors) """
+    # first value is the time from start of capture to the first transition
+    intervals = np.frombuffer( flux, dtype=np.uint8)[1:]
+    results = []
+    for clock_window in FLUX_CLOCK_WINDOWS:
+        for threshold in FLUX_THRESHOLDS:
+            disk_bytes = flux_to_disk_bytes( flux_cells( intervals, threshold, clock_window))
+            # count decoder errors of the variant corresponding to a standard board read only
+            nominal = (clock_window == 0) and (threshold == FLUX_THRESHOLDS[len( FLUX_THRESHOLDS) // 2])
+            read_track_no, new_sectors = track_decode_dos33( disk_bytes, track_image, errors=errors if nominal else None)
+            results.append( (threshold, clock_window, new_sectors))
+            if track_image.is_complete():
+                return results
+    return results
+    
+
 #--------------------------------------------------------------------------------------------------------------
 #
 # decode DIR_TRACK containing VTOC and list DOS3.3 directory (if table of contents is located in track 17)
@@ -498,6 +1245,69 @@ def analyze_dir_track( sector_list, disk_dec, print_full_directory):
     return disk_no_tracks, disk_no_sectors, disk_os_version    
 	
 
+#--------------------------------------------------------------------------------------------------------------
+#
+# read VTOC free sector bitmaps
+#
+# input:
+#         vtoc:           256 bytes of VTOC sector (track 17, sector 0)
+#         disk_no_tracks: number of tracks in this disk
+# returns:
+#         free_tracks:    list of tracks without any allocated sector
+#         None if the bitmaps are implausible (DIR_TRACK marked as free)
+#
+# The bitmap of track n is stored in bytes 0x38+4*n (sectors 15..8) and 0x39+4*n (sectors 7..0). A set bit marks a free sector.
+# ------------------------------------------------------------------------------------------------------------- 
+def read_vtoc_free_tracks( vtoc, disk_no_tracks):
+    free_tracks = []
+    track_no = 0
+    while track_no < min( disk_no_tracks, MAX_TRACKS):
+        if( vtoc[0x38 + 4*track_no] == 0xff) and (vtoc[0x39 + 4*track_no] == 0xff):
+            free_tracks.append( track_no)
+        track_no += 1
+    if DIR_TRACK in free_tracks:
+        return None
+    return free_tracks
+    
+
+def decode_catalog_sector( sector, directory):
+    """ decode DOS 3.3 disk catalog sector """
+
+    file_type_table={0x00:"  T", 0x80:" *T", 0x01:"  I", 0x81:" *I", 0x02:"  A", 0x82:" *A", 0x04:"  B", 0x84:" *B", \
+                     0x08:"  S", 0x88:" *S", 0x10:"  R", 0x90:" *R", 0x20:" AT", 0xA0:"*AT", 0x40:" BT", 0xC0:"*BT"}   
+
+    # check some default pattern in catalog sector; all following bytes should be zero
+    zero_byte_offsets = [0,3,4,5,6,7,8,9,10]
+    for i in zero_byte_offsets:
+        if sector[i] != 0:
+            debug("decode_catalog_sector: catalog sector badly formatted")
+            return False
+    
+    # following list contains byte offsets of 7 file entries in catalog sector        
+    file_entry_offsets = [11,46,81,116,151,186,221]
+    for i in file_entry_offsets:
+        #check if entry is final one or contains deleted entry. If so, skip entry
+        if (sector[i] == 0) or (sector[i] == 0xFF):
+            continue
+        # check if entry points to invalid track/sector list. If so, skip entry
+        if( sector[i] >= MAX_TRACKS) or (sector[i+1] >= MAX_SECTORS):
+            continue
+        # extract file type
+        if sector[i+2] in file_type_table:
+            file_type=file_type_table[sector[i+2]]   
+        else:
+            file_type="UDF"     
+        file_name=sector[i+3:i+33]
+        file_length=sector[i+33] | (sector[i+34] << 8)
+        # file name needs to be converted in ASCII    
+        file_name = bytearray( i&0x7f for i in file_name)   
+        try:    
+            directory.append([file_name.decode("ascii"), str( file_type), file_length, sector[i], sector[i+1]])
+        except UnicodeDecodeError:
+            directory.append(["FILE NAME COULD NOT BE DECODED", str( file_type), file_length, sector[i], sector[i+1]])   
+    return True
+    
+
 #--------------------------------------------------------------------------------------------------------------
 #
 # read catalog info and returns result in list
@@ -516,44 +1326,6 @@ def analyze_dir_track( sector_list, disk_dec, print_full_directory):
 # ------------------------------------------------------------------------------------------------------------- 
 def read_catalog( disk_dec):
 	
-    def decode_catalog_sector( sector, directory):
-        """ decode DOS 3.3 disk catalog sector """
-    
-        file_type_table={0x00:"  T", 0x80:" *T", 0x01:"  I", 0x81:" *I", 0x02:"  A", 0x82:" *A", 0x04:"  B", 0x84:" *B", \
-                         0x08:"  S", 0x88:" *S", 0x10:"  R", 0x90:" *R", 0x20:" AT", 0xA0:"*AT", 0x40:" BT", 0xC0:"*BT"}   
-    
-        # check some default pattern in catalog sector; all following bytes should be zero
-        zero_byte_offsets = [0,3,4,5,6,7,8,9,10]
-        for i in zero_byte_offsets:
-            if sector[i] != 0:
-                debug("decode_catalog_sector: catalog sector badly formatted")
-                return False
-        
-        # following list contains byte offsets of 7 file entries in catalog sector        
-        file_entry_offsets = [11,46,81,116,151,186,221]
-        for i in file_entry_offsets:
-            #check if entry is final one or contains deleted entry. If so, skip entry
-            if (sector[i] == 0) or (sector[i] == 0xFF):
-                continue
-            # check if entry points to invalid track/sector list. If so, skip entry
-            if( sector[i] >= MAX_TRACKS) or (sector[i+1] >= MAX_SECTORS):
-                continue
-            # extract file type
-            if sector[i+2] in file_type_table:
-                file_type=file_type_table[sector[i+2]]   
-            else:
-                file_type="UDF"     
-            file_name=sector[i+3:i+33]
-            file_length=sector[i+33]  
-            # file name needs to be converted in ASCII    
-            file_name = bytearray( i&0x7f for i in file_name)   
-            try:    
-                directory.append([file_name.decode("ascii"), str( file_type), file_length, sector[i], sector[i+1]])
-            except UnicodeDecodeError:
-                directory.append(["FILE NAME COULD NOT BE DECODED", str( file_type), file_length, sector[i], sector[i+1]])   
-        return True       
-   
-    # implementation starts here
     directory = []
     offset = disk_dec[2] * SECTOR_SIZE # VTOC offset to first catalog sector (usually last sector on track 17)
 	
@@ -562,7 +1334,7 @@ def read_catalog( disk_dec):
         sector = disk_dec[offset:offset + SECTOR_SIZE]
         if( len( sector) == SECTOR_SIZE):
             if (sector[1] > MAX_TRACKS-1 or sector[2] > MAX_SECTORS-1):
-                print("Invalid catalog information. Track:", catalog_track, " Sector:", catalog_sector,".", sep='')
+                print("Invalid catalog information. Track:", sector[1], " Sector:", sector[2],".", sep='')
                 finished = True    
             elif ( sector[1] == 0) and (sector[2] == 0):
                 # last catalog sector found
@@ -585,65 +1357,994 @@ def read_catalog( disk_dec):
 # Using the table of contents, function assembles the track/sector lists for each file and stores them in a list.
 #
 # input:
-#             disk_dec  :  byte array containing entire disk
+#             disk      :  DiskImage containing entire disk
 #             directory :  list containing disk table of contents
 #     
 # returns:
 #      total_sector_list:  list of track/sector lists for each file in the directory
 #                
 # ------------------------------------------------------------------------------------------------------------- 	
-def read_sector_list( disk_dec, directory):
+def read_sector_list( disk, directory):
 
+    def get_sector( track_no, sector_no):
+        if not disk.is_valid( track_no, sector_no):
+            return b''
+        return disk.sector( track_no, sector_no)
+        
     total_sector_list = []
     for i in directory:
-        sector_list   = []
-        file_length   = i[2] 
-        track_offset  = i[3]
-        sector_offset = i[4]
-        
-        if(( track_offset > MAX_TRACKS-1) or (sector_offset > MAX_SECTORS-1) or (file_length == 0)): # check if entries are valid
-            finished=True
-        else:
-            sector_list.append([track_offset, sector_offset]) # initialize sector list with first entry
-            finished=False
-            file_length-=1  # remove first T/S list entry
-            if( file_length == 0): # rare case in DOS3.3 
-                finished=True
-            
-        while not finished:
-            offset = (TRACK_SIZE * track_offset) + (SECTOR_SIZE * sector_offset)
-            _list  = disk_dec[offset:offset + SECTOR_SIZE]
-            if( len(_list) == SECTOR_SIZE):
-                 if(( _list[0] | _list[3] | _list[4]) == 0): # check if a few default entries are zero
-                    # a list sector contains 122 T/S pair entries max.
-                    gen_list = (x for x in range (0, min( 244, file_length*2), 2))
-                    for x in gen_list:
-                        sector_list.append([_list[12+x], _list[12+x+1]]) # 12 is offset for first pair of track/sector entries
-                    file_length -= 123 # reduce length by max value for T/S sector
-                    if file_length <= 2: # extended list requires at least one more T/S sector + data sector
-                        finished = True
-                    else:
-                        track_offset  = _list[1]
-                        sector_offset = _list[2]
-                        file_length-=1 # reduce by second T/S entry               
-                        if( track_offset == 0): # last sector list sector belonging to this file?
-                            sector_list.append(["INVALID CONT.", "INVALID CONT."])  
-                            finished=True                  
-                        else:
-                            sector_list.append([track_offset, sector_offset]) # update sector list with second T/S list
-                 else:
-                    sector_list.append(["INVALID", "INVALID"])  
-                    # list seems corrupted
-                    finished=True 
-            else:
-                sector_list.append(["INVALID", "INVALID"])  
-                finished=True
-           # print(sector_list)
+        sector_list = []
+        for kind, track_no, sector_no in read_file_sector_list( get_sector, i):
+            sector_list.append([track_no, sector_no])
         total_sector_list.append( sector_list)
   
     return total_sector_list
   
+  
+#--------------------------------------------------------------------------------------------------------------
+#
+# read track/sector list of one file
+#
+# input:
+#             get_sector :  function returning the 256 bytes of a logical sector (track_no, sector_no); 
+#                           an empty or short result marks a sector which is not available
+#             file_entry :  directory entry of the file (see read_catalog())
+#     
+# returns:
+#      sector_list:  list of entries (kind, track, sector) in the order of the track/sector list:
+#                    kind "list": track/sector list sector, "data": data sector 
+#                    kind "INVALID" or "INVALID CONT.": list is corrupt (track and sector set to kind as well)
+#                
+# ------------------------------------------------------------------------------------------------------------- 	
+def read_file_sector_list( get_sector, file_entry):
+
+    sector_list   = []
+    file_length   = file_entry[2] 
+    track_offset  = file_entry[3]
+    sector_offset = file_entry[4]
+    
+    if(( track_offset > MAX_TRACKS-1) or (sector_offset > MAX_SECTORS-1) or (file_length == 0)): # check if entries are valid
+        finished=True
+    else:
+        sector_list.append(("list", track_offset, sector_offset)) # initialize sector list with first entry
+        finished=False
+        file_length-=1  # remove first T/S list entry
+        if( file_length == 0): # rare case in DOS3.3 
+            finished=True
+        
+    while not finished:
+        _list = get_sector( track_offset, sector_offset)
+        if( len(_list) == SECTOR_SIZE):
+             if(( _list[0] | _list[3] | _list[4]) == 0): # check if a few default entries are zero
+                # a list sector contains 122 T/S pair entries max.
+                gen_list = (x for x in range (0, min( 244, file_length*2), 2))
+                for x in gen_list:
+                    sector_list.append(("data", _list[12+x], _list[12+x+1])) # 12 is offset for first pair of track/sector entries
+                file_length -= 122 # reduce length by max value for T/S sector
+                if file_length < 2: # extended list requires at least one more T/S sector + data sector
+                    finished = True
+                else:
+                    track_offset  = _list[1]
+                    sector_offset = _list[2]
+                    file_length-=1 # reduce by second T/S entry               
+                    if( track_offset == 0): # last sector list sector belonging to this file?
+                        sector_list.append(("INVALID CONT.", "INVALID CONT.", "INVALID CONT."))  
+                        finished=True                  
+                    else:
+                        sector_list.append(("list", track_offset, sector_offset)) # update sector list with second T/S list
+             else:
+                sector_list.append(("INVALID", "INVALID", "INVALID"))  
+                # list seems corrupted
+                finished=True 
+        else:
+            sector_list.append(("INVALID", "INVALID", "INVALID"))  
+            finished=True
+    return sector_list
+       
        
+#--------------------------------------------------------------------------------------------------------------
+#
+# Lazy file access to DOS 3.3 images
+#
+# DosImage opens a .bin image as memory mapped file; nothing is read before it is needed. The catalog is read on first
+# use, files are opened as read only, seekable file objects (DosFile) returning the content of their data sectors
+# (as stored on disk, like the files written by 'f'; sectors not allocated in sparse files read as zeros).
+# The track/sector list of a file is followed only as far as the file is read. Sectors are read through a small LRU 
+# cache (SECTOR_CACHE_SIZE sectors per image). 
+# A corrupt track/sector list or a data sector outside of the image raises OSError when the file is read there.
+# Example:
+#     with DosImage( "disks/disk1.bin") as image:
+#         for file_entry in image.find( "*.OBJ"):
+#             header = image.open( file_entry).read( 4)
+#
+# ------------------------------------------------------------------------------------------------------------- 
+class DosImage:
+    def __init__( self, file_name):
+        self.file_name = file_name
+        with open( file_name, "rb") as image_file:
+            self.data = mmap.mmap( image_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.no_tracks = len( self.data) // TRACK_SIZE
+        self.directory = None  # catalog, read on first use
+        self.sector    = functools.lru_cache( maxsize=SECTOR_CACHE_SIZE)( self.read_sector)
+        
+    def __enter__( self):
+        return self
+        
+    def __exit__( self, *args):
+        self.close()
+        
+    def close( self):
+        self.sector.cache_clear()
+        self.data.close()
+        
+    def read_sector( self, track_no, sector_no):
+        """ returns the 256 bytes of logical sector <sector_no> of track <track_no>; empty if outside of the image """
+        if not( 0 <= track_no < self.no_tracks and 0 <= sector_no < MAX_SECTORS):
+            return b''
+        offset = track_no * TRACK_SIZE + sector_no * SECTOR_SIZE
+        return self.data[offset:offset + SECTOR_SIZE]
+        
+    def catalog( self):
+        """ returns list of directory entries (see read_catalog()) """
+        if self.directory is None:
+            self.directory = []
+            vtoc = self.sector( DIR_TRACK, 0)
+            location = (vtoc[1], vtoc[2]) if len( vtoc) == SECTOR_SIZE else (0, 0)
+            visited = set()
+            while( location != (0, 0)) and (location not in visited):
+                visited.add( location)
+                sector = self.sector( *location)
+                if( len( sector) != SECTOR_SIZE) or not decode_catalog_sector( sector, self.directory):
+                    break
+                location = (sector[1], sector[2])
+        return self.directory
+        
+    def find( self, pattern):
+        """ returns directory entries of the files matching <pattern>, e.g. HELLO or *.OBJ """
+        return [i for i in self.catalog() if fnmatch.fnmatchcase( i[0].rstrip(), pattern)]
+        
+    def open( self, file_entry):
+        """ returns DosFile of directory entry <file_entry> (or of the file named <file_entry>) """
+        if isinstance( file_entry, str):
+            entries = [i for i in self.catalog() if i[0].rstrip() == file_entry]
+            if len( entries) == 0:
+                raise FileNotFoundError( errno.ENOENT, "file not found in " + self.file_name, file_entry)
+            file_entry = entries[0]
+        return DosFile( self, file_entry)
+        
+        
+class DosFile( io.RawIOBase):
+    def __init__( self, image, file_entry):
+        super().__init__()
+        self.image        = image
+        self.name         = file_entry[0].rstrip()
+        self.position     = 0
+        self.data_sectors = []                              # track/sector pairs of the data sectors resolved so far
+        self.next_list    = (file_entry[3], file_entry[4])  # next track/sector list sector to be read; None at end of list
+        self.remaining    = file_entry[2] - 1               # sectors of the file (length in catalog) not resolved yet
+        self.visited      = set()
+        if file_entry[2] <= 1:
+            self.next_list = None
+            
+    def read_list_sector( self):
+        """ reads the next track/sector list sector (same rules as read_file_sector_list()) """
+        location = self.next_list
+        sector = self.image.sector( *location)
+        if( len( sector) != SECTOR_SIZE) or (location in self.visited) or (( sector[0] | sector[3] | sector[4]) != 0):
+            raise OSError( errno.EIO, "track/sector list sector " + str( location) + " corrupt", self.name)
+        self.visited.add( location)
+        for x in range( 0, min( 244, self.remaining*2), 2):
+            self.data_sectors.append( (sector[12+x], sector[12+x+1]))
+        self.remaining -= 122
+        if( self.remaining < 2) or (sector[1] == 0):
+            self.next_list = None
+        else:
+            self.next_list = (sector[1], sector[2])
+            self.remaining -= 1
+            
+    def resolve( self, index):
+        """ follows the track/sector list until data sector <index> is known; returns False if the file is shorter """
+        while( len( self.data_sectors) <= index) and (self.next_list is not None):
+            self.read_list_sector()
+        return index < len( self.data_sectors)
+        
+    def size( self):
+        """ returns size of the file [bytes]: number of data sectors * 256 """
+        while self.next_list is not None:
+            self.read_list_sector()
+        return len( self.data_sectors) * SECTOR_SIZE
+        
+    def readable( self):
+        return True
+        
+    def seekable( self):
+        return True
+        
+    def tell( self):
+        return self.position
+        
+    def seek( self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size()
+        if offset < 0:
+            raise ValueError( "negative seek position " + str( offset))
+        self.position = offset
+        return self.position
+        
+    def readinto( self, buffer):
+        count = 0
+        while count < len( buffer):
+            index, offset = divmod( self.position, SECTOR_SIZE)
+            if not self.resolve( index):
+                break
+            location = self.data_sectors[index]
+            if location == (0, 0):
+                sector = bytes( SECTOR_SIZE) # sector not allocated (sparse file)
+            else:
+                sector = self.image.sector( *location)
+                if len( sector) != SECTOR_SIZE:
+                    raise OSError( errno.EIO, "data sector " + str( location) + " outside of image", self.name)
+            n = min( len( buffer) - count, SECTOR_SIZE - offset)
+            buffer[count:count + n] = sector[offset:offset + n]
+            count += n
+            self.position += n
+        return count
+        
+        
+#--------------------------------------------------------------------------------------------------------------
+#
+# Disk image exporters
+#
+# Exporters write additional image formats in the same pass as capture ('c') and raw decoding ('r').
+# Each exporter is fed track by track (in ascending order) and writes its file incrementally:
+#
+#   write_track( track_no, track_dec, missing_sector_list, raw_track)
+#
+#         track_dec:            16*256 bytes of decoded sectors in DOS 3.3 logical order
+#         missing_sector_list:  list of logical sectors which could not be decoded (zero filled in track_dec)
+#         raw_track:            disk bytes as captured by the board (None if track has been assembled from several reads)
+#
+# Nibble based formats (.nib, .woz) use one revolution of the raw track if available. Otherwise the track is
+# re-encoded in standard DOS 3.3 format from the decoded sectors. Missing sectors get a data field with invalid checksum.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def find_revolution( raw_track):
+    """ returns disk bytes of one revolution of <raw_track>, starting in the gap in front of an address field """
+    positions = {}
+    s = raw_track.find( b'\xd5\xaa\x96')
+    while( s != -1) and (s + 13 <= len( raw_track)):
+        adr_field_ok, track_no, sector_no = check_address_field( raw_track[s:s+13])
+        if adr_field_ok:
+            positions.setdefault( sector_no, []).append( s)
+        s = raw_track.find( b'\xd5\xaa\x96', s + 13)
+    # distance between two occurrences of the same sector is the length of one revolution
+    periods = sorted( p[1] - p[0] for p in positions.values() if len(p) > 1)
+    if len( periods) == 0:
+        return bytes( raw_track[0:NIB_TRACK_SIZE])
+    period = periods[len( periods) // 2]
+    start = max( 0, min( p[0] for p in positions.values()) - 16)
+    if( start + period > len( raw_track)):
+        start = 0
+    return bytes( raw_track[start:start + period])
+
+def encode_track( track_no, volume_no, track_dec, missing_sector_list):
+    """ returns disk bytes of track <track_no> in standard DOS 3.3 format """
+    track = bytearray( b'\xff' * 48)
+    for physical_sector in range( MAX_SECTORS):
+        logical_sector = LOGICAL_OF_PHYSICAL[physical_sector]
+        data_field = encode_data_field( track_dec[logical_sector*SECTOR_SIZE:(logical_sector+1)*SECTOR_SIZE])
+        if logical_sector in missing_sector_list:
+            # sector could not be decoded: write data field with invalid checksum
+            data_field[-1] = GCR_6_2[(LUT[data_field[-1] & 0x7f] + 1) & 0x3f]
+        track += encode_address_field( volume_no, track_no, physical_sector)
+        track += b'\xff' * 6
+        track += b'\xd5\xaa\xad' + data_field + b'\xde\xaa\xeb'
+        track += b'\xff' * 27
+    return track
+
+
+class ImageExporter:
+    """ base class of image exporters; writes the image file <file_name> track by track (write_track() of the subclasses) """
+    def __init__( self, file_name, volume_no):
+        self.file_name = file_name
+        self.volume_no = volume_no
+        self.file      = open( file_name, "wb")
+        
+    def track_bytes( self, track_no, track_dec, missing_sector_list, raw_track):
+        """ returns disk bytes of one revolution of the track """
+        if raw_track is not None:
+            return find_revolution( raw_track)
+        return encode_track( track_no, self.volume_no, track_dec, missing_sector_list)
+        
+    def close( self):
+        self.file.close()
+        
+        
+class DosOrderExporter( ImageExporter):
+    """ .dsk: sectors in DOS 3.3 logical order (same as .bin) """
+    def write_track( self, track_no, track_dec, missing_sector_list, raw_track=None):
+        self.file.write( track_dec)
+        
+        
+class ProdosOrderExporter( ImageExporter):
+    """ .po: sectors in ProDOS order """
+    def write_track( self, track_no, track_dec, missing_sector_list, raw_track=None):
+        for logical_sector in PRODOS_2_LOGICAL:
+            self.file.write( track_dec[logical_sector*SECTOR_SIZE:(logical_sector+1)*SECTOR_SIZE])
+            
+            
+class NibExporter( ImageExporter):
+    """ .nib: 6656 disk bytes per track """
+    def write_track( self, track_no, track_dec, missing_sector_list, raw_track=None):
+        track = self.track_bytes( track_no, track_dec, missing_sector_list, raw_track)
+        track = track[0:NIB_TRACK_SIZE]
+        self.file.write( track + b'\xff' * (NIB_TRACK_SIZE - len( track)))
+        
+        
+class WozExporter( ImageExporter):
+    """ .woz (version 2): bit stream per track; chunk tables and CRC are completed in close() """
+    # file layout: header (12 bytes), INFO chunk (8+60 bytes), TMAP chunk (8+160 bytes), TRKS chunk header (8 bytes), 
+    # 160 TRK entries (8 bytes each); track bit streams start at block 3 (offset 1536) and are aligned to 512 byte blocks
+    INFO_OFFSET = 12
+    TMAP_OFFSET = 80
+    TRKS_OFFSET = 248
+    DATA_OFFSET = 1536
+    BLOCK_SIZE  = 512
+    
+    def __init__( self, file_name, volume_no):
+        ImageExporter.__init__( self, file_name, volume_no)
+        self.tracks = [] # (track number, start block, block count, bit count)
+        self.file.write( bytes( self.DATA_OFFSET))
+        
+    def write_track( self, track_no, track_dec, missing_sector_list, raw_track=None):
+        track = self.track_bytes( track_no, track_dec, missing_sector_list, raw_track)
+        # sync bytes (runs of 0xff) are stored as 10 bit self-sync patterns, all other disk bytes with 8 bits
+        bits = 0
+        bit_count = 0
+        i = 0
+        while i < len( track):
+            if( track[i] == 0xff) and ((i > 0 and track[i-1] == 0xff) or (i+1 < len( track) and track[i+1] == 0xff)):
+                bits = (bits << 10) | 0x3fc
+                bit_count += 10
+            else:
+                bits = (bits << 8) | track[i]
+                bit_count += 8
+            i+=1
+        block_count = (bit_count + self.BLOCK_SIZE*8 - 1) // (self.BLOCK_SIZE*8)
+        data = (bits << (block_count*self.BLOCK_SIZE*8 - bit_count)).to_bytes( block_count*self.BLOCK_SIZE, "big")
+        start_block = self.file.tell() // self.BLOCK_SIZE
+        self.file.write( data)
+        self.tracks.append( (track_no, start_block, block_count, bit_count))
+        
+    def close( self):
+        size = self.file.tell()
+        creator = ("treckr " + VERSION).encode("utf-8")[0:32].ljust( 32, b' ')
+        largest_track = max( [t[2] for t in self.tracks] + [0])
+        info = struct.pack( "<BBBBB32sBBBHHH", 2, 1, 1, 0, 1, creator, 1, 1, 32, 0, 0, largest_track)
+        tmap = bytearray( b'\xff' * 160)
+        trks = bytearray( 1280)
+        for index, (track_no, start_block, block_count, bit_count) in enumerate( self.tracks):
+            # quarter tracks next to a track are mapped to the track as well
+            for quarter_track in [4*track_no - 1, 4*track_no, 4*track_no + 1]:
+                if 0 <= quarter_track < 160:
+                    tmap[quarter_track] = index
+            struct.pack_into( "<HHI", trks, 8*index, start_block, block_count, bit_count)
+        self.file.seek( 0)
+        self.file.write( b'WOZ2\xff\n\r\n' + bytes(4))
+        self.file.write( b'INFO' + struct.pack( "<I", 60) + info.ljust( 60, b'\x00'))
+        self.file.write( b'TMAP' + struct.pack( "<I", 160) + tmap)
+        self.file.write( b'TRKS' + struct.pack( "<I", size - self.TRKS_OFFSET - 8) + trks)
+        self.file.close()
+        # CRC32 of everything following the header
+        crc = 0
+        with open( self.file_name, "r+b") as woz_file:
+            woz_file.seek( 12)
+            for block in iter( lambda: woz_file.read( 65536), b''):
+                crc = zlib.crc32( block, crc)
+            woz_file.seek( 8)
+            woz_file.write( struct.pack( "<I", crc & 0xffffffff))
+            
+            
+EXPORTERS = {"dsk": DosOrderExporter,
+             "po":  ProdosOrderExporter,
+             "nib": NibExporter,
+             "woz": WozExporter}
+
+def ask_export_formats():
+    """ asks for additional image formats; returns list of format names """
+    user_input = input( "Additional image formats (" + " ".join( EXPORTERS) + "), return for [" + " ".join( EXPORT_FORMATS) + "]: ")
+    if user_input.strip() == "":
+        return list( EXPORT_FORMATS)
+    formats = []
+    for name in user_input.replace(",", " ").split():
+        if name.lower().lstrip(".") in EXPORTERS:
+            formats.append( name.lower().lstrip("."))
+        else:
+            print("Unknown image format", name, "ignored.")
+    return formats
+    
+def export_file_names( base_name, formats):
+    """ returns file names of images to be written for <formats> """
+    return [base_name + "." + name for name in formats]
+    
+def open_exporters( base_name, formats, volume_no):
+    """ returns list of exporters writing <base_name>.<format> """
+    return [EXPORTERS[name]( base_name + "." + name, volume_no) for name in formats]
+    
+def close_exporters( exporters):
+    for exporter in exporters:
+        exporter.close()
+        print("Image written to:", exporter.file_name)
+    return
+    
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Capture statistics
+#
+# Every read attempt of a capture ('c') is recorded as one row of the following columns:
+#
+#   track:          track number
+#   attempt:        number of the read attempt on this track (1..)
+#   mode:           READ_MODE_BOARD: disk bytes decoded by the board; READ_MODE_FLUX: flux intervals decoded by the host 
+#                   READ_MODE_SECTOR: missing sectors read one by one, starting at their address fields
+#   round_value:    round value used by the board for this read (flux reads: first threshold which decoded new sectors, or 0)
+#   new_sectors:    number of sectors decoded for the first time by this read
+#   new_mask:       bit mask of these logical sectors
+#   decoded:        number of decoded sectors of the track after this read
+#   header_errors:  number of damaged address fields
+#   data_errors:    number of corrupt data fields of sectors not decoded yet
+#   wrong_track:    number of address fields of another track (head position error)
+#   motor_reset:    1 if the track motor has been repositioned after this read
+#   time:           time of read [s] after start of capture
+#
+# The columns are written as NumPy .npz archive (DISK_DIR_NAME/<name>.stats.npz) together with "meta", a JSON
+# description of the capture (drive port, disk identity, start time, version). NumPy is only needed to speed up queries;
+# archives are written and read with the standard library.
+#
+# Query API: load_capture_stats() loads one archive, collect_capture_stats() concatenates the archives of many 
+# captures into one table (column "capture" refers to the list of meta data), round_value_statistics() and
+# track_trends() aggregate the table per drive and round value resp. per disk and track.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+STATS_COLUMNS = [("track", "B"), ("attempt", "H"), ("mode", "B"), ("round_value", "B"), ("new_sectors", "B"), ("new_mask", "H"), 
+                 ("decoded", "B"), ("header_errors", "H"), ("data_errors", "H"), ("wrong_track", "H"), 
+                 ("motor_reset", "B"), ("time", "f")]
+NPY_TYPES = {"B": "|u1", "H": "<u2", "I": "<u4", "f": "<f4", "d": "<f8"} # array typecode -> .npy type description
+
+class CaptureStats:
+    def __init__( self, drive):
+        self.start   = time.time()
+        self.meta    = {"drive": drive, "disk": None, "start": self.start, "version": VERSION}
+        self.columns = {name: array.array( code) for name, code in STATS_COLUMNS}
+        
+    def add_read( self, track_no, attempt, mode, round_value, new_sectors, decoded, errors, motor_reset):
+        """ records one read attempt; <new_sectors> is the list of logical sectors decoded by this read """
+        columns = self.columns
+        columns["track"].append( track_no)
+        columns["attempt"].append( attempt)
+        columns["mode"].append( mode)
+        columns["round_value"].append( round_value)
+        columns["new_sectors"].append( len( new_sectors))
+        columns["new_mask"].append( sum( 1 << j for j in new_sectors))
+        columns["decoded"].append( decoded)
+        columns["header_errors"].append( min( errors["header_errors"], 0xffff))
+        columns["data_errors"].append( min( errors["data_errors"], 0xffff))
+        columns["wrong_track"].append( min( errors["wrong_track"], 0xffff))
+        columns["motor_reset"].append( 1 if motor_reset else 0)
+        columns["time"].append( time.time() - self.start)
+        
+    def write( self, file_name):
+        """ writes columns and meta data to .npz archive <file_name> """
+        arrays = dict( self.columns)
+        arrays["meta"] = array.array( "B", json.dumps( self.meta).encode( "utf-8"))
+        write_npz( file_name, arrays)
+        
+        
+def write_npz( file_name, arrays):
+    """ writes dictionary <arrays> (name -> array.array) as compressed .npz archive """
+    with zipfile.ZipFile( file_name, "w", zipfile.ZIP_DEFLATED) as npz_file:
+        for name in arrays:
+            data = arrays[name]
+            if sys.byteorder == "big":
+                data = array.array( data.typecode, data)
+                data.byteswap()
+            header = "{'descr': '" + NPY_TYPES[data.typecode] + "', 'fortran_order': False, 'shape': (" + str( len( data)) + ",), }"
+            # header is padded with spaces, so the data starts at a multiple of 64 bytes
+            header += " " * (63 - (len( header) + 10) % 64) + "\n"
+            npz_file.writestr( name + ".npy", b'\x93NUMPY\x01\x00' + struct.pack( "<H", len( header)) + header.encode( "latin1") + data.tobytes())
+            
+def read_npz( file_name):
+    """ returns dictionary (name -> array) of the 1-dimensional arrays in .npz archive <file_name> """
+    arrays = {}
+    if np is not None:
+        with np.load( file_name) as npz_file:
+            for name in npz_file.files:
+                arrays[name] = npz_file[name]
+        return arrays
+    typecodes = {NPY_TYPES[code]: code for code in NPY_TYPES}
+    with zipfile.ZipFile( file_name) as npz_file:
+        for member in npz_file.namelist():
+            content = npz_file.read( member)
+            if content[6] == 1:
+                header_size = struct.unpack( "<H", content[8:10])[0] 
+                offset = 10
+            else:
+                header_size = struct.unpack( "<I", content[8:12])[0] 
+                offset = 12
+            header = ast.literal_eval( content[offset:offset + header_size].decode( "latin1"))
+            data = array.array( typecodes[header["descr"]], content[offset + header_size:])
+            if sys.byteorder == "big":
+                data.byteswap()
+            arrays[member[:-len(".npy")]] = data
+    return arrays
+    
+def load_capture_stats( file_name):
+    """ returns meta data (dictionary) and columns (name -> array) of capture statistics <file_name> """
+    arrays = read_npz( file_name)
+    meta = json.loads( bytes( arrays.pop( "meta")).decode( "utf-8"))
+    meta["file"] = file_name
+    return meta, arrays
+    
+def collect_capture_stats( file_names):
+    """ returns list of meta data and table (name -> array) of all read attempts of the captures <file_names> """
+    metas = []
+    parts = {name: [] for name, code in STATS_COLUMNS}
+    parts["capture"] = []
+    for file_name in file_names:
+        try:
+            meta, columns = load_capture_stats( file_name)
+        except Exception as e:
+            print("Error when trying to read", file_name, ":", str( e))
+            continue
+        size = len( columns["track"])
+        for name, code in STATS_COLUMNS:
+            # columns added in later versions are zero in older archives
+            parts[name].append( columns[name] if name in columns else array.array( code, [0]) * size)
+        parts["capture"].append( array.array( "I", [len( metas)]) * size)
+        metas.append( meta)
+    table = {}
+    for name in parts:
+        if np is not None:
+            table[name] = np.concatenate( [np.asarray( part) for part in parts[name]]) if len( parts[name]) > 0 else np.zeros( 0)
+        else:
+            table[name] = array.array( "d")
+            for part in parts[name]:
+                table[name].extend( float( x) for x in part)
+    return metas, table
+    
+def _group_sum( keys, values, size):
+    """ returns list of sums of <values> per key (0..size-1) """
+    if np is not None:
+        return np.bincount( np.asarray( keys, dtype=np.int64), weights=np.asarray( values, dtype=np.float64), minlength=size).tolist()
+    sums = [0] * size
+    for key, value in zip( keys, values):
+        sums[int( key)] += value
+    return sums
+    
+def _group_max( keys, values, size):
+    """ returns list of maxima of <values> per key (0..size-1); -1 for keys without values """
+    if np is not None:
+        maxima = np.full( size, -1.0)
+        np.maximum.at( maxima, np.asarray( keys, dtype=np.int64), np.asarray( values, dtype=np.float64))
+        return maxima.tolist()
+    maxima = [-1] * size
+    for key, value in zip( keys, values):
+        maxima[int( key)] = max( maxima[int( key)], value)
+    return maxima
+    
+def round_value_statistics( metas, table):
+    """ returns dictionary drive -> {round value -> [reads, successful reads, recovered sectors]} of board reads """
+    drives = sorted( set( str( meta["drive"]) for meta in metas))
+    drive_of_capture = [drives.index( str( meta["drive"])) for meta in metas]
+    # only reads decoded by the board (round values of flux reads are decode variants on the host)
+    if np is not None:
+        keys = np.asarray( drive_of_capture, dtype=np.int64)[table["capture"].astype( np.int64)] * 256 + table["round_value"]
+        board = table["mode"] == READ_MODE_BOARD
+        successful = board & (table["new_sectors"] > 0)
+        recovered = np.where( board, table["new_sectors"], 0)
+    else:
+        keys = [drive_of_capture[int( c)] * 256 + int( r) for c, r in zip( table["capture"], table["round_value"])]
+        board = [1 if m == READ_MODE_BOARD else 0 for m in table["mode"]]
+        successful = [b if n > 0 else 0 for b, n in zip( board, table["new_sectors"])]
+        recovered = [b * n for b, n in zip( board, table["new_sectors"])]
+    size = len( drives) * 256
+    reads = _group_sum( keys, board, size)
+    hits = _group_sum( keys, successful, size)
+    sectors = _group_sum( keys, recovered, size)
+    result = {}
+    for key in range( size):
+        if reads[key] > 0:
+            result.setdefault( drives[key // 256], {})[key % 256] = [int( reads[key]), int( hits[key]), int( sectors[key])]
+    return result
+    
+def track_trends( metas, table):
+    """ returns dictionary (disk, track) -> list of (capture start time, reads, missing sectors) ordered by time """
+    if np is not None:
+        keys = table["capture"].astype( np.int64) * MAX_TRACKS + table["track"]
+    else:
+        keys = [int( c) * MAX_TRACKS + int( t) for c, t in zip( table["capture"], table["track"])]
+    size = len( metas) * MAX_TRACKS
+    reads = _group_sum( keys, [1] * len( keys), size)
+    decoded = _group_max( keys, table["decoded"], size)
+    trends = {}
+    for key in range( size):
+        meta = metas[key // MAX_TRACKS]
+        if( reads[key] > 0) and (meta["disk"] is not None):
+            trends.setdefault( (meta["disk"], key % MAX_TRACKS), []).append( (meta["start"], int( reads[key]), MAX_SECTORS - int( decoded[key])))
+    for key in trends:
+        trends[key].sort()
+    return trends
+    
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Integrity manifests
+#
+# Capture ('c', 'a') and raw decoding ('r') write a manifest <image file>.manifest (JSON) next to each .bin/.raw file:
+#
+#   version:      treckr version which wrote the image
+#   image:        file name of the image (same directory as the manifest)
+#   size:         size of the image [bytes]
+#   track_size:   size of one track in the image [bytes]
+#   sector_size:  size of one sector [bytes]; 0 for .raw images (no sector structure)
+#   tracks:       per track: "hash" of the track, "sectors": hashes of the sectors (if sector_size > 0) and 
+#                 "status": bit mask of logical sectors decoded correctly (bit n = sector n; not present for .raw images)
+#
+# Hashes are BLAKE2b (128 bit) in hex. verify_image() checks an image against its manifest in a single pass over the
+# memory mapped image; compare_manifests() finds the tracks and sectors which differ between two captures from the 
+# manifests only.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def image_hash( data):
+    """ returns hash of <data> as used in manifests """
+    return hashlib.blake2b( data, digest_size=16).hexdigest()
+    
+class ImageManifest:
+    """ collects the hashes of image <image_name> while it is written track by track """
+    def __init__( self, image_name, sector_size=SECTOR_SIZE):
+        self.image_name = image_name
+        self.manifest   = {"version": VERSION, "image": os.path.basename( image_name), "size": 0, "track_size": 0, 
+                           "sector_size": sector_size, "tracks": []}
+                           
+    def add_track( self, track_data, status=None):
+        """ adds next track of the image; <status> is the bit mask of logical sectors decoded correctly """
+        manifest = self.manifest
+        entry = {"hash": image_hash( track_data)}
+        sector_size = manifest["sector_size"]
+        if sector_size > 0:
+            entry["sectors"] = [image_hash( track_data[i:i + sector_size]) for i in range( 0, len( track_data), sector_size)]
+        if status is not None:
+            entry["status"] = status
+        manifest["tracks"].append( entry)
+        manifest["track_size"] = max( manifest["track_size"], len( track_data))
+        manifest["size"] += len( track_data)
+        
+    def close( self):
+        """ writes the manifest file """
+        with open( self.image_name + MANIFEST_SUFFIX, "w") as manifest_file:
+            json.dump( self.manifest, manifest_file, indent=1)
+            
+            
+def sector_status( missing_sector_list):
+    """ returns bit mask of logical sectors not in <missing_sector_list> """
+    return sum( 1 << j for j in range( MAX_SECTORS) if j not in missing_sector_list)
+    
+def read_manifest( manifest_name):
+    with open( manifest_name, "r") as manifest_file:
+        return json.load( manifest_file)
+        
+def verify_image( manifest_name):
+    """ checks image of manifest <manifest_name>; returns (image name, differing tracks, differing [track, sector], error) """
+    try:
+        manifest = read_manifest( manifest_name)
+        image_name = os.path.join( os.path.dirname( manifest_name), manifest["image"])
+        size = os.path.getsize( image_name)
+    except Exception as e:
+        return manifest_name, [], [], str( e)
+    if size != manifest["size"]:
+        return image_name, [], [], "size is " + str( size) + " bytes instead of " + str( manifest["size"])
+    if size == 0:
+        return image_name, [], [], None
+    bad_tracks = []
+    bad_sectors = []
+    track_size = manifest["track_size"]
+    sector_size = manifest["sector_size"]
+    with open( image_name, "rb") as image_file, \
+         mmap.mmap( image_file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+         memoryview( data) as view:
+        for track_no, track in enumerate( manifest["tracks"]):
+            track_data = view[track_no * track_size:(track_no + 1) * track_size]
+            if image_hash( track_data) != track["hash"]:
+                bad_tracks.append( track_no)
+                # locate the differing sectors
+                for sector_no, sector_hash in enumerate( track.get( "sectors", [])):
+                    if image_hash( track_data[sector_no * sector_size:(sector_no + 1) * sector_size]) != sector_hash:
+                        bad_sectors.append( [track_no, sector_no])
+            track_data.release()
+    return image_name, bad_tracks, bad_sectors, None
+    
+def verify_images( manifest_names):
+    """ verifies the images of <manifest_names> in parallel; returns list of results of verify_image() """
+    if len( manifest_names) < 2:
+        return [verify_image( name) for name in manifest_names]
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        return list( executor.map( verify_image, manifest_names, chunksize=max( 1, len( manifest_names) // (4 * (os.cpu_count() or 1)))))
+        
+def compare_manifests( manifest_a, manifest_b):
+    """ returns list of [track, differing sectors, sectors decoded only in a, sectors decoded only in b] of two captures """
+    differences = []
+    for track_no in range( max( len( manifest_a["tracks"]), len( manifest_b["tracks"]))):
+        if track_no >= len( manifest_a["tracks"]) or track_no >= len( manifest_b["tracks"]):
+            differences.append( [track_no, [], [], []])
+            continue
+        track_a = manifest_a["tracks"][track_no]
+        track_b = manifest_b["tracks"][track_no]
+        if track_a["hash"] == track_b["hash"]:
+            continue
+        sectors = [j for j, (a, b) in enumerate( zip( track_a.get( "sectors", []), track_b.get( "sectors", []))) if a != b]
+        status_a = track_a.get( "status", 0xffff)
+        status_b = track_b.get( "status", 0xffff)
+        only_a = [j for j in range( MAX_SECTORS) if (status_a & ~status_b) >> j & 1]
+        only_b = [j for j in range( MAX_SECTORS) if (status_b & ~status_a) >> j & 1]
+        differences.append( [track_no, sectors, only_a, only_b])
+    return differences
+    
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Best-of-N merge of several captures of one disk
+#
+# The captures (.raw and .bin files, e.g. taken on different days or drives) are loaded in parallel; .raw files are
+# decoded like 'r'. A sector copy is verified if it has been decoded with correct checksum: all decoded sectors of 
+# .raw files, sectors of .bin files marked in the status of their manifest and still matching the sector hash.
+# Sectors of .bin files without manifest are not verified; they are only used if no capture holds a verified copy
+# and if they are not all zero.
+# For each sector the content found in most captures is taken (verified copies first); on a tie the capture listed 
+# first wins. The merged image is written as .bin file with manifest and a provenance map (JSON, PROVENANCE_SUFFIX):
+#   captures:   file names of the merged captures
+#   tracks:     per track 16 entries (logical sectors): index of the capture the sector was taken from, -1 if missing
+#   verified:   per track bit mask of the sectors taken from a verified copy
+#   conflicts:  [track, sector, [capture indices of each differing content]] for sectors with differing copies
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def load_capture( file_name):
+    """ loads capture <file_name> (.raw or .bin); returns (file name, data, sector masks usable, verified, error) """
+    try:
+        with open( file_name, "rb") as capture_file, \
+             mmap.mmap( capture_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if file_name.endswith( ".raw"):
+                image = DiskImage( len( data) // RAW_TRACK_SIZE)
+                for track_no in range( image.no_tracks):
+                    track_decode_dos33( data, image.track( track_no), RAW_TRACK_SIZE*track_no, RAW_TRACK_SIZE*(track_no+1))
+                return file_name, bytes( image.data), list( image.valid), list( image.valid), None
+            image = DiskImage.from_bytes( bytearray( data))
+    except Exception as e:
+        return file_name, None, [], [], str( e)
+    # sectors are usable if not all zero (sectors which could not be decoded are zero filled)
+    valid = [sum( 1 << j for j in range( MAX_SECTORS) if any( image.sector( track_no, j))) for track_no in range( image.no_tracks)]
+    verified = [0] * image.no_tracks
+    try:
+        manifest = read_manifest( file_name + MANIFEST_SUFFIX)
+    except Exception:
+        manifest = None
+    if( manifest is not None) and (manifest["sector_size"] == SECTOR_SIZE):
+        for track_no, track in enumerate( manifest["tracks"][:image.no_tracks]):
+            if "status" not in track:
+                continue
+            # sectors marked as decoded in the manifest, unless changed since capture
+            sectors = track.get( "sectors", [])
+            verified[track_no] = sum( 1 << j for j in range( min( len( sectors), MAX_SECTORS)) 
+                                      if (track["status"] >> j) & 1 and image_hash( image.sector( track_no, j)) == sectors[j])
+            valid[track_no] = verified[track_no]
+    return file_name, bytes( image.data), valid, verified, None
+    
+def load_captures( file_names):
+    """ loads the captures <file_names> in parallel; returns list of results of load_capture() """
+    if len( file_names) < 2:
+        return [load_capture( name) for name in file_names]
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        return list( executor.map( load_capture, file_names))
+
+def merge_captures( captures):
+    """ merges the loaded captures [(data, usable masks, verified masks)]; returns (DiskImage, provenance) """
+    no_tracks = max( len( valid) for data, valid, verified in captures)
+    images = []
+    for data, valid, verified in captures:
+        image = DiskImage( len( valid), bytearray( data))
+        image.valid = array.array( 'H', valid)
+        images.append( (image, verified))
+    merged = DiskImage( no_tracks)
+    provenance = {"tracks": [], "verified": [], "conflicts": []}
+    for track_no in range( no_tracks):
+        sources = [-1] * MAX_SECTORS
+        verified_mask = 0
+        for sector_no in range( MAX_SECTORS):
+            copies = {}  # sector content -> indices of captures holding it (verified copies only, if any)
+            use_verified = any( track_no < len( verified) and (verified[track_no] >> sector_no) & 1 for image, verified in images)
+            for k, (image, verified) in enumerate( images):
+                if not image.is_valid( track_no, sector_no):
+                    continue
+                if use_verified and not (verified[track_no] >> sector_no) & 1:
+                    continue
+                copies.setdefault( bytes( image.sector( track_no, sector_no)), []).append( k)
+            if len( copies) == 0:
+                continue
+            # content held by most captures, first capture on a tie (dicts keep insertion order)
+            content, holders = max( copies.items(), key=lambda item: len( item[1]))
+            merged.sector( track_no, sector_no)[:] = content
+            merged.valid[track_no] |= 1 << sector_no
+            sources[sector_no] = holders[0]
+            if use_verified:
+                verified_mask |= 1 << sector_no
+            if len( copies) > 1:
+                provenance["conflicts"].append( [track_no, sector_no, [indices for indices in copies.values()]])
+        provenance["tracks"].append( sources)
+        provenance["verified"].append( verified_mask)
+    return merged, provenance
+    
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Consistency check of DOS 3.3 images
+#
+# check_image() cross-checks the DOS 3.3 structures of a .bin image. The image is memory mapped and only the sectors
+# of the VTOC, the catalog and the track/sector lists are read (and the sectors used by files if there is no manifest).
+# Each problem found is reported as [check, text]:
+#   vtoc:     VTOC (track 17, sector 0) missing or implausible (catalog sector, tracks, sectors per track, 
+#             bytes per sector, track/sector pairs per list sector)
+#   catalog:  catalog chain leaves the disk, loops, or contains missing or badly formatted sectors
+#   ts_list:  track/sector list of a file is corrupt, ends before the file length, or points outside of the disk
+#   missing:  file uses sectors which could not be decoded: sectors not marked in the status of the manifest 
+#             (if the image has no manifest: sectors which are all zero)
+#   shared:   sector used by two files (or by a file and the VTOC or catalog)
+#   bitmap:   sectors used but marked as free in the VTOC bitmap; sectors allocated but not used by any file
+#             (not checked for tracks 0-2, which hold the DOS image, and for DIR_TRACK)
+# check_images() checks many images in a process pool.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def check_image( file_name):
+    """ checks the DOS 3.3 structures of image <file_name> (.bin); returns (file name, list of [check, text], error) """
+    try:
+        manifest = read_manifest( file_name + MANIFEST_SUFFIX)
+        if manifest["sector_size"] != SECTOR_SIZE:
+            manifest = None
+    except Exception:
+        manifest = None
+    try:
+        with open( file_name, "rb") as image_file, \
+             mmap.mmap( image_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return file_name, check_dos_structures( data, manifest), None
+    except Exception as e:
+        return file_name, [], str( e)
+        
+def check_images( file_names):
+    """ checks the images <file_names> in parallel; returns list of results of check_image() """
+    if len( file_names) < 2:
+        return [check_image( name) for name in file_names]
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        return list( executor.map( check_image, file_names, chunksize=max( 1, len( file_names) // (4 * (os.cpu_count() or 1)))))
+        
+def check_dos_structures( data, manifest=None):
+    """ cross-checks VTOC, catalog, track/sector lists and free sector bitmap of disk image <data>; returns list of [check, text] """
+    problems = []
+    no_tracks = len( data) // TRACK_SIZE
+    owners = {}  # (track, sector) -> first user of the sector
+    
+    def is_decoded( track_no, sector_no):
+        if( manifest is not None) and (track_no < len( manifest["tracks"])) and ("status" in manifest["tracks"][track_no]):
+            return (manifest["tracks"][track_no]["status"] >> sector_no) & 1 == 1
+        return True
+        
+    def is_missing( track_no, sector_no):
+        if manifest is not None:
+            return not is_decoded( track_no, sector_no)
+        # empty catalog sectors are all zero as well, so the structures are read regardless
+        offset = track_no * TRACK_SIZE + sector_no * SECTOR_SIZE
+        return data[offset:offset + SECTOR_SIZE].count( 0) == SECTOR_SIZE
+        
+    def get_sector( track_no, sector_no):
+        if not( 0 <= track_no < no_tracks and 0 <= sector_no < MAX_SECTORS and is_decoded( track_no, sector_no)):
+            return b''
+        offset = track_no * TRACK_SIZE + sector_no * SECTOR_SIZE
+        return data[offset:offset + SECTOR_SIZE]
+        
+    def use( track_no, sector_no, owner):
+        if( track_no, sector_no) not in owners:
+            owners[(track_no, sector_no)] = owner
+        elif owners[(track_no, sector_no)] != owner:
+            problems.append(["shared", "Track " + str( track_no) + ", sector " + str( sector_no) + " used by " + 
+                             owners[(track_no, sector_no)] + " and " + owner + "."])
+    
+    # VTOC
+    vtoc = get_sector( DIR_TRACK, 0)
+    if len( vtoc) != SECTOR_SIZE:
+        problems.append(["vtoc", "VTOC (track " + str( DIR_TRACK) + ", sector 0) missing."])
+        return problems
+    use( DIR_TRACK, 0, "VTOC")
+    disk_no_tracks = vtoc[0x34]
+    if not( DEF_TRACKS <= disk_no_tracks <= MAX_TRACKS):
+        problems.append(["vtoc", "Number of tracks is " + str( disk_no_tracks) + "."])
+        disk_no_tracks = no_tracks
+    elif disk_no_tracks > no_tracks:
+        problems.append(["vtoc", "Disk has " + str( disk_no_tracks) + " tracks, image holds " + str( no_tracks) + "."])
+        disk_no_tracks = no_tracks
+    if vtoc[0x35] != MAX_SECTORS:
+        problems.append(["vtoc", "Number of sectors per track is " + str( vtoc[0x35]) + "."])
+    if( vtoc[0x36] | (vtoc[0x37] << 8)) != SECTOR_SIZE:
+        problems.append(["vtoc", "Number of bytes per sector is " + str( vtoc[0x36] | (vtoc[0x37] << 8)) + "."])
+    if vtoc[0x27] != 122:
+        problems.append(["vtoc", "Number of track/sector pairs per list sector is " + str( vtoc[0x27]) + "."])
+        
+    # catalog chain
+    directory = []
+    track_no, sector_no = vtoc[1], vtoc[2]
+    if( track_no, sector_no) == (0, 0):
+        problems.append(["vtoc", "No catalog sector."])
+    while( track_no, sector_no) != (0, 0):
+        location = "Catalog sector (track " + str( track_no) + ", sector " + str( sector_no) + ")"
+        if not( track_no < disk_no_tracks and sector_no < MAX_SECTORS):
+            problems.append(["catalog", location + " outside of disk."])
+            break
+        if owners.get( (track_no, sector_no)) == "catalog":
+            problems.append(["catalog", location + " already in catalog chain (loop)."])
+            break
+        use( track_no, sector_no, "catalog")
+        sector = get_sector( track_no, sector_no)
+        if len( sector) != SECTOR_SIZE:
+            problems.append(["catalog", location + " missing."])
+            break
+        if not decode_catalog_sector( sector, directory):
+            problems.append(["catalog", location + " badly formatted."])
+            break
+        track_no, sector_no = sector[1], sector[2]
+        
+    # track/sector lists of the files
+    for file_entry in directory:
+        owner = "file " + file_entry[0].rstrip()
+        missing = []
+        list_location = None
+        for kind, track_no, sector_no in read_file_sector_list( get_sector, file_entry):
+            if kind == "INVALID":
+                # track/sector list sector could not be read; missing sectors are reported below
+                if( list_location is not None) and is_decoded( *list_location):
+                    problems.append(["ts_list", owner + ": track/sector list sector " + str( list_location) + " corrupt."])
+                continue
+            if kind == "INVALID CONT.":
+                problems.append(["ts_list", owner + ": track/sector list ends before end of file."])
+                continue
+            if( kind == "data") and (track_no == 0) and (sector_no == 0):
+                continue # sector not allocated (sparse file)
+            if not( track_no < disk_no_tracks and sector_no < MAX_SECTORS):
+                problems.append(["ts_list", owner + ": sector " + str( (track_no, sector_no)) + " outside of disk."])
+                if kind == "list":
+                    list_location = None
+                continue
+            if kind == "list":
+                list_location = (track_no, sector_no)
+            use( track_no, sector_no, owner)
+            if is_missing( track_no, sector_no):
+                missing.append( (track_no, sector_no))
+        if len( missing) > 0:
+            problems.append(["missing", owner + ": " + ("sectors not decoded: " if manifest is not None else "sectors zero filled: ") + 
+                             " ".join( str( location) for location in missing)])
+                             
+    # free sector bitmap (bit n of the 16-bit value set: sector n free)
+    for track_no in range( disk_no_tracks):
+        free = (vtoc[0x38 + 4*track_no] << 8) | vtoc[0x39 + 4*track_no]
+        used = sum( 1 << j for j in range( MAX_SECTORS) if (track_no, j) in owners)
+        if used & free:
+            problems.append(["bitmap", "Track " + str( track_no) + ": sectors used but marked as free: " + 
+                             str( [j for j in range( MAX_SECTORS) if (used & free) >> j & 1])])
+        unused = 0xffff & ~free & ~used
+        if unused and (track_no > 2) and (track_no != DIR_TRACK):
+            problems.append(["bitmap", "Track " + str( track_no) + ": sectors allocated but not used: " + 
+                             str( [j for j in range( MAX_SECTORS) if unused >> j & 1])])
+    return problems
+    
+
 #--------------------------------------------------------------------------------------------------------------
 #
 # Test serial connection to board
@@ -677,6 +2378,8 @@ def test_serial( connection):
 #
 # ------------------------------------------------------------------------------------------------------------- 
 def _read_disk_directory( connection):
+    # disk may have been changed since the last command
+    connection.track_cache.begin_disk()
     read_disk_directory( connection, True)
     return
 
@@ -713,6 +2416,7 @@ def capture_raw_disk_to_host_file( connection):
             return
       
     user_input = input( "Insert disk. Enter a filename for the disk (.raw is appended automatically): ")
+    connection.track_cache.begin_disk()
     try:
         os.mkdir( DISK_DIR_NAME, 0o700)
     except OSError as e:
@@ -726,14 +2430,17 @@ def capture_raw_disk_to_host_file( connection):
         connection.enter_single_track_mode()
         try:
             with open(disk_name, "wb") as file:
+                manifest = ImageManifest( disk_name, 0)
                 i=0 
                 while i<MAX_TRACKS:
       	            # read track i with default delay (best effort mode, as track format is unknown)
                     track_data = connection.read_track_from_drive( i, DEF_ROUND)
                     print("Storing track:", i, "to file.")
                     file.write( track_data)               
+                    manifest.add_track( track_data)
                     i+=1 # move to next track              
                 file.close()   
+                manifest.close()
         except Exception as e:
             print("Error during generation of", disk_name,".")   
             print(str(e))
@@ -754,69 +2461,76 @@ def capture_raw_disk_to_host_file( connection):
 def analyze_raw_disk_from_bin_file():
     
     user_input = input( "Enter input file name to be decoded (.raw is appended automatically): ")  
-    disk_name = DISK_DIR_NAME + "/" + user_input + ".raw"
-    disk_out_name = DISK_DIR_NAME + "/" + user_input + ".bin"
+    export_formats = ask_export_formats()
+    decode_raw_disk( user_input, export_formats)
+    return
+    
+def decode_raw_disk( name, export_formats=[]):
+    """ decodes DISK_DIR_NAME/<name>.raw to <name>.bin (and <export_formats>); returns name of .bin file or None """
+    disk_name = DISK_DIR_NAME + "/" + name + ".raw"
+    disk_out_name = DISK_DIR_NAME + "/" + name + ".bin"
+    for file_name in export_file_names( DISK_DIR_NAME + "/" + name, export_formats):
+        if os.path.isfile( file_name):
+            print("Error: File", file_name, "already exists.")
+            return None
     
-    # read input .raw file from file system
+    # map input .raw file from file system; tracks are decoded in place
     try:
-        with open( disk_name, "rb") as bin_file:
-            disk_dec = bytearray( bin_file.read())
-            bin_file.close()     
+        raw_file = open( disk_name, "rb")
+        raw_disk = mmap.mmap( raw_file.fileno(), 0, access=mmap.ACCESS_READ)
     except Exception as e:
         print("Error when trying to read", disk_name,".")   
         print( str(e))
-        return
+        return None
     
     print("\nDecoding", disk_name, "...\n")    
-    track_dec=bytearray()  
+    image = DiskImage( MAX_TRACKS)
     i=0
     while i<MAX_TRACKS: 
-        read_sectors=0
-        missing_logical_sector_list=[]
-        # decode track to DOS3.3 format
-        no, track_dec_phys = track_decode_dos33( disk_dec.hex()[(RAW_TRACK_SIZE*2)*i:(RAW_TRACK_SIZE*2)*i+RAW_TRACK_SIZE*2])
-        track_dec_phys_total = {}
-        for sector in track_dec_phys:
-            if sector not in track_dec_phys_total:
-                track_dec_phys_total[sector] = track_dec_phys[sector]
-                read_sectors +=1
-                
-        # fill up missing physical sectors with all zero pattern      
-        j=0
-        while j<MAX_SECTORS:
-          
-            if j not in track_dec_phys_total:
-                track_dec_phys_total[j] = [0 for i in range(SECTOR_SIZE)]
-                missing_logical_sector_list.append(j)
-                print("Track: ", i,". Decoded Sectors:", read_sectors, end="\r", flush=True)
-            j+=1
-                
-        # now reassemble 16 physical to 16 logical sectors
-        physical_2_logical_sector_mapping_list=[0,13,11,9,7,5,3,1,14,12,10,8,6,4,2,15]
-        for j in physical_2_logical_sector_mapping_list:
-            track_dec += bytes( track_dec_phys_total[j])    
+        # decode track to DOS3.3 format; missing sectors remain all zero
+        track_image = image.track( i)
+        track_decode_dos33( raw_disk, track_image, RAW_TRACK_SIZE*i, RAW_TRACK_SIZE*(i+1))
+        read_sectors = track_image.count()
+        missing_logical_sector_list = track_image.missing_sectors()
         
         if( read_sectors == MAX_SECTORS):
             print("Track:", i, ".", MAX_SECTORS,"sectors decoded correctly.       ")
         else:
-            print("Track:", i, ". Incomplete track read. Sector(s) ", str( sorted( missing_logical_sector_list)), " could not be decoded.", sep='')
-            
+            print("Track:", i, ". Incomplete track read. Sector(s) ", str( missing_logical_sector_list), " could not be decoded.", sep='')
         i+=1 # next track
         
+    # feed additional image formats with decoded sectors and raw disk bytes of the tracks of the disk (as 'c'):
+    # number of tracks in VTOC, 35 if there is no usable VTOC
+    disk_no_tracks = DEF_TRACKS
+    vtoc = image.sector( DIR_TRACK, 0)
+    if image.is_valid( DIR_TRACK, 0) and (vtoc[3] == 3) and (DEF_TRACKS <= vtoc[0x34] <= MAX_TRACKS):
+        disk_no_tracks = vtoc[0x34]
+    exporters = open_exporters( DISK_DIR_NAME + "/" + name, export_formats, DEF_VOLUME)
+    for i in range( disk_no_tracks):
+        for exporter in exporters:
+            exporter.write_track( i, image.track_data( i), image.missing_sectors( i), raw_disk[RAW_TRACK_SIZE*i:RAW_TRACK_SIZE*(i+1)])
+    close_exporters( exporters)
+    raw_disk.close()
+    raw_file.close()
+
     # write output to .bin file
     try:
         with open( disk_out_name, "wb") as bin_file:
-            bin_file.write( track_dec) 
+            bin_file.write( image.data) 
             print("\nOutput written to: ", disk_out_name,"\n")       
+        manifest = ImageManifest( disk_out_name)
+        for i in range( MAX_TRACKS):
+            manifest.add_track( image.track_data( i), image.valid[i])
+        manifest.close()
     
     except Exception as e:
         print("Error when trying to write ", disk_out_name,".")   
         print( str(e))
+        disk_out_name = None
     
     # print VTOC and table of contents     
-    track_offset = DIR_TRACK*TRACK_SIZE  
-    analyze_dir_track([], track_dec[track_offset:track_offset+TRACK_SIZE], True)
-    return
+    analyze_dir_track( image.missing_sectors( DIR_TRACK), image.track_data( DIR_TRACK), True)
+    return disk_out_name
   
  
 
@@ -833,6 +2547,13 @@ def quick_scan( connection):
 
     print("Now running quick scan of disk. This will output the number of decoded DOS3.3 sectors in tracks", QSCAN_TRACKS,".")
     user_input = input( "Insert disk and press return: ")
+    quick_scan_disk( connection)
+    return
+    
+def quick_scan_disk( connection):
+    """ scans tracks QSCAN_TRACKS of inserted disk; returns dict track -> missing logical sectors """
+    connection.track_cache.begin_disk()
+    missing_sectors = {}
  
     # configure target for single track read mode
     connection.enter_single_track_mode()
@@ -840,12 +2561,264 @@ def quick_scan( connection):
     # scan the tracks (last parameter '0' indicates fast mode, i.e. max 8 retry attempts)
     for i in QSCAN_TRACKS:
         result, read_sectors, missing_sector_list, round_list, disk_dec = track_read( connection, i, 0)      
+        missing_sectors[i] = missing_sector_list
     
     # configure target to leave single track read mode and enter main loop
     connection.enter_main_loop()     
+    return missing_sectors
+  
+ 
+#--------------------------------------------------------------------------------------------------------------
+#
+# Serial link benchmark
+#
+# Reads the tracks BENCHMARK_TRACKS BENCHMARK_READS times with plain and packed transfer and prints for each
+# transfer mode the bytes sent over the serial link, the transfer time and the effective rate (track bytes/s).
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def benchmark_link( connection):
+    if not connection.is_established():
+        if not connection.setup():
+            print("Cannot connect to drive.")
+            return
+
+    user_input = input( "Insert disk and press return: ")
+    connection.enter_single_track_mode()
+    modes = [("plain", False)]
+    if connection.is_packed_supported():
+        modes.append( ("packed", True))
+    else:
+        print("Packed transfer not supported by board firmware (or disabled). Measuring plain transfer only.")
+
+    print("")
+    print("Mode    Track  Wire bytes  Time [ms]  Rate [bytes/s]  Ratio  Sectors")
+    results = {}
+    for track_no in BENCHMARK_TRACKS:
+        for name, packed in modes:
+            wire_bytes, track_bytes, transfer_time, sectors = 0, 0, 0.0, 0
+            for i in range( BENCHMARK_READS):
+                track = connection.read_track_from_drive( track_no, DEF_ROUND, packed)
+                if track is None:
+                    print("Track ", track_no, ": read failed.", sep='')
+                    connection.enter_main_loop()
+                    return
+                wire_bytes += connection.last_transfer[0]
+                track_bytes += connection.last_transfer[1]
+                transfer_time += connection.last_transfer[2]
+                # decode into a scratch image, the track cache is not touched
+                track_image = DiskImage().track( track_no)
+                track_decode_dos33( track, track_image)
+                sectors += track_image.count()
+            results[name] = results.get( name, 0.0) + transfer_time
+            print("{0:<6}  {1:>5}  {2:>10}  {3:>9.1f}  {4:>14.0f}  {5:>5.2f}  {6:>7.1f}".format( name, track_no, 
+                  wire_bytes // BENCHMARK_READS, 1000 * transfer_time / BENCHMARK_READS, track_bytes / max( transfer_time, 1e-9), 
+                  wire_bytes / track_bytes, sectors / BENCHMARK_READS))
+    connection.enter_main_loop()
+    if "packed" in results:
+        print("")
+        print("Transfer time packed/plain: ", "{0:.2f}".format( results["packed"] / results["plain"]), sep='')
     return
   
  
+#--------------------------------------------------------------------------------------------------------------
+#
+# Retry scheduling of incomplete tracks
+#
+# 'c' reads each track FIRST_PASS_ATTEMPTS times in a first pass over the disk. Tracks with missing sectors are
+# deferred and retried afterwards: each sweep reads the deferred tracks RETRY_CHUNK_ATTEMPTS times in the order 
+# with least head travel (see seek_order()), the round values continue where the previous reads stopped.
+# The track motor is reset after a sweep in which tracks have failed another len( ROUND_VALUES) reads (same as
+# track_read()), but only once for all tracks of the sweep and not in the middle of the pass.
+# Retries stop when all tracks are complete, each track has been read len( ROUND_VALUES) * RETRY_ATTEMPTS times
+# or the time budget CAPTURE_TIME_BUDGET is used up.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def retry_deferred_tracks( connection, deferred, attempts, round_lists):
+    """ retries tracks <deferred>; <attempts>, <round_lists>: reads done and round values per track; returns time used [s] """
+    start = time.monotonic()
+    max_attempts = len( ROUND_VALUES) * RETRY_ATTEMPTS
+    deferred = [track_no for track_no in deferred if attempts[track_no] < max_attempts]
+    while len( deferred) > 0:
+        motor_reset = False
+        for track_no in seek_order( deferred, connection.head_track):
+            if( CAPTURE_TIME_BUDGET > 0) and (time.monotonic() - start > CAPTURE_TIME_BUDGET):
+                print("Time budget for retries used up. Tracks not complete:", sorted( deferred))
+                return time.monotonic() - start
+            chunk = min( RETRY_CHUNK_ATTEMPTS, max_attempts - attempts[track_no])
+            result, read_sectors, missing_sector_list, round_list, disk_dec = track_read( connection, track_no, RETRY_ATTEMPTS, chunk, 
+                                                                                          first_attempt=attempts[track_no], motor_resets=False)
+            attempts[track_no] += chunk
+            round_lists[track_no] += round_list
+            if( len( missing_sector_list) == 0) or (attempts[track_no] >= max_attempts):
+                deferred.remove( track_no)
+            elif attempts[track_no] // len( ROUND_VALUES) != (attempts[track_no] - chunk) // len( ROUND_VALUES):
+                motor_reset = True
+        if motor_reset and len( deferred) > 0:
+            # reposition track motor; next sweep starts at the lowest track
+            connection.reset_track_motor( min( deferred))
+    return time.monotonic() - start
+  
+ 
+#--------------------------------------------------------------------------------------------------------------
+#
+# Detection of disks already in the archive
+#
+# Before a disk is captured, its identity (volume and fingerprint of VTOC and catalog, see disk_identity()) is looked up
+# in an index of the .bin images in DISK_DIR_NAME (FINGERPRINT_INDEX, JSON: per image file size, modification time and 
+# identity; entries of new or changed images are updated on each lookup). If archived images have the same identity,
+# a few tracks with allocated sectors (FINGERPRINT_SAMPLE_TRACKS) are read and compared with these images. The disk is
+# taken as duplicate of an image if all sectors decoded on the sample tracks are equal.
+# A duplicate can be skipped or verified: all tracks with allocated sectors are read once (no retries) and compared 
+# with the image.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def image_identity( file_name):
+    """ returns disk identity (see disk_identity()) of .bin image <file_name>; None if VTOC is missing """
+    with open( file_name, "rb") as image_file:
+        image_file.seek( DIR_TRACK * TRACK_SIZE)
+        track = image_file.read( TRACK_SIZE)
+    if len( track) != TRACK_SIZE:
+        return None
+    missing_sector_list = []
+    try:
+        status = read_manifest( file_name + MANIFEST_SUFFIX)["tracks"][DIR_TRACK]["status"]
+        missing_sector_list = [j for j in range( MAX_SECTORS) if not (status >> j) & 1]
+    except Exception:
+        pass
+    return disk_identity( track, missing_sector_list)
+    
+def update_fingerprint_index():
+    """ updates index DISK_DIR_NAME/FINGERPRINT_INDEX of the .bin images; returns dict image name -> entry """
+    index_name = DISK_DIR_NAME + "/" + FINGERPRINT_INDEX
+    try:
+        with open( index_name, "r") as index_file:
+            images = json.load( index_file)["images"]
+    except Exception:
+        images = {}
+    changed = False
+    names = [os.path.basename( name) for name in glob.glob( DISK_DIR_NAME + "/*.bin")]
+    for name in names:
+        stat = os.stat( DISK_DIR_NAME + "/" + name)
+        entry = images.get( name)
+        if( entry is None) or (entry["size"] != stat.st_size) or (entry["mtime"] != stat.st_mtime):
+            try:
+                identity = image_identity( DISK_DIR_NAME + "/" + name)
+            except OSError:
+                identity = None
+            images[name] = {"size": stat.st_size, "mtime": stat.st_mtime, "identity": None if identity is None else list( identity)}
+            changed = True
+    for name in [name for name in images if name not in names]:
+        del images[name]
+        changed = True
+    if changed:
+        with open( index_name, "w") as index_file:
+            json.dump( {"version": VERSION, "images": images}, index_file, indent=1)
+    return images
+    
+def sample_tracks( vtoc, disk_no_tracks, count):
+    """ returns up to <count> tracks with allocated sectors, spread over the disk (DOS tracks 0-2 and DIR_TRACK excluded) """
+    free_tracks = read_vtoc_free_tracks( vtoc, disk_no_tracks) or []
+    used = [t for t in range( 3, min( disk_no_tracks, MAX_TRACKS)) if t != DIR_TRACK and t not in free_tracks]
+    if len( used) <= count:
+        return used
+    return [used[(len( used) - 1) * k // max( 1, count - 1)] for k in range( count)]
+    
+def compare_with_image( disk, file_name, tracks):
+    """ compares the decoded sectors of <tracks> in DiskImage <disk> with .bin image <file_name>
+        returns (number of equal sectors, differing [track, sector], [track, sector] not decoded in the image) """
+    equal = 0
+    differing = []
+    not_in_image = []
+    try:
+        manifest = read_manifest( file_name + MANIFEST_SUFFIX)
+    except Exception:
+        manifest = None
+    with open( file_name, "rb") as image_file, \
+         mmap.mmap( image_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for track_no in tracks:
+            status = 0xffff
+            if( manifest is not None) and (track_no < len( manifest["tracks"])):
+                status = manifest["tracks"][track_no].get( "status", 0xffff)
+            for sector_no in range( MAX_SECTORS):
+                if not disk.is_valid( track_no, sector_no):
+                    continue
+                offset = track_no * TRACK_SIZE + sector_no * SECTOR_SIZE
+                if not (status >> sector_no) & 1:
+                    not_in_image.append( [track_no, sector_no])
+                elif data[offset:offset + SECTOR_SIZE] == disk.sector( track_no, sector_no):
+                    equal += 1
+                else:
+                    differing.append( [track_no, sector_no])
+    return equal, differing, not_in_image
+    
+def missing_allocated_sectors( file_name, vtoc, disk_no_tracks):
+    """ returns number of sectors allocated in <vtoc> which are not decoded in .bin image <file_name> (see its manifest) """
+    try:
+        tracks = read_manifest( file_name + MANIFEST_SUFFIX)["tracks"]
+    except Exception:
+        return 0
+    missing = 0
+    for track_no in range( min( disk_no_tracks, MAX_TRACKS, len( tracks))):
+        allocated = ~((vtoc[0x38 + 4*track_no] << 8) | vtoc[0x39 + 4*track_no]) & 0xffff
+        missing += bin( allocated & ~tracks[track_no].get( "status", 0xffff)).count("1")
+    return missing
+    
+def find_duplicate( connection, disk_no_tracks):
+    """ returns name of archived image of the disk in the drive (DIR_TRACK must have been read); None if not archived 
+        images with all allocated sectors decoded are preferred """
+    track_cache = connection.track_cache
+    image = track_cache.image()
+    if not track_cache.is_identified() or (len( image.missing_sectors( DIR_TRACK)) > 0):
+        return None
+    images = update_fingerprint_index()
+    vtoc = image.sector( DIR_TRACK, 0)
+    candidates = sorted( (missing_allocated_sectors( DISK_DIR_NAME + "/" + name, vtoc, disk_no_tracks), DISK_DIR_NAME + "/" + name) 
+                         for name, entry in images.items() if entry["identity"] == list( track_cache.current[:2]))
+    if len( candidates) == 0:
+        return None
+    tracks = sample_tracks( vtoc, disk_no_tracks, FINGERPRINT_SAMPLE_TRACKS)
+    print("Disk identity found in archive:", ", ".join( name for missing, name in candidates) + ". Comparing tracks:", tracks)
+    # the sample tracks are read from the drive, not from the track cache: a cached copy of the archived disk would always match
+    sample = DiskImage()
+    connection.enter_single_track_mode()
+    for track_no in tracks:
+        track_read( connection, track_no, RETRY_ATTEMPTS, FIRST_PASS_ATTEMPTS, image=sample)
+    connection.enter_main_loop()
+    # a capture of the disk uses these reads
+    track_cache.add_reads( sample)
+    for missing, name in candidates:
+        equal, differing, not_in_image = compare_with_image( sample, name, tracks)
+        if( len( differing) == 0) and (equal > 0 or len( tracks) == 0):
+            if missing > 0:
+                print("Archived image", name, "lacks", missing, "allocated sector(s).")
+            return name
+    return None
+    
+def verify_duplicate( connection, file_name, disk_no_tracks):
+    """ reads the tracks with allocated sectors once and compares them with image <file_name>; returns True if equal """
+    vtoc = connection.track_cache.image().sector( DIR_TRACK, 0)
+    free_tracks = read_vtoc_free_tracks( vtoc, disk_no_tracks) or []
+    tracks = [t for t in range( disk_no_tracks) if t not in free_tracks]
+    # read from the drive into a new image, sectors of the track cache are not used
+    image = DiskImage()
+    connection.enter_single_track_mode()
+    for track_no in seek_order( tracks, connection.head_track):
+        track_read( connection, track_no, RETRY_ATTEMPTS, FIRST_PASS_ATTEMPTS, image=image)
+    connection.enter_main_loop()
+    # a capture following a failed verify uses these reads
+    connection.track_cache.add_reads( image)
+    equal, differing, not_in_image = compare_with_image( image, file_name, tracks)
+    print("Verified against ", file_name, ": ", equal, " sectors equal.", sep='')
+    if len( differing) > 0:
+        print("Sectors differing [track, sector]:", differing)
+    if len( not_in_image) > 0:
+        print("Sectors decoded, but missing in the image [track, sector]:", not_in_image, "(use 'M' to merge a new capture)")
+    missing = sum( len( image.missing_sectors( t)) for t in tracks)
+    if missing > 0:
+        print(missing, "sector(s) of allocated tracks could not be decoded in this pass.")
+    return len( differing) == 0
+  
+ 
 #--------------------------------------------------------------------------------------------------------------
 #
 # Capture DOS 3.3 disk to host file
@@ -859,6 +2832,21 @@ def capture_dos_disk_to_host_file( connection):
             return
               
     user_input = input( "Insert disk. Enter a filename for the disk (.bin and .txt are appended automatically): ")
+    export_formats = ask_export_formats()
+    capture_mode = input( "Capture mode: [f]ull, [s]parse (single read of free tracks), [z]ero (free tracks skipped and zero filled); return for full: ")
+    capture_dos_disk( connection, user_input, export_formats, capture_mode, duplicates="ask")
+    return
+    
+def capture_dos_disk( connection, name, export_formats=[], capture_mode="f", duplicates="capture"):
+    """ captures inserted disk to DISK_DIR_NAME/<name>.bin (and .txt, <export_formats>); returns name of .bin file or None 
+        duplicates: disk already archived (see find_duplicate()): "capture" (not checked), "ask", "skip", "verify"
+        returns name of the archived image if the disk has been skipped or verified without differences; 
+        a disk differing from the archived image is captured """
+    result = None
+    connection.track_cache.begin_disk()
+    # record all read attempts of this capture
+    capture_stats = CaptureStats( connection.port)
+    connection.capture_stats = capture_stats
      
     print("Now reading VTOC to check DOS version and number of available tracks on disk...")     
                  
@@ -869,6 +2857,35 @@ def capture_dos_disk_to_host_file( connection):
     if( disk_os_version != 3):
         disk_no_tracks=DEF_TRACKS
         print("Invalid DOS version. Set number of tracks set to 35.")
+        
+    # sparse capture: find tracks without allocated sectors in VTOC (VTOC has just been decoded, it's in the track cache)
+    free_tracks = []
+    if capture_mode in ["s", "z"]:
+        image = connection.track_cache.image()
+        if( disk_os_version == 3) and image.is_valid( DIR_TRACK, 0):
+            free_tracks = read_vtoc_free_tracks( image.sector( DIR_TRACK, 0), disk_no_tracks)
+        if free_tracks is None or disk_os_version != 3:
+            print("VTOC free sector bitmaps not usable. Capturing all tracks.")
+            free_tracks = []
+        else:
+            print("Tracks without allocated sectors:", free_tracks)
+            
+    # disk already archived?
+    if( rc == True) and (disk_os_version == 3) and (duplicates != "capture"):
+        duplicate = find_duplicate( connection, disk_no_tracks)
+        if duplicate is not None:
+            choice = duplicates
+            if duplicates == "ask":
+                choice = input( "Disk matches archived image " + duplicate + ". [s]kip, [v]erify only; return to capture anyway: ")
+            if choice in ["s", "skip"]:
+                print("Disk matches", duplicate + ". Capture skipped.")
+                connection.capture_stats = None
+                return duplicate
+            if choice in ["v", "verify"]:
+                if verify_duplicate( connection, duplicate, disk_no_tracks):
+                    connection.capture_stats = None
+                    return duplicate
+                print("Disk differs from", duplicate + ". Capturing the disk.")
   
     if( rc == True):
         try:
@@ -876,34 +2893,101 @@ def capture_dos_disk_to_host_file( connection):
         except OSError as e:
             if(e.errno != errno.EEXIST):
                 print("Cannot create directory", DISK_DIR_NAME, "in current directory")
-                exit()
+                connection.capture_stats = None
+                return None
     
-        disk_name = DISK_DIR_NAME + "/" + user_input + ".bin"
-        disk_info = DISK_DIR_NAME + "/" + user_input + ".txt"
+        disk_name = DISK_DIR_NAME + "/" + name + ".bin"
+        disk_info = DISK_DIR_NAME + "/" + name + ".txt"
+        export_names = export_file_names( DISK_DIR_NAME + "/" + name, export_formats)
         
         #check if file already exists
-        if not os.path.isfile( disk_name):
+        if not os.path.isfile( disk_name) and not any( os.path.isfile( name) for name in export_names):
       	
             # configure target for single track read mode
                 connection.enter_single_track_mode() # move !!!!
+                
+                steps = connection.head_steps
+                
+                # volume number is used for address fields of nibble based image formats
+                volume_no = DEF_VOLUME
+                if connection.track_cache.is_identified():
+                    volume_no = connection.track_cache.current[0]
           
          #   try:
                 with open( disk_name,"wb") as bin_file,\
                      open( disk_info,"w")  as txt_file:
+                    exporters = open_exporters( DISK_DIR_NAME + "/" + name, export_formats, volume_no)
+                    manifest = ImageManifest( disk_name)
+                    if len( free_tracks) > 0:
+                        txt_file.write( "Sparse capture. Tracks without allocated sectors in VTOC: " + str( free_tracks) + ".\n")
+                    skipped_tracks = []
+                    round_lists = {}
+                    attempts = {}
+                    deferred = []
+                    # first pass: few reads per track, incomplete tracks are retried when all tracks have been read
+                    for i in range( disk_no_tracks):
+                        if( i in free_tracks) and (capture_mode == "z"):
+                            # track is not read at all
+                            print("Track ", i, ": no allocated sectors. Skipped, zero filled.", sep='')
+                            skipped_tracks.append( i)
+                        elif i in free_tracks:
+                            # best effort read of track
+                            result, read_sectors, missing_sector_list, round_lists[i], disk_dec = track_read( connection, i, RETRY_ATTEMPTS, SPARSE_READ_ATTEMPTS)
+                        else:
+                            result, read_sectors, missing_sector_list, round_lists[i], disk_dec = track_read( connection, i, RETRY_ATTEMPTS, FIRST_PASS_ATTEMPTS)
+                            attempts[i] = FIRST_PASS_ATTEMPTS
+                            if len( missing_sector_list) > 0:
+                                deferred.append( i)
+                    first_pass_steps = connection.head_steps - steps
+                    if len( deferred) > 0:
+                        print("Retrying incomplete tracks:", deferred)
+                        retry_time = retry_deferred_tracks( connection, deferred, attempts, round_lists)
+                    else:
+                        retry_time = 0.0
+                    steps = connection.head_steps - steps
+                    print("Head steps: ", steps, " (first pass: ", first_pass_steps, "). Retry time: ", "{0:.1f}s.".format( retry_time), sep='')
+                    
+                    # write tracks in order
+                    image = connection.track_cache.image()
                     i=0 
                     while i<disk_no_tracks:
                         info_text="Track: " + str(i) + ": "
-                        result, read_sectors, missing_sector_list, round_list, disk_dec = track_read( connection, i, RETRY_ATTEMPTS)
-                        if( read_sectors==MAX_SECTORS):
-                            info_text += "ok. "
+                        if i in skipped_tracks:
+                            missing_sector_list = list( range( MAX_SECTORS))
+                            disk_dec = bytes( TRACK_SIZE)
+                            info_text += "skipped (no allocated sectors in VTOC), zero filled.\n"
                         else:
-                            info_text += "corrupt sectors: " + str( missing_sector_list) +". "
-                        info_text += "List of round values: " + str( round_list) + ".\n"
+                            if i in free_tracks:
+                                info_text += "no allocated sectors in VTOC, read " + str( SPARSE_READ_ATTEMPTS) + " time(s). "
+                            missing_sector_list = image.missing_sectors( i)
+                            disk_dec = image.track_data( i)
+                            if( len( missing_sector_list) == 0):
+                                info_text += "ok. "
+                            else:
+                                info_text += "corrupt sectors: " + str( missing_sector_list) +". "
+                            info_text += "List of round values: " + str( round_lists[i]) + ".\n"
                         bin_file.write( disk_dec)               
+                        manifest.add_track( disk_dec, sector_status( missing_sector_list))
                         txt_file.write( info_text)
+                        for exporter in exporters:
+                            exporter.write_track( i, disk_dec, missing_sector_list)
                         i+=1 # move to next track              
+                    if len( skipped_tracks) > 0:
+                        txt_file.write( "Skipped tracks (zero filled): " + str( skipped_tracks) + ".\n")
+                    txt_file.write( "Head steps: " + str( steps) + " (first pass: " + str( first_pass_steps) + "). Retried tracks: " 
+                                    + str( deferred) + ". Retry time: " + "{0:.1f}s.\n".format( retry_time))
+                    close_exporters( exporters)
                 bin_file.close()  
                 txt_file.close() 
+                manifest.close()
+                if connection.track_cache.is_identified():
+                    capture_stats.meta["disk"] = "{0}/{1}".format( *connection.track_cache.current)
+                capture_stats.meta["mode"] = capture_mode
+                capture_stats.meta["head_steps"] = steps
+                capture_stats.meta["retry_time"] = round( retry_time, 1)
+                capture_stats.write( DISK_DIR_NAME + "/" + name + ".stats.npz")
+                print("Read statistics written to:", DISK_DIR_NAME + "/" + name + ".stats.npz")
+                result = disk_name
         #    except Exception as e:
        #        print("Error during generation of", disk_name, "or", disk_info, ".")
         #        print( str(e))
@@ -911,10 +2995,148 @@ def capture_dos_disk_to_host_file( connection):
             # configure target to leave single track read mode and enter main loop
                 connection.enter_main_loop()  # move back!!!!
         else:
-            print("Error: File", disk_name, "or", disk_info, "already exists.")
-    return
+            print("Error: File", disk_name, "or", disk_info, "or additional image already exists.")
+    connection.capture_stats = None
+    return result
   
 
+#--------------------------------------------------------------------------------------------------------------
+#
+# Capture selected files of a DOS 3.3 disk to host
+#
+# Only the catalog track and the sectors of the selected files are read: the track/sector lists are followed on the
+# drive, then the data sectors are read track by track in seek optimized order. Reading of a track stops as soon as 
+# the sectors of the selected files have been decoded.
+# Each file is written with the content of its data sectors (as stored by DOS, i.e. including length/address
+# header of A, I and B files) to DISK_DIR_NAME/<name>/<file name>.<file type>. Sectors which could not be decoded
+# are zero filled and listed in DISK_DIR_NAME/<name>/<name>.txt.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def seek_order( tracks, head_track):
+    """ returns <tracks> in the order with least head travel starting at <head_track> (one sweep in each direction) """
+    tracks = sorted( set( tracks))
+    if head_track is None:
+        return tracks
+    lower = [t for t in tracks if t < head_track]
+    upper = [t for t in tracks if t >= head_track]
+    if len( lower) == 0 or len( upper) == 0:
+        return upper + lower[::-1]
+    # move to the nearer end first
+    if( upper[-1] - head_track) <= (head_track - lower[0]):
+        return upper + lower[::-1]
+    return lower[::-1] + upper
+
+def host_file_name( file_entry):
+    """ returns name of host file for DOS 3.3 directory entry: file name and file type """
+    name = file_entry[0].rstrip()
+    for c in '/\\:*?"<>|':
+        name = name.replace( c, "_")
+    name = "".join( c if c.isprintable() else "_" for c in name)
+    return name + "." + file_entry[1].replace("*", "").strip()
+    
+def capture_files_to_host( connection):
+
+    if not connection.is_established():
+        if not connection.setup():
+            print("Cannot connect to drive.")
+            return
+            
+    user_input = input( "Insert disk. Enter a directory name for the extracted files: ")
+    connection.track_cache.begin_disk()
+    target_dir = DISK_DIR_NAME + "/" + user_input
+    if os.path.exists( target_dir):
+        print("Error:", target_dir, "already exists.")
+        return
+        
+    connection.enter_single_track_mode()
+    
+    # read catalog track
+    result, read_sectors, missing_sector_list, round_list, disk_dec = track_read( connection, DIR_TRACK, RETRY_ATTEMPTS)
+    disk_no_tracks, disk_no_sectors, disk_os_version = analyze_dir_track( missing_sector_list, disk_dec, True)
+    if( disk_os_version != 3) or (disk_dec[1] != DIR_TRACK):
+        print("No DOS 3.3 catalog found.")
+        connection.enter_main_loop()
+        return
+    directory = read_catalog( disk_dec)
+    
+    user_input = input( "Enter file names or patterns (* and ?), separated by ',': ")
+    patterns = [pattern.strip().upper() for pattern in user_input.split(",") if pattern.strip() != ""]
+    selected = [i for i in directory if any( fnmatch.fnmatchcase( i[0].rstrip(), pattern) for pattern in patterns)]
+    if len( selected) == 0:
+        print("No matching files.")
+        connection.enter_main_loop()
+        return
+        
+    track_cache = connection.track_cache  # decoded sectors are collected in the image of the disk in the drive
+    attempted = set()  # (track, sector) pairs searched for on the drive
+    
+    def read_file_sectors( track_no, sector_list):
+        """ reads the logical sectors <sector_list> of track <track_no> (sectors decoded before are taken from cache) """
+        track_read( connection, track_no, RETRY_ATTEMPTS, needed_sectors=sector_list)
+        attempted.update( (track_no, sector_no) for sector_no in sector_list)
+        
+    def get_sector( track_no, sector_no):
+        if( track_no >= MAX_TRACKS) or (sector_no >= MAX_SECTORS):
+            return b''
+        if not track_cache.image().is_valid( track_no, sector_no) and (track_no, sector_no) not in attempted:
+            read_file_sectors( track_no, [sector_no])
+        if not track_cache.image().is_valid( track_no, sector_no):
+            return b''
+        return track_cache.image().sector( track_no, sector_no)
+        
+    # follow track/sector lists of selected files on the drive
+    file_sector_lists = []
+    for i in selected:
+        print("Reading track/sector list of", i[0].rstrip())
+        file_sector_lists.append( read_file_sector_list( get_sector, i))
+        
+    # read data sectors in seek optimized order
+    needed = {}
+    for sector_list in file_sector_lists:
+        for kind, track_no, sector_no in sector_list:
+            if( kind == "data") and (track_no != 0) and (track_no < MAX_TRACKS) and (sector_no < MAX_SECTORS):
+                if not track_cache.image().is_valid( track_no, sector_no) and (track_no, sector_no) not in attempted:
+                    needed.setdefault( track_no, []).append( sector_no)
+    for track_no in seek_order( needed, connection.head_track):
+        read_file_sectors( track_no, sorted( set( needed[track_no])))
+        
+    connection.enter_main_loop()
+    
+    # write files and report
+    os.makedirs( target_dir, 0o700)
+    with open( target_dir + "/" + os.path.basename( target_dir) + ".txt", "w") as txt_file:
+        for i, sector_list in zip( selected, file_sector_lists):
+            data_sectors = [[track_no, sector_no] for kind, track_no, sector_no in sector_list if kind == "data"]
+            # trailing entries 0/0 are unused entries of the last track/sector list
+            while len( data_sectors) > 0 and data_sectors[-1] == [0, 0]:
+                data_sectors.pop()
+            content = bytearray()
+            missing = []
+            for track_no, sector_no in data_sectors:
+                sector = b''
+                if( track_no != 0):  # track 0 never holds file data: entry 0/0 is a hole in a random access file
+                    sector = get_sector( track_no, sector_no)
+                    if len( sector) != SECTOR_SIZE:
+                        missing.append([track_no, sector_no])
+                content += sector if len( sector) == SECTOR_SIZE else bytes( SECTOR_SIZE)
+            file_name = host_file_name( i)
+            while os.path.exists( target_dir + "/" + file_name):
+                file_name = "_" + file_name
+            with open( target_dir + "/" + file_name, "wb") as out_file:
+                out_file.write( content)
+            info_text = "{0} {1:03} {2}: {3} data sectors -> {4}. ".format( i[1], i[2], i[0].rstrip(), len( data_sectors), file_name)
+            if any( kind in ["INVALID", "INVALID CONT."] for kind, track_no, sector_no in sector_list):
+                info_text += "Track/sector list corrupt or incomplete. "
+            if len( missing) > 0:
+                info_text += "Sectors zero filled (could not be decoded): " + str( missing) + "."
+            else:
+                info_text += "ok."
+            print( info_text)
+            txt_file.write( info_text + "\n")
+    print("Files written to", target_dir)
+    return
+    
+
 #--------------------------------------------------------------------------------------------------------------
 #
 # Write disk catalog data to two .info files:
@@ -1005,10 +3227,11 @@ def generate_catalog_from_bin_file():
                             message = "Error: File length <" + File + "> invalid (" + str( len( disk_dec)) + " bytes).\n"
                             debug(message)                    
                         else:
+                            disk = DiskImage.from_bytes( disk_dec)
                             # generate disk table of contents
-                            disk_directory = read_catalog( disk_dec[track_offset: track_offset+TRACK_SIZE])
+                            disk_directory = read_catalog( disk.track_data( DIR_TRACK))
                             # generate list of sectors used by the files
-                            sector_list = read_sector_list (disk_dec, disk_directory)
+                            sector_list = read_sector_list (disk, disk_directory)
                             # write info to files
                             write_info_files( File, txt_file, txt_file_short, disk_directory, sector_list)
                                          
@@ -1020,13 +3243,685 @@ def generate_catalog_from_bin_file():
         return 
 
 
+#--------------------------------------------------------------------------------------------------------------
+#
+# Show read statistics of all captures in DISK_DIR_NAME (*.stats.npz)
+#
+# Prints per drive the share of reads which recovered sectors for each round value and the tracks whose number of reads 
+# or missing sectors increased between the first and the last capture of the same disk.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def show_capture_statistics():
+    file_names = sorted( glob.glob( DISK_DIR_NAME + "/*.stats.npz"))
+    if len( file_names) == 0:
+        print("No capture statistics found in", DISK_DIR_NAME)
+        return
+    start = time.time()
+    metas, table = collect_capture_stats( file_names)
+    print(len( metas), "captures,", len( table["track"]), "read attempts loaded in", "{0:.2f}s.".format( time.time() - start))
+    
+    for drive, rounds in sorted( round_value_statistics( metas, table).items()):
+        print("\nDrive:", drive)
+        print("Round value   Reads   Successful   Recovered sectors")
+        for round_value in sorted( rounds):
+            reads, hits, sectors = rounds[round_value]
+            print("{0:11}   {1:5}   {2:9.1f}%   {3:17}".format( round_value, reads, 100.0 * hits / reads, sectors))
+            
+    degrading = []
+    for (disk, track_no), history in track_trends( metas, table).items():
+        if len( history) > 1:
+            first, last = history[0], history[-1]
+            if( last[2] > first[2]) or (last[1] > first[1]):
+                degrading.append( (last[2] - first[2], last[1] - first[1], disk, track_no, history))
+    if len( degrading) > 0:
+        print("\nTracks needing more reads or with more missing sectors than in the first capture of the disk:")
+        for missing, reads, disk, track_no, history in sorted( degrading, reverse=True):
+            print("Disk", disk, "track", track_no, ": reads", [h[1] for h in history], ", missing sectors", [h[2] for h in history])
+    print("")
+    return
+
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Verify images in DISK_DIR_NAME against their manifests
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def verify_archive():
+    user_input = input( "Enter image file name or pattern, e.g. *.bin (return for all images): ")
+    if user_input.strip() == "":
+        user_input = "*"
+    manifest_names = sorted( glob.glob( DISK_DIR_NAME + "/" + user_input.strip() + MANIFEST_SUFFIX))
+    if len( manifest_names) == 0:
+        print("No manifests found.")
+        return
+    start = time.time()
+    results = verify_images( manifest_names)
+    failed = 0
+    for image_name, bad_tracks, bad_sectors, error in results:
+        if error is not None:
+            print(image_name, ": error:", error)
+        elif len( bad_tracks) > 0:
+            print(image_name, ": tracks differ:", bad_tracks, end="")
+            if len( bad_sectors) > 0:
+                print(", sectors [track, sector]:", bad_sectors, end="")
+            print("")
+        else:
+            continue
+        failed += 1
+    print(len( results), "image(s) verified in", "{0:.2f}s,".format( time.time() - start), failed, "failed.")
+    return
+    
+    
+#--------------------------------------------------------------------------------------------------------------
+#
+# Compare two captures in DISK_DIR_NAME using their manifests
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def compare_captures():
+    name_a = input( "Enter first image file name (e.g. disk1.bin): ")
+    name_b = input( "Enter second image file name (e.g. disk2.bin): ")
+    try:
+        manifest_a = read_manifest( DISK_DIR_NAME + "/" + name_a + MANIFEST_SUFFIX)
+        manifest_b = read_manifest( DISK_DIR_NAME + "/" + name_b + MANIFEST_SUFFIX)
+    except Exception as e:
+        print("Error when trying to read manifest.")
+        print( str( e))
+        return
+    if( manifest_a["track_size"] != manifest_b["track_size"]) or (manifest_a["sector_size"] != manifest_b["sector_size"]):
+        print("Images have different formats.")
+        return
+    differences = compare_manifests( manifest_a, manifest_b)
+    for track_no, sectors, only_a, only_b in differences:
+        info_text = "Track " + str( track_no) + " differs."
+        if len( sectors) > 0:
+            info_text += " Sectors: " + str( sectors) + "."
+        if len( only_a) > 0:
+            info_text += " Decoded only in " + name_a + ": " + str( only_a) + "."
+        if len( only_b) > 0:
+            info_text += " Decoded only in " + name_b + ": " + str( only_b) + "."
+        print( info_text)
+    if len( differences) == 0:
+        print("Captures are identical.")
+    return
+    
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Check DOS 3.3 structures of the images in DISK_DIR_NAME (see check_image())
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def check_archive():
+    user_input = input( "Enter image file name or pattern, e.g. game*.bin (return for all .bin images): ")
+    if user_input.strip() == "":
+        user_input = "*.bin"
+    file_names = [name for name in sorted( glob.glob( DISK_DIR_NAME + "/" + user_input.strip())) if name.endswith( ".bin")]
+    if len( file_names) == 0:
+        print("No images found.")
+        return
+    start = time.time()
+    results = check_images( file_names)
+    failed = 0
+    for image_name, problems, error in results:
+        if error is not None:
+            print(image_name, ": error:", error)
+        elif len( problems) > 0:
+            print(image_name, ":", sep='')
+            for check, text in problems:
+                print("   ", check + ":", text)
+        else:
+            continue
+        failed += 1
+    print(len( results), "image(s) checked in", "{0:.2f}s,".format( time.time() - start), failed, "with problems.")
+    return
+    
+    
+#--------------------------------------------------------------------------------------------------------------
+#
+# Merge several captures in DISK_DIR_NAME into one best image (see merge_captures())
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def merge_captures_to_bin_file():
+    user_input = input( "Enter captures to merge (file names or patterns incl. .raw/.bin, separated by blanks): ")
+    file_names = []
+    for pattern in user_input.split():
+        for name in sorted( glob.glob( DISK_DIR_NAME + "/" + pattern)):
+            if name.endswith( (".raw", ".bin")) and name not in file_names:
+                file_names.append( name)
+    if len( file_names) < 2:
+        print("At least two captures needed. Found:", file_names)
+        return
+    user_input = input( "Enter a filename for the merged disk (.bin is appended automatically): ")
+    disk_name = DISK_DIR_NAME + "/" + user_input + ".bin"
+    if os.path.isfile( disk_name):
+        print("Error: File", disk_name, "already exists.")
+        return
+    
+    start = time.time()
+    captures = []
+    names = []
+    for file_name, data, valid, verified, error in load_captures( file_names):
+        if error is not None:
+            print(file_name, ": error:", error, "(skipped)")
+            continue
+        print(file_name, ": ", sum( bin( mask).count("1") for mask in verified), " verified sectors, ", 
+              sum( bin( mask).count("1") for mask in valid), " usable sectors.", sep='')
+        captures.append( (data, valid, verified))
+        names.append( os.path.basename( file_name))
+    if len( captures) == 0:
+        return
+    image, provenance = merge_captures( captures)
+    
+    # number of tracks from VTOC of the merged image (as 'c'), otherwise largest .bin capture
+    print("")
+    disk_no_tracks, disk_no_sectors, disk_os_version = analyze_dir_track( image.missing_sectors( DIR_TRACK), image.track_data( DIR_TRACK), False)
+    if( disk_os_version != 3) or not (0 < disk_no_tracks <= image.no_tracks):
+        disk_no_tracks = max( [DEF_TRACKS] + [len( valid) for name, (data, valid, verified) in zip( names, captures) if name.endswith( ".bin")])
+        disk_no_tracks = min( disk_no_tracks, image.no_tracks)
+    for track_no in range( disk_no_tracks):
+        sources = provenance["tracks"][track_no]
+        missing = [j for j in range( MAX_SECTORS) if sources[j] < 0]
+        unverified = [j for j in range( MAX_SECTORS) if sources[j] >= 0 and not (provenance["verified"][track_no] >> j) & 1]
+        info_text = "Track " + str( track_no) + ": sectors from captures " + str( sorted( set( sources) - {-1})) + "."
+        if len( missing) > 0:
+            info_text += " Missing: " + str( missing) + "."
+        if len( unverified) > 0:
+            info_text += " Not verified: " + str( unverified) + "."
+        print( info_text)
+    provenance["tracks"] = provenance["tracks"][:disk_no_tracks]
+    provenance["verified"] = provenance["verified"][:disk_no_tracks]
+    provenance["conflicts"] = [conflict for conflict in provenance["conflicts"] if conflict[0] < disk_no_tracks]
+    for track_no, sector_no, indices in provenance["conflicts"]:
+        print("Track ", track_no, ", sector ", sector_no, ": captures differ ", str( indices), ".", sep='')
+
+    try:
+        with open( disk_name, "wb") as bin_file:
+            bin_file.write( image.view[:disk_no_tracks * TRACK_SIZE])
+        manifest = ImageManifest( disk_name)
+        for track_no in range( disk_no_tracks):
+            manifest.add_track( image.track_data( track_no), provenance["verified"][track_no])
+        manifest.close()
+        with open( disk_name + PROVENANCE_SUFFIX, "w") as provenance_file:
+            json.dump( dict( version=VERSION, image=os.path.basename( disk_name), captures=names, **provenance), provenance_file, indent=1)
+    except Exception as e:
+        print("Error when trying to write ", disk_name,".")   
+        print( str(e))
+        return
+    missing = sum( MAX_SECTORS - bin( mask).count("1") for mask in provenance["verified"])
+    print("\nMerged", len( captures), "captures in", "{0:.2f}s.".format( time.time() - start), missing, "sector(s) missing or not verified.")
+    print("Output written to:", disk_name, "and", disk_name + PROVENANCE_SUFFIX)
+    return
+    
+
+#--------------------------------------------------------------------------------------------------------------
+#
+# Forget all decoded sectors kept in the session cache
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def clear_track_cache( connection):
+    connection.track_cache.clear()
+    print("Track cache cleared.")
+    return
+
 def shutdown_and_reset( connection):     
-    """ restarts serial connection to Arduino board (target) """
+    """ restarts serial connection to Arduino board (target); the port used before is probed first """
     connection.shutdown()
     print("Trigger board reset")
     connection.setup()
     return
     
+#--------------------------------------------------------------------------------------------------------------
+#
+# Capture daemon (treckr.py --daemon [port])
+#
+# The daemon keeps the serial connection to the board open and runs jobs submitted via a local HTTP API (JSON):
+#   GET  /status              port of the board, running job and number of queued jobs
+#   POST /jobs                submit job {"type": <job type>, <parameters>}; returns job info with id
+#   GET  /jobs                list of all jobs
+#   GET  /jobs/<id>           job info: type, parameters, state (queued, running, done, failed), result, error
+#   GET  /jobs/<id>/events    progress of the job as text lines; streamed until the job is finished
+# Job types and parameters (see DAEMON_JOBS, checked by check_job_params(); name and pattern must not contain a path separator
+# or ..):
+#   capture:  name, export_formats, capture_mode,  (as 'c'; result: name of .bin file)
+#             duplicates                           (disk already archived: "capture", "skip" or "verify", see find_duplicate())
+#   triage:   -                                    (as 'q'; result: missing sectors per track)
+#   decode:   name, export_formats                 (as 'r'; result: name of .bin file)
+#   verify:   pattern                              (as 'v'; result: list of [image, tracks, sectors, error])
+#   check:    pattern                              (as 'k'; result: list of [image, problems, error])
+# Jobs using the drive run one after another on one thread, progress is the text they print. Decode, verify and 
+# check jobs run in a process pool, in parallel to drive jobs; the text they print is sent back to the daemon via a 
+# queue of a multiprocessing manager (see run_pool_job()).
+# Example: curl -H "Content-Type: application/json" -d '{"type": "capture", "name": "disk1"}' http://127.0.0.1:8642/jobs
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def verify_job( pattern="*"):
+    """ verifies images matching <pattern> in DISK_DIR_NAME; returns list of results of verify_image() """
+    return verify_images( sorted( glob.glob( DISK_DIR_NAME + "/" + pattern + MANIFEST_SUFFIX)))
+
+def check_job( pattern="*.bin"):
+    """ checks DOS 3.3 structures of images matching <pattern> in DISK_DIR_NAME; returns list of results of check_image() """
+    return check_images( sorted( glob.glob( DISK_DIR_NAME + "/" + pattern)))
+
+# job type -> (function, True if function uses the drive, allowed parameters)
+DAEMON_JOBS = {"capture": (capture_dos_disk, True, ["name", "export_formats", "capture_mode", "duplicates"]),
+               "triage":  (quick_scan_disk, True, []),
+               "decode":  (decode_raw_disk, False, ["name", "export_formats"]),
+               "verify":  (verify_job, False, ["pattern"]),
+               "check":   (check_job, False, ["pattern"])}
+
+def check_job_params( job_type, params):
+    """ raises ValueError if <params> (dict) are not valid parameters of job <job_type> """
+    if job_type not in DAEMON_JOBS:
+        raise ValueError( "unknown job type " + str( job_type))
+    function, uses_drive, param_names = DAEMON_JOBS[job_type]
+    for key in params:
+        if key not in param_names:
+            raise ValueError( "unknown parameter " + str( key) + " of job type " + job_type)
+    if ("name" in param_names) and ("name" not in params):
+        raise ValueError( "parameter name missing")
+    for key in ["name", "pattern"]:
+        if key in params:
+            value = params[key]
+            if( not isinstance( value, str)) or (value == "") or (".." in value) or ("/" in value) or ("\\" in value) or (os.sep in value):
+                raise ValueError( "invalid " + key + " " + json.dumps( value) + ", must not be empty or contain a path separator or ..")
+    export_formats = params.get( "export_formats", [])
+    if( not isinstance( export_formats, list)) or any( name not in EXPORTERS for name in export_formats):
+        raise ValueError( "invalid export_formats, must be a list of " + ", ".join( EXPORTERS))
+    if params.get( "capture_mode", "f") not in ["f", "s", "z"]:
+        raise ValueError( "invalid capture_mode, must be f, s or z")
+    if params.get( "duplicates", "capture") not in ["capture", "skip", "verify"]:
+        raise ValueError( "invalid duplicates, must be capture, skip or verify")
+
+class Job:
+    def __init__( self, job_id, job_type, params):
+        self.id      = job_id
+        self.type    = job_type
+        self.params  = params
+        self.state   = "queued"
+        self.result  = None
+        self.error   = None
+        self.events  = []   # progress lines
+        self.partial = ""   # text printed after the last complete line
+        self.changed = threading.Condition()
+        
+    def write( self, text):
+        """ adds printed <text> to the progress lines """
+        with self.changed:
+            lines = (self.partial + text).replace("\r", "\n").split("\n")
+            self.partial = lines.pop()
+            self.events += [line.rstrip() for line in lines if line.strip() != ""]
+            self.changed.notify_all()
+            
+    def set_state( self, state, result=None, error=None):
+        with self.changed:
+            if( state in ["done", "failed"]) and (self.partial.strip() != ""):
+                self.events.append( self.partial.rstrip())
+                self.partial = ""
+            self.state  = state
+            self.result = result
+            self.error  = error
+            self.changed.notify_all()
+            
+    def is_finished( self):
+        return self.state in ["done", "failed"]
+        
+    def info( self):
+        return {"id": self.id, "type": self.type, "params": self.params, "state": self.state, 
+                "result": self.result, "error": self.error, "events": len( self.events)}
+                
+class JobOutput:
+    """ replaces sys.stdout in the daemon: text printed by the drive thread is recorded as progress of the running job """
+    def __init__( self, stream):
+        self.stream = stream
+        self.job    = None  # job running on the drive thread
+        self.thread = None  # drive thread
+        
+    def write( self, text):
+        if( self.job is not None) and (threading.current_thread() is self.thread):
+            self.job.write( text)
+            return len( text)
+        return self.stream.write( text)
+        
+    def flush( self):
+        self.stream.flush()
+        
+class PoolJobOutput:
+    """ replaces sys.stdout in a pool process: printed text is sent to the daemon as progress of job <job_id> """
+    def __init__( self, events, job_id):
+        self.events = events
+        self.job_id = job_id
+        
+    def write( self, text):
+        self.events.put( (self.job_id, text))
+        return len( text)
+        
+    def flush( self):
+        pass
+        
+def run_pool_job( events, job_id, job_type, params):
+    """ runs job <job_id> of <job_type> with <params> in a pool process; text it prints is put on queue <events> """
+    function, uses_drive, param_names = DAEMON_JOBS[job_type]
+    stdout = sys.stdout
+    sys.stdout = PoolJobOutput( events, job_id)
+    try:
+        return function( **params)
+    finally:
+        sys.stdout = stdout
+        
+class CaptureDaemon:
+    def __init__( self):
+        self.connection = SerialConnection()
+        self.jobs     = {}
+        self.lock     = threading.Lock()
+        self.queue    = queue.Queue()   # jobs waiting for the drive
+        self.executor = concurrent.futures.ProcessPoolExecutor()
+        self.manager  = multiprocessing.Manager()
+        self.events   = self.manager.Queue()    # (job id, text printed by a pool job or None when the job is finished)
+        self.futures  = {}                      # job id -> future of running pool job
+        self.output   = JobOutput( sys.stdout)
+        sys.stdout    = self.output
+        self.output.thread = threading.Thread( target=self.run_drive_jobs, daemon=True)
+        self.output.thread.start()
+        threading.Thread( target=self.forward_pool_events, daemon=True).start()
+        
+    def submit( self, job_type, params):
+        """ queues job <job_type> with <params> (dict); returns Job """
+        check_job_params( job_type, params)
+        function, uses_drive, param_names = DAEMON_JOBS[job_type]
+        with self.lock:
+            job = Job( len( self.jobs) + 1, job_type, params)
+            self.jobs[job.id] = job
+        if uses_drive:
+            self.queue.put( job)
+        else:
+            job.set_state( "running")
+            future = self.executor.submit( run_pool_job, self.events, job.id, job_type, params)
+            with self.lock:
+                self.futures[job.id] = future
+            # queued behind the text the job has printed, so the job is finished after its last progress line
+            future.add_done_callback( lambda future: self.events.put( (job.id, None)))
+        return job
+        
+    def forward_pool_events( self):
+        """ adds text printed by pool jobs to the progress of the jobs; finishes a job after its last line """
+        while True:
+            try:
+                job_id, text = self.events.get()
+            except (EOFError, OSError): # manager shut down
+                return
+            if text is not None:
+                self.jobs[job_id].write( text)
+            else:
+                with self.lock:
+                    future = self.futures.pop( job_id)
+                self.finish_pool_job( self.jobs[job_id], future)
+        
+    def finish_pool_job( self, job, future):
+        try:
+            job.set_state( "done", job_result( future.result()))
+        except Exception as e:
+            job.set_state( "failed", error=str( e))
+            
+    def run_drive_jobs( self):
+        """ runs the drive jobs one after another; the serial connection stays open between the jobs """
+        while True:
+            job = self.queue.get()
+            function, uses_drive, param_names = DAEMON_JOBS[job.type]
+            job.set_state( "running")
+            self.output.job = job
+            try:
+                if not self.connection.is_established():
+                    if not self.connection.setup():
+                        raise RuntimeError( "cannot connect to drive")
+                job.set_state( "done", job_result( function( self.connection, **job.params)))
+            except (Exception, SystemExit) as e:
+                job.set_state( "failed", error=str( e))
+            self.output.job = None
+            
+    def status( self):
+        running = self.output.job
+        return {"version": VERSION, "port": self.connection.port, "connected": self.connection.is_established(), 
+                "running": None if running is None else running.id, "queued": self.queue.qsize()}
+                
+def job_result( result):
+    """ returns <result> of a job function as JSON compatible value """
+    return json.loads( json.dumps( result, default=str))
+
+class DaemonRequestHandler( http.server.BaseHTTPRequestHandler):
+    daemon = None # CaptureDaemon serving the requests
+    
+    def send_json( self, data, status=200):
+        body = json.dumps( data).encode( "utf-8")
+        self.send_response( status)
+        self.send_header( "Content-Type", "application/json")
+        self.send_header( "Content-Length", str( len( body)))
+        self.end_headers()
+        self.wfile.write( body)
+        
+    def find_job( self, job_id):
+        try:
+            return self.daemon.jobs.get( int( job_id))
+        except ValueError:
+            return None
+        
+    def do_GET( self):
+        path = self.path.strip("/").split("/")
+        if path == ["status"]:
+            self.send_json( self.daemon.status())
+        elif path == ["jobs"]:
+            self.send_json( [job.info() for job in list( self.daemon.jobs.values())])
+        elif( len( path) in [2, 3]) and (path[0] == "jobs") and (self.find_job( path[1]) is not None):
+            job = self.find_job( path[1])
+            if len( path) == 2:
+                self.send_json( job.info())
+            elif path[2] == "events":
+                self.stream_events( job)
+            else:
+                self.send_json( {"error": "not found"}, 404)
+        else:
+            self.send_json( {"error": "not found"}, 404)
+            
+    def do_POST( self):
+        if self.path.strip("/") != "jobs":
+            self.send_json( {"error": "not found"}, 404)
+            return
+        if self.headers.get_content_type() != "application/json":
+            self.send_json( {"error": "Content-Type must be application/json"}, 415)
+            return
+        try:
+            params = json.loads( self.rfile.read( int( self.headers.get( "Content-Length", 0))) or b"{}")
+            if not isinstance( params, dict):
+                raise ValueError( "job must be a JSON object")
+            job_type = params.pop( "type", None)
+            job = self.daemon.submit( job_type, params)
+        except Exception as e:
+            self.send_json( {"error": str( e)}, 400)
+            return
+        self.send_json( job.info(), 201)
+        
+    def stream_events( self, job):
+        """ sends the progress lines of <job> as they are printed until the job is finished """
+        self.send_response( 200)
+        self.send_header( "Content-Type", "text/plain; charset=utf-8")
+        self.end_headers()
+        sent = 0
+        while True:
+            with job.changed:
+                while( sent == len( job.events)) and not job.is_finished():
+                    job.changed.wait()
+                lines = job.events[sent:]
+                finished = job.is_finished()
+            for line in lines:
+                self.wfile.write( (line + "\n").encode( "utf-8"))
+            self.wfile.flush()
+            sent += len( lines)
+            if finished and (sent == len( job.events)):
+                break
+                
+    def log_message( self, format, *args):
+        debug( "Debug: daemon: " + (format % args))
+        
+def run_daemon( port=DAEMON_PORT):
+    """ runs the capture daemon until interrupted """
+    daemon = CaptureDaemon()
+    DaemonRequestHandler.daemon = daemon
+    server = http.server.ThreadingHTTPServer( (DAEMON_HOST, port), DaemonRequestHandler)
+    print("treckr daemon ", VERSION, " listening on http://", DAEMON_HOST, ":", port, sep='')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    daemon.executor.shutdown( wait=False)
+    daemon.manager.shutdown()
+    daemon.connection.shutdown()
+    return
+   
+   
+#--------------------------------------------------------------------------------------------------------------
+#
+# Watch folder service (treckr.py --watch [interval])
+#
+# The service scans DISK_DIR_NAME every WATCH_INTERVAL seconds. New or changed .raw files are decoded as by 'r' 
+# (.bin file and manifest, no additional image formats) in a process pool; a file is taken as soon as its size and
+# modification time have not changed since the previous scan (captures still being written are not decoded).
+# The catalog index of 'g' (WATCH_CATALOG_NAME.info, WATCH_CATALOG_NAME_with_sector_list.info) is kept up to date for 
+# all .bin files; only new or changed .bin files are read.
+# The state is stored in DISK_DIR_NAME/WATCH_STATE (JSON, replaced in one step after each change):
+#   raw:     per .raw file: size and modification time when decoded, name of the .bin file (None if decoding failed)
+#   images:  per .bin file: size, modification time, catalog and track/sector lists (see read_catalog(), read_sector_list())
+# After a restart only files changed since are processed. A .raw file which is not in the state is not decoded again
+# if its .bin file has a manifest written after the .raw file (decoded by 'r', or before the service was stopped).
+# Stop the service with Ctrl-C.
+#
+# ------------------------------------------------------------------------------------------------------------- 
+def write_json_atomic( file_name, data):
+    """ writes <data> as JSON to <file_name>; the file is replaced in one step, so it is never left half written """
+    temp_name = file_name + ".tmp"
+    with open( temp_name, "w") as json_file:
+        json.dump( data, json_file, indent=1)
+        json_file.flush()
+        os.fsync( json_file.fileno())
+    os.replace( temp_name, file_name)
+    
+def read_watch_state( state_name):
+    try:
+        with open( state_name, "r") as state_file:
+            state = json.load( state_file)
+    except Exception:
+        state = {}
+    state.setdefault( "raw", {})
+    state.setdefault( "images", {})
+    return state
+    
+def catalog_image( file_name):
+    """ returns catalog and track/sector lists of .bin image <file_name> (as written to the .info files by 'g') """
+    with open( file_name, "rb") as bin_file:
+        disk_dec = bytearray( bin_file.read())
+    if( len( disk_dec) < DIR_TRACK * TRACK_SIZE) or (len( disk_dec) > MAX_TRACKS * TRACK_SIZE):
+        return [], []
+    disk = DiskImage.from_bytes( disk_dec)
+    directory = read_catalog( disk.track_data( DIR_TRACK))
+    return directory, read_sector_list( disk, directory)
+    
+def write_watch_catalog( images):
+    """ writes the catalog index of the .bin files <images> (see read_watch_state()) """
+    disk_info_short = DISK_DIR_NAME + "/" + WATCH_CATALOG_NAME + ".info"
+    disk_info       = DISK_DIR_NAME + "/" + WATCH_CATALOG_NAME + "_with_sector_list.info"
+    with open( disk_info + ".tmp", "w") as txt_file, \
+         open( disk_info_short + ".tmp", "w") as txt_file_short:
+        for name in sorted( images):
+            write_info_files( name, txt_file, txt_file_short, images[name]["directory"], images[name]["sector_list"])
+    os.replace( disk_info + ".tmp", disk_info)
+    os.replace( disk_info_short + ".tmp", disk_info_short)
+    
+def update_watch_images( images, files, busy):
+    """ updates catalogs of new or changed .bin files in <files> (name -> stat), except <busy>; returns True if changed """
+    changed = False
+    for name, stat in files.items():
+        if( not name.endswith( ".bin")) or (name in busy):
+            continue
+        entry = images.get( name)
+        if( entry is not None) and (entry["size"] == stat.st_size) and (entry["mtime"] == stat.st_mtime):
+            continue
+        try:
+            directory, sector_list = catalog_image( DISK_DIR_NAME + "/" + name)
+        except OSError as e:
+            print("Error when trying to read", name, ":", str( e))
+            continue
+        images[name] = {"size": stat.st_size, "mtime": stat.st_mtime, "directory": directory, "sector_list": sector_list}
+        changed = True
+    for name in [name for name in images if name not in files]:
+        del images[name]
+        changed = True
+    return changed
+    
+def run_watch( interval=WATCH_INTERVAL):
+    """ decodes new or changed .raw files in DISK_DIR_NAME and updates the catalog index until stopped with Ctrl-C """
+    if not os.path.isdir( DISK_DIR_NAME):
+        print("Directory", DISK_DIR_NAME, "not found.")
+        return
+    state_name = DISK_DIR_NAME + "/" + WATCH_STATE
+    state = read_watch_state( state_name)
+    last_seen = {}  # .raw file -> [size, modification time] at the previous scan
+    running = {}    # future of decode_raw_disk() -> (.raw file, [size, modification time])
+    print("Watching", DISK_DIR_NAME, "for .raw files every", interval, "s. Stop with Ctrl-C.")
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        try:
+            while True:
+                changed = False
+                # decoded .raw files
+                for future in [future for future in running if future.done()]:
+                    name, key = running.pop( future)
+                    try:
+                        bin_name = future.result()
+                    except Exception as e:
+                        print("Error when decoding", name, ":", str( e))
+                        bin_name = None
+                    state["raw"][name] = {"size": key[0], "mtime": key[1], "bin": None if bin_name is None else os.path.basename( bin_name)}
+                    changed = True
+                    print("Decoded", name, "->", bin_name)
+                    
+                files = {entry.name: entry.stat() for entry in os.scandir( DISK_DIR_NAME) if entry.is_file()}
+                busy = [name for name, key in running.values()]
+                # new or changed .raw files
+                for name, stat in files.items():
+                    if( not name.endswith( ".raw")) or (name in busy):
+                        continue
+                    key = [stat.st_size, stat.st_mtime]
+                    done = state["raw"].get( name)
+                    if( done is not None) and ([done["size"], done["mtime"]] == key):
+                        continue
+                    if last_seen.get( name) != key:
+                        # file is new or still being written; decode it when it is unchanged at the next scan
+                        last_seen[name] = key
+                        continue
+                    manifest_name = name[:-4] + ".bin" + MANIFEST_SUFFIX
+                    if( done is None) and (manifest_name in files) and (files[manifest_name].st_mtime >= stat.st_mtime):
+                        # decoded before
+                        state["raw"][name] = {"size": key[0], "mtime": key[1], "bin": name[:-4] + ".bin"}
+                        changed = True
+                        continue
+                    print("Decoding", name, "...")
+                    running[executor.submit( decode_raw_disk, name[:-4])] = (name, key)
+                    busy.append( name)
+                    
+                # catalog index of the .bin files (except files being written by decode_raw_disk())
+                if update_watch_images( state["images"], files, [name[:-4] + ".bin" for name in busy]) or \
+                   not os.path.isfile( DISK_DIR_NAME + "/" + WATCH_CATALOG_NAME + ".info"):
+                    write_watch_catalog( state["images"])
+                    changed = True
+                if changed:
+                    write_json_atomic( state_name, state)
+                    
+                if len( running) > 0:
+                    concurrent.futures.wait( list( running), timeout=interval, return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    time.sleep( interval)
+        except KeyboardInterrupt:
+            print("Watch folder service stopped.")
+    return
+   
+   
 #--------------------------------------------------------------------------------------------------------------
 #
 # List command options
@@ -1041,9 +3936,17 @@ def list_commands():
     print("[q]: quick scan. Reads tracks 0-4 and 17 to determine disk status")
     print("[d]: read disk VTOC and show table of contents (DOS 3.3)")
     print("[c]: capture disk in DOS3.3 format (.bin)")
+    print("[f]: capture selected files of disk (DOS 3.3)")
     print("[a]: capture disk in raw format (.raw)")
     print("[r]: analyze .raw file and store result in .bin file")
     print("[g]: read .bin file and write table of contents to .info file")
+    print("[s]: show read statistics of all captures")
+    print("[v]: verify images against their manifests")
+    print("[m]: compare two captures (using their manifests)")
+    print("[M]: merge several captures of a disk (.raw/.bin) into one best image")
+    print("[k]: check DOS 3.3 structures of images (VTOC, catalog, track/sector lists, free sector bitmap)")
+    print("[b]: benchmark serial link (plain and packed track transfer)")
+    print("[x]: clear track cache (decoded sectors of disks read in this session)")
     print("[R]: reset board (resetting serial connection)")
     print("[e]: exit")
     return
@@ -1054,45 +3957,63 @@ def list_commands():
 # Main command loop
 #
 # ------------------------------------------------------------------------------------------------------------- 
-print("")
-print("------------------------------------------------------------------------------")
-print("          treckr:       Apple II Disk Recovery Tool                           ")
-print("                                                                              ")
-print("          ", VERSION,sep='')
-print("                                                                              ")
-print("          Tool to read DOS 3.3 formatted 5.25 inch disks with 35/40 tracks    ")
-print("          Please carefully study the README file                              ")
-print("                                                                              ")
-print(" NOTE:    -> BEFORE USAGE, ALWAYS CHECK THE DRIVE POWER SUPPLY AND THE      <-")
-print("          -> WIRING FROM BOARD TO DRIVE. YOU NEED A DEDICATED POWER SUPPLY  <-")
-print("          -> FOR THE DISK DRIVE TO PROVIDE +12V,-12V, +5V and GND.          <-")
-print("          -> INCORRECT WIRING MAY DAMAGE DRIVE, DISKS, BOARD AND/OR HOST    <-")
-print("          -> ALWAYS WRITE PROTECT DISKS BEFORE INSERTING THEM IN THE DRIVE. <-")
-print("                                                                              ")
-print("------------------------------------------------------------------------------")
-print("")
-
-connection = SerialConnection()
-
-f_group1 = {"l": list_commands,
-            "e": exit,
-            "g": generate_catalog_from_bin_file,
-            "r": analyze_raw_disk_from_bin_file}
-
-f_group2 = {"t": test_serial,
-            "q": quick_scan,
-            "d": _read_disk_directory,
-            "c": capture_dos_disk_to_host_file,
-            "a": capture_raw_disk_to_host_file,
-            "R": shutdown_and_reset }
-
-while True:
-    command = (input( "Choose a command ([l] list options): "))
+if __name__ == "__main__":
+    if "--daemon" in sys.argv:
+        args = sys.argv[sys.argv.index( "--daemon") + 1:]
+        run_daemon( int( args[0]) if len( args) > 0 and args[0].isdigit() else DAEMON_PORT)
+        sys.exit()
+    if "--watch" in sys.argv:
+        args = sys.argv[sys.argv.index( "--watch") + 1:]
+        run_watch( float( args[0]) if len( args) > 0 and args[0].replace( ".", "", 1).isdigit() else WATCH_INTERVAL)
+        sys.exit()
+        
+    print("")
+    print("------------------------------------------------------------------------------")
+    print("          treckr:       Apple II Disk Recovery Tool                           ")
+    print("                                                                              ")
+    print("          ", VERSION,sep='')
+    print("                                                                              ")
+    print("          Tool to read DOS 3.3 formatted 5.25 inch disks with 35/40 tracks    ")
+    print("          Please carefully study the README file                              ")
+    print("                                                                              ")
+    print(" NOTE:    -> BEFORE USAGE, ALWAYS CHECK THE DRIVE POWER SUPPLY AND THE      <-")
+    print("          -> WIRING FROM BOARD TO DRIVE. YOU NEED A DEDICATED POWER SUPPLY  <-")
+    print("          -> FOR THE DISK DRIVE TO PROVIDE +12V,-12V, +5V and GND.          <-")
+    print("          -> INCORRECT WIRING MAY DAMAGE DRIVE, DISKS, BOARD AND/OR HOST    <-")
+    print("          -> ALWAYS WRITE PROTECT DISKS BEFORE INSERTING THEM IN THE DRIVE. <-")
+    print("                                                                              ")
+    print("------------------------------------------------------------------------------")
+    print("")
+
+    connection = SerialConnection()
+
+    f_group1 = {"l": list_commands,
+                "e": exit,
+                "g": generate_catalog_from_bin_file,
+                "s": show_capture_statistics,
+                "v": verify_archive,
+                "m": compare_captures,
+                "M": merge_captures_to_bin_file,
+                "k": check_archive,
+                "r": analyze_raw_disk_from_bin_file}
+
+    f_group2 = {"t": test_serial,
+                "q": quick_scan,
+                "d": _read_disk_directory,
+                "c": capture_dos_disk_to_host_file,
+                "f": capture_files_to_host,
+                "a": capture_raw_disk_to_host_file,
+                "x": clear_track_cache,
+                "b": benchmark_link,
+                "R": shutdown_and_reset }
+
+    while True:
+        command = (input( "Choose a command ([l] list options): "))
  
-    if command in f_group1:
-        f_group1[command]()
-    elif command in f_group2:
-        f_group2[command]( connection)                	
-    else:
-        print("Unknown command")
+        if command in f_group1:
+            f_group1[command]()
+        elif command in f_group2:
+            f_group2[command]( connection)                	
+        else:
+            print("Unknown command")
  
@@ -34,6 +34,10 @@ void hw_delay_us( word);
 void track_motor_all_phases_off();
 void reset_hw_drive_state( void);
 void capture_track( void);
+void capture_flux( void);
+void send_packed_symbol( byte);
+word packed_symbol_count( void);
+void send_packed_track( void);
 void test_serial( void);
 void init_DELAY_default(void);
 void set_DELAY_slow(void);
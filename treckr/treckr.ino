@@ -72,18 +72,55 @@
 #define HOST_BAUD_RATE   (500000) // default baud rate, needs to be configured on host as well!
 
 #define COMMAND_READ     (0x80)
+#define COMMAND_READ_FLUX (0x90)
+#define COMMAND_READ_PACKED  (0x81)
+#define COMMAND_READ_SECTOR  (0x82)
+#define COMMAND_CAPABILITIES (0xB0)
 #define COMMAND_TEST     (0xA0)
 #define COMMAND_FINISH   (0xF0)
 
 #define RESPONSE_OK      (0x40)
 #define RESPONSE_FINISH  (0x60)
 #define RESPONSE_ERROR   (0xEF)
+#define RESPONSE_NOT_FOUND (0x44)
+
+#define CAPABILITY_PACKED (0x01) // COMMAND_READ_PACKED supported
+#define CAPABILITY_FLUX   (0x02) // COMMAND_READ_FLUX supported
+#define CAPABILITY_SECTOR (0x04) // COMMAND_READ_SECTOR supported
+
+/* -------------------------------------------------------------------------
+ *  Definitions for packed track transfer (see send_packed_track())
+ * ------------------------------------------------------------------------*/
+#define PACKED_ESCAPE   (63) // escape symbol; next symbol: 0..47: run of 1..48 0xFF bytes, or one of the following codes
+#define PACKED_MAX_RUN  (48)
+#define PACKED_D5       (48) // disk byte 0xD5
+#define PACKED_AA       (49) // disk byte 0xAA
+#define PACKED_LITERAL  (50) // any other byte; two symbols follow: upper 2 bits, lower 6 bits
+#define PACKED_END      (51) // end of track data
+#define PACKED_PLAIN    (52) // track data follows unpacked (7KB, after the padding of the current byte)
+
+// 6-bit symbol of disk bytes 0x80..0xFF: index in 6-and-2 code table; 0xFF: no symbol (escape needed)
+const byte packed_symbol[128] PROGMEM = {
+  0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF,
+  0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0x00, 0x01, 0xFF, 0xFF, 0x02, 0x03, 0xFF, 0x04, 0x05, 0x06,
+  0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0x07, 0x08, 0xFF, 0xFF, 0xFF, 0x09, 0x0A, 0x0B, 0x0C, 0x0D,
+  0xFF, 0xFF, 0x0E, 0x0F, 0x10, 0x11, 0x12, 0x13, 0xFF, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1A,
+  0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0x1B, 0xFF, 0x1C, 0x1D, 0x1E,
+  0xFF, 0xFF, 0xFF, 0x1F, 0xFF, 0xFF, 0x20, 0x21, 0xFF, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28,
+  0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0x29, 0x2A, 0x2B, 0xFF, 0x2C, 0x2D, 0x2E, 0x2F, 0x30, 0x31, 0x32,
+  0xFF, 0xFF, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0xFF, 0x39, 0x3A, 0x3B, 0x3C, 0x3D, 0x3E, 0xFF
+};
+
+word packed_acc;  // bit accumulator of packed transfer
+byte packed_bits; // number of bits in accumulator not sent yet
 
 /* -----------------------------------------------------
  *  Definition of data buffer size to capture read data
  * ----------------------------------------------------*/
  
 #define SIZE_OF_DATA_BUFFER  (28) /* 28x256 bytes = 7KB, this is maximum value for ATmega 2560 */
+#define SIZE_OF_SECTOR_BUFFER (2) /* 2x256 bytes captured after the address field of a sector, covers its data field */
+#define SEARCH_LIMIT        "52"  /* max. 52x256 bytes (about 2 revolutions) searched for the address field of a sector */
 
 /* ---------------------------------------------------------------------------------
  *  Definition data structures which are shared with assembly function
@@ -91,11 +128,14 @@
  *  round value: value 0..64 -> added to time stamp value 
  *  capture_data: buffer to store data read from drive
  *  size_capture_data: informs assembly function about size of capture_data buffer
+ *  search_state, search_pattern: address field to be found by assembly function before capturing (see capture_track())
  *  capture_timestamp: small buffer used by ISR to store time stamp value
  *  
  * ------------------------------------------------------------------------------*/
 volatile byte round_value;        
 volatile byte size_capture_data;                          
+volatile byte search_state;
+volatile byte search_pattern[4];
 volatile byte capture_data[SIZE_OF_DATA_BUFFER*256];
 volatile byte capture_timestamp[64] __attribute__((aligned(256))); // must be aligned as ISR triggers wrap around
 
@@ -169,7 +209,13 @@ void test_serial( void) {
  *  Tracks are read only when requested by host. Host commands supported are
  *  a) COMMAND_READ with 2 parameters (track number, round value) -> response byte is returned (OK or INVALID_PARAMS) 
  *     Multiple COMMAND_READs can be issued by host 
- *  b) COMMAND_FINISH to return to main loop -> response byte is returned (OK) and main loop is entered
+ *     COMMAND_READ_PACKED: same as COMMAND_READ, the track data is sent packed (see send_packed_track())
+ *     COMMAND_CAPABILITIES: response byte OK is returned, followed by one byte of CAPABILITY_xxx flags
+ *     COMMAND_READ_SECTOR with 3 parameters (track number, round value, physical sector number): waits for the address 
+ *     field of the sector and captures the following 512 bytes -> response OK followed by the bytes or NOT_FOUND
+ *  b) COMMAND_READ_FLUX with 2 parameters (track number, unused) -> response byte is returned (OK or INVALID_PARAMS) 
+ *     followed by 7KB of flux transition intervals (see capture_flux())
+ *  c) COMMAND_FINISH to return to main loop -> response byte is returned (OK) and main loop is entered
  *     Any other command is responded with RESPONSE_ERROR and main loop is re-entered
  * 
  *  ---------------------------------------------------------------------------------------------------------------
@@ -202,7 +248,12 @@ void track_read( void) {
       finished = true;
       send_host_response( RESPONSE_FINISH);
     }
-    else if(command[0] == COMMAND_READ) {
+    else if(command[0] == COMMAND_CAPABILITIES) {
+      send_host_response(RESPONSE_OK);
+      send_host_response(CAPABILITY_PACKED | CAPABILITY_FLUX | CAPABILITY_SECTOR);
+    }
+    else if((command[0] == COMMAND_READ) || (command[0] == COMMAND_READ_PACKED)) {
+      response = command[0];
       // get READ command parameters
       read_host_command(2, command);
       track_no = command[0];    // track number to be read
@@ -240,7 +291,12 @@ void track_read( void) {
           interrupts();
           
           // send track data to host
-          Serial.write((byte*)capture_data, 7*1024);
+          if( response == COMMAND_READ_PACKED) {
+            send_packed_track();
+          }
+          else {
+            Serial.write((byte*)capture_data, 7*1024);
+          }
         }
         else {
           finished = true;
@@ -248,6 +304,73 @@ void track_read( void) {
         }
       }
     }
+    else if(command[0] == COMMAND_READ_SECTOR) {
+      // get READ_SECTOR command parameters
+      read_host_command(3, command);
+      track_no = command[0];    // track number to be read
+      round_value = command[1]; // round value to be used by assembly function
+      if((track_no > 39) || ( round_value >= 64) || (command[2] > 15)) {
+        send_host_response(0xFE); // invalid parameters
+        finished=true;
+      }
+      // position step motor to requested track
+      else if( set_track( track_no) == OK) { 
+        // address field to be found: track and sector, 4-and-4 encoded
+        search_pattern[0] = (track_no >> 1) | 0xAA;
+        search_pattern[1] = track_no | 0xAA;
+        search_pattern[2] = (command[2] >> 1) | 0xAA;
+        search_pattern[3] = command[2] | 0xAA;
+        search_state = 1;
+        size_capture_data = SIZE_OF_SECTOR_BUFFER;
+        
+        // wait for address field and capture the data field following it
+        noInterrupts();
+        EIMSK = 0x10; // enable only INT4
+        capture_track();
+        EIMSK = 0x0; // disable external interrupts
+        interrupts();
+        size_capture_data = SIZE_OF_DATA_BUFFER;
+        
+        if( search_state == 0) {
+          send_host_response(RESPONSE_OK);
+          Serial.write((byte*)capture_data, SIZE_OF_SECTOR_BUFFER*256);
+        }
+        else {
+          search_state = 0;
+          send_host_response(RESPONSE_NOT_FOUND);
+        }
+      }
+      else {
+        finished = true;
+        send_host_response(RESPONSE_ERROR);
+      }
+    }
+    else if(command[0] == COMMAND_READ_FLUX) {
+      // get READ_FLUX command parameters
+      read_host_command(2, command);
+      track_no = command[0];    // track number to be read
+      if(track_no > 39) {
+        send_host_response(0xFE); // invalid parameters
+        finished=true;
+      }
+      // position step motor to requested track
+      else if( set_track( track_no) == OK) { 
+        send_host_response(RESPONSE_OK);
+        Serial.flush();
+
+        // capture 7KB of flux transition intervals in onchip RAM
+        noInterrupts();
+        capture_flux();
+        interrupts();
+          
+        // send intervals to host
+        Serial.write((byte*)capture_data, 7*1024);
+      }
+      else {
+        finished = true;
+        send_host_response(RESPONSE_ERROR);
+      }
+    }
     else {
       finished = true;
       send_host_response(RESPONSE_ERROR);
@@ -313,6 +436,124 @@ void send_host_response( byte response) {
    Serial.write( response);
 }
 
+/* ----------------------------------------------------------------------------------------------------------------
+ *  send_packed_track()
+ *  
+ *  Sends capture_data[] to host as stream of 6-bit symbols, four symbols packed in three bytes (MSB first)
+ *  
+ *  All captured bytes have the MSB set; the 63 disk bytes of the 6-and-2 code (except 0xFF) are sent as one symbol.
+ *  Runs of 0xFF (sync bytes) and all other bytes are sent after PACKED_ESCAPE:
+ *  - 0..47:           run of 1..48 0xFF bytes
+ *  - PACKED_D5/AA:    disk byte 0xD5/0xAA
+ *  - PACKED_LITERAL:  any other byte, sent in the two following symbols
+ *  - PACKED_END:      end of track data; the last byte is padded with zero bits
+ *  - PACKED_PLAIN:    sent instead of the symbols if they would need more bytes than the plain track data 
+ *                     (e.g. unformatted tracks); the current byte is padded and the 7KB follow unpacked
+ *  
+ *  Sending is done while the data is packed, i.e. transfer time is reduced by about 25% for DOS 3.3 tracks.
+ *  packed_symbol_count() counts the symbols first, so a track is never sent with more than 2 extra bytes.
+ *  ---------------------------------------------------------------------------------------------------------------
+ */
+void send_packed_symbol( byte symbol) {
+  packed_acc = (packed_acc << 6) | symbol;
+  packed_bits += 6;
+  if( packed_bits >= 8) {
+    packed_bits -= 8;
+    Serial.write( (byte)(packed_acc >> packed_bits));
+  }
+}
+
+word packed_symbol_count( void) {
+  word i, count;
+  byte data, run;
+
+  count = 2; // PACKED_END
+  i = 0;
+  while( i < SIZE_OF_DATA_BUFFER*256) {
+    data = capture_data[i];
+    if( data == 0xFF) {
+      run = 0;
+      while(( i < SIZE_OF_DATA_BUFFER*256) && (capture_data[i] == 0xFF) && (run < PACKED_MAX_RUN)) {
+        run++;
+        i++;
+      }
+      count += 2;
+      continue;
+    }
+    if(( data & 0x80) && (pgm_read_byte( &packed_symbol[data & 0x7F]) != 0xFF)) {
+      count += 1;
+    }
+    else if(( data == 0xD5) || (data == 0xAA)) {
+      count += 2;
+    }
+    else {
+      count += 4;
+    }
+    i++;
+  }
+  return count;
+}
+
+void send_packed_track( void) {
+  word i;
+  byte data, symbol, run;
+
+  packed_acc = 0;
+  packed_bits = 0;
+  if( packed_symbol_count() > (SIZE_OF_DATA_BUFFER*256*8)/6) {
+    // packed data would be larger than plain data
+    send_packed_symbol( PACKED_ESCAPE);
+    send_packed_symbol( PACKED_PLAIN);
+    if( packed_bits > 0) {
+      Serial.write( (byte)(packed_acc << (8 - packed_bits)));
+    }
+    Serial.write((byte*)capture_data, 7*1024);
+    return;
+  }
+  i = 0;
+  while( i < SIZE_OF_DATA_BUFFER*256) {
+    data = capture_data[i];
+    if( data == 0xFF) {
+      // run of sync bytes
+      run = 0;
+      while(( i < SIZE_OF_DATA_BUFFER*256) && (capture_data[i] == 0xFF) && (run < PACKED_MAX_RUN)) {
+        run++;
+        i++;
+      }
+      send_packed_symbol( PACKED_ESCAPE);
+      send_packed_symbol( run - 1);
+      continue;
+    }
+    symbol = 0xFF;
+    if( data & 0x80) {
+      symbol = pgm_read_byte( &packed_symbol[data & 0x7F]);
+    }
+    if( symbol != 0xFF) {
+      send_packed_symbol( symbol);
+    }
+    else if( data == 0xD5) {
+      send_packed_symbol( PACKED_ESCAPE);
+      send_packed_symbol( PACKED_D5);
+    }
+    else if( data == 0xAA) {
+      send_packed_symbol( PACKED_ESCAPE);
+      send_packed_symbol( PACKED_AA);
+    }
+    else {
+      send_packed_symbol( PACKED_ESCAPE);
+      send_packed_symbol( PACKED_LITERAL);
+      send_packed_symbol( data >> 6);
+      send_packed_symbol( data & 0x3F);
+    }
+    i++;
+  }
+  send_packed_symbol( PACKED_ESCAPE);
+  send_packed_symbol( PACKED_END);
+  if( packed_bits > 0) {
+    Serial.write( (byte)(packed_acc << (8 - packed_bits)));
+  }
+}
+
 /* ----------------------------------------------------------------------------------------------------------------
  *  setup()
  *  
@@ -6,6 +6,8 @@ extern volatile byte capture_timestamp[];    // 64 byte buffer to store 2-bit ti
 extern volatile byte capture_data[];         // 7 KB buffer to store MSB aligned 8-bit samples
 extern volatile byte round_value;            // value to be added to timer0 cnt value before deciding on bit sequence: "1", "01", "001" or "0-01"
 extern volatile byte size_capture_data;      // size of data buffer  (default is 28d, i.e. 0x1c)*256 -> 7168 = 7KB
+extern volatile byte search_state;           // 0: capture starts immediately; 1: capture starts after address field search_pattern[] (0 if found)
+extern volatile byte search_pattern[];       // track and sector of address field to be searched (4-and-4 encoded)
 
 /* 
  *  Interrupt service routine for INT4 interrupt
@@ -87,6 +89,14 @@ ISR(INT4_vect, ISR_NAKED){             // uses 28 cycles
  *  ->   Note: if a "00" timestamp is found, the current data byte is cleared and bit counter are initialized.
  *  ->   This is because only two consecutive zeros are allowed within a valid data word.
  *  
+ *  Address field search (search_state = 1):
+ *  Before capturing, the assembled bytes are compared with the address field of the requested sector:
+ *  D5 AA 96, volume (any value), track and sector as given in search_pattern[]. Z stays at the start of capture_data 
+ *  while searching, i.e. the capture starts with the first byte after the sector number. r22 holds the number of 
+ *  the next pattern byte (1..9), 0 when found. If the address field is not found within SEARCH_LIMIT*256 bytes
+ *  (about 2 revolutions), the capture is stopped and search_state keeps a value != 0.
+ *  The search adds about 40 cycles per assembled byte (one byte takes 512 cycles).
+ *  
  *  Uses all  CPU registers
  */
 void capture_track( void) {
@@ -127,6 +137,11 @@ void capture_track( void) {
 
            "lds r23, size_capture_data\n"      // load size of data_buffer (in multiples of 256 bytes)
            "lds r17, round_value\n"            // init r17 with round value 
+           "lds r22, search_state\n"           // init r22 with search state (0: no address field search)
+           "lds r6, search_pattern\n"          // init r6..r9 with track and sector of address field to be searched
+           "lds r7, search_pattern+1\n"
+           "lds r8, search_pattern+2\n"
+           "lds r9, search_pattern+3\n"
            "ldi yh, hi8(capture_timestamp)\n"  // init read pointer for timestamp buffer
            "ldi yl, lo8(capture_timestamp)\n"
            "ldi xh, hi8(capture_timestamp)\n"  // init write pointer for timestamp buffer
@@ -222,17 +237,70 @@ void capture_track( void) {
            "clr r18\n"                        // 1, next_word=0
       
 "__chk_end:\n"  
+           "cpse r22, r2 \n"                  // 1-2, searching for address field?
+           "rjmp __search \n"                 // 2
            "adiw r24, 1 \n"                   // 1, increment counter
            "cp  r25, r23 \n"                  // 1, compare with max size of data_buffer
            "breq __exit_capture \n"           // 1-2
 "__inc_read_ptr:\n"
            "andi yl, 63 \n"                   // 1, update read pointer
            "rjmp __chk_read_ptr \n"           // 2
+
+"__search:\n"
+           "ld r19, -Z \n"                    // 2, fetch assembled byte, Z stays at start of buffer
+           "adiw r24, 1 \n"                   // 1, count searched bytes
+           "cpi r25, " SEARCH_LIMIT " \n"     // 1, search limit reached?
+           "breq __exit_capture \n"           // 1-2
+           "mov r21, r19 \n"                  // 1, r21: expected byte; volume (r22: 4, 5) matches any byte
+           "cpi r22, 1 \n"                    // 1
+           "brne __search_2 \n"               // 1-2
+           "ldi r21, 0xD5 \n"                 // 1
+"__search_2:\n"
+           "cpi r22, 2 \n"                    // 1
+           "brne __search_3 \n"               // 1-2
+           "ldi r21, 0xAA \n"                 // 1
+"__search_3:\n"
+           "cpi r22, 3 \n"                    // 1
+           "brne __search_6 \n"               // 1-2
+           "ldi r21, 0x96 \n"                 // 1
+"__search_6:\n"
+           "cpi r22, 6 \n"                    // 1
+           "brne __search_7 \n"               // 1-2
+           "mov r21, r6 \n"                   // 1, track (odd bits)
+"__search_7:\n"
+           "cpi r22, 7 \n"                    // 1
+           "brne __search_8 \n"               // 1-2
+           "mov r21, r7 \n"                   // 1, track (even bits)
+"__search_8:\n"
+           "cpi r22, 8 \n"                    // 1
+           "brne __search_9 \n"               // 1-2
+           "mov r21, r8 \n"                   // 1, sector (odd bits)
+"__search_9:\n"
+           "cpi r22, 9 \n"                    // 1
+           "brne __search_cmp \n"             // 1-2
+           "mov r21, r9 \n"                   // 1, sector (even bits)
+"__search_cmp:\n"
+           "cp r19, r21 \n"                   // 1, expected byte?
+           "brne __search_restart \n"         // 1-2
+           "inc r22 \n"                       // 1, yes: next pattern byte
+           "cpi r22, 10 \n"                   // 1, address field complete?
+           "brne __inc_read_ptr \n"           // 1-2
+           "clr r22 \n"                       // 1, found: start capture with next byte
+           "clr r24 \n"                       // 1
+           "clr r25 \n"                       // 1
+           "rjmp __inc_read_ptr \n"           // 2
+"__search_restart:\n"
+           "ldi r22, 1 \n"                    // 1, restart search ...
+           "cpi r19, 0xD5 \n"                 // 1
+           "brne __inc_read_ptr \n"           // 1-2
+           "ldi r22, 2 \n"                    // 1, ... with D5 already found
+           "rjmp __inc_read_ptr \n"           // 2
                                               // --------------------------
                                               // end of worker thread
                                               // --------------------------
 "__exit_capture:\n"                   
            "cli \n"
+           "sts search_state, r22 \n"          // 0 if address field found (or no search)
            "pop r31\n"
            "pop r30\n"
            "pop r29\n"
@@ -267,3 +335,46 @@ void capture_track( void) {
            "pop r0\n"
          );
 }
+
+/* 
+ *  capture_flux()
+ *  
+ *  Interrupts must be disabled before calling this function!
+ *  
+ *  Captures the time intervals between two rising edges of the drive read signal (flux transitions) in capture_data[].
+ *  Instead of the INT4 interrupt, the read signal pin (PE4) is polled. Each interval is stored as one byte in timer0 ticks 
+ *  (62.5ns); the bit decoding is done on the host. Intervals longer than 255 ticks (timer overflow) are stored as 0xFF.
+ *  The first value holds the time from start of capture to the first transition and is to be ignored.
+ *  
+ *  One loop takes max. 15 cycles, well below the minimum interval of two transitions (4us, i.e. 64 cycles).
+ *  size_capture_data*256 intervals are captured, i.e. about 1/5 of a track revolution.
+ *  
+ *  Uses r16, r18, r24, r25, Z
+ */
+void capture_flux( void) {
+    HW_TIM_CNT=0;
+        asm volatile (
+           "lds r25, size_capture_data\n"      // init loop counter(high) with size of data buffer (in multiples of 256 bytes)
+           "clr r24\n"                         // init loop counter(low)
+           "clr r18\n"                         // use r18 as zero register
+           "ldi zh, hi8(capture_data)\n"       // init Z write pointer for 7KB data buffer
+           "ldi zl, lo8(capture_data)\n"
+           "sbi 0x15, 0 \n"                    // 2, clear TOV by setting bit 0 
+
+"__flux_wait_low:\n"
+           "sbic 0x0c, 4\n"                    // 1-2, wait until read signal (PINE, bit 4) is low 
+           "rjmp __flux_wait_low\n"            // 2
+"__flux_wait_high:\n"
+           "sbis 0x0c, 4\n"                    // 1-2, wait for rising edge of read signal
+           "rjmp __flux_wait_high\n"           // 2
+           "in r16, 0x26 \n"                   // 1, read timer0 to r16
+           "out 0x26, r18 \n"                  // 1, clear timer0 
+           "sbic 0x15, 0 \n"                   // 1-2, skip next instruction if TOV is not set 
+           "ser r16 \n"                        // 1, timer overflow: r16=0xff
+           "sbi 0x15, 0 \n"                    // 2, clear TOV by setting bit 0 
+           "st Z+, r16 \n"                     // 2, store interval in array (capture_data)
+           "sbiw r24, 1 \n"                    // 2, decrement loop counter
+           "brne __flux_wait_low \n"           // 1-2
+           ::: "r16", "r18", "r24", "r25", "r30", "r31", "memory"
+         );
+}